@@ -0,0 +1,52 @@
+"""
+Time checkpointing and restoring a fleet of state machines to one file.
+
+Run with: python benchmarks/bench_checkpoint.py
+"""
+
+import os
+import tempfile
+import time
+
+from scullery import statemachines
+
+MACHINES = 50_000
+
+
+def make_machine() -> statemachines.StateMachine:
+    sm = statemachines.StateMachine(start="idle")
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_rule("idle", "start", "running")
+    sm.set_timer("running", 3600, "idle")
+    sm.freeze()
+    return sm
+
+
+def main():
+    machines = {str(i): make_machine() for i in range(MACHINES)}
+    for i, sm in enumerate(machines.values()):
+        if i % 2:
+            sm.event("start")
+
+    group = statemachines.StateMachineGroup(make_machine(), MACHINES)
+    group.event("start", mask=[bool(i % 2) for i in range(MACHINES)])
+
+    with tempfile.TemporaryDirectory() as d:
+        for name, fleet in (("separate machines", machines), ("group", {"group": group})):
+            fn = os.path.join(d, "checkpoint.json")
+
+            t = time.perf_counter()
+            statemachines.checkpoint(fleet, fn, backup=False)
+            saved = time.perf_counter() - t
+
+            t = time.perf_counter()
+            statemachines.restore_checkpoint(fleet, fn)
+            restored = time.perf_counter() - t
+
+            size = os.path.getsize(fn) / 1e6
+            print(f"{name:>18}: checkpoint {saved:.2f}s, restore {restored:.2f}s, {size:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
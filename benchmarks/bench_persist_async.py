@@ -0,0 +1,81 @@
+"""
+How long the event loop stalls while saving, calling save() directly from a coroutine,
+or through asave().
+
+Run with: python benchmarks/bench_persist_async.py [--fsync-ms 20]
+--fsync-ms adds that much to every fsync, like slow flash storage would.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from scullery import persist
+
+FILES = 20
+SAVES = 200
+
+
+async def ticker(stalls: list[float], stop: asyncio.Event):
+    "Notices when the loop doesn't get back to it for a while"
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        stalls.append(now - last)
+        last = now
+
+
+async def run(d: str, use_async: bool) -> tuple[float, float, float]:
+    stalls: list[float] = []
+    stop = asyncio.Event()
+    t = asyncio.create_task(ticker(stalls, stop))
+    await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    pending = []
+    for i in range(SAVES):
+        data = {"i": i, "rows": [{"id": n, "name": f"row {n}"} for n in range(2000)]}
+        fn = os.path.join(d, f"{i % FILES}.json")
+        if use_async:
+            pending.append(persist.asave(data, fn))
+            # Give the loop a turn, like a real service would
+            await asyncio.sleep(0)
+        else:
+            persist.save(data, fn)
+            await asyncio.sleep(0)
+    await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await t
+    stalls.sort()
+    return elapsed, stalls[len(stalls) // 2], stalls[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fsync-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    if args.fsync_ms:
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(args.fsync_ms / 1000)
+            real_fsync(fd)
+
+        os.fsync = slow_fsync
+
+    # Somewhere on a real disk, /tmp may be in RAM
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        for use_async in (False, True):
+            elapsed, median, worst = asyncio.run(run(d, use_async))
+            name = "asave()" if use_async else "save()"
+            print(f"{SAVES} saves with {name}: {elapsed:.2f}s, event loop stalls {median * 1000:.1f}ms median, {worst * 1000:.1f}ms worst")
+
+
+if __name__ == "__main__":
+    main()
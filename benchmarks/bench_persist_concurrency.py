@@ -0,0 +1,61 @@
+"""
+Measure how much small saves and loads get held up by a slow save of a big
+compressed file in another thread.
+
+Run with: python benchmarks/bench_persist_concurrency.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from scullery import persist
+
+SMALL_THREADS = 4
+SECONDS = 3
+
+
+def main():
+    big = {"rows": [{"id": i, "name": f"row {i}", "values": list(range(20))} for i in range(100_000)]}
+
+    with tempfile.TemporaryDirectory() as d:
+        stop = threading.Event()
+        big_saves = [0]
+        small_ops = [0] * SMALL_THREADS
+        worst = [0.0] * SMALL_THREADS
+
+        def big_saver():
+            n = 0
+            while not stop.is_set():
+                big["rows"][0]["id"] = n
+                n += 1
+                persist.save(big, os.path.join(d, "big.json.bz2"))
+                big_saves[0] += 1
+
+        def small(i: int):
+            fn = os.path.join(d, f"small{i}.json")
+            n = 0
+            while not stop.is_set():
+                t = time.perf_counter()
+                persist.save({"n": n}, fn, backup=False)
+                persist.load(fn)
+                worst[i] = max(worst[i], time.perf_counter() - t)
+                n += 1
+            small_ops[i] = n
+
+        threads = [threading.Thread(target=big_saver)]
+        threads += [threading.Thread(target=small, args=(i,)) for i in range(SMALL_THREADS)]
+        for t in threads:
+            t.start()
+        time.sleep(SECONDS)
+        stop.set()
+        for t in threads:
+            t.join()
+
+    print(f"big bz2 saves: {big_saves[0]}")
+    print(f"small save+load pairs: {sum(small_ops) / SECONDS:,.0f}/s, worst {max(worst) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
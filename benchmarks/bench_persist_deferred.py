@@ -0,0 +1,46 @@
+"""
+Compare saving a small state file on every change with deferred saves.
+
+Run with: python benchmarks/bench_persist_deferred.py
+"""
+
+import os
+import tempfile
+import time
+
+from scullery import persist
+
+CHANGES = 2000
+
+fsyncs = 0
+real_fsync = os.fsync
+
+
+def counting_fsync(fd):
+    global fsyncs
+    fsyncs += 1
+    real_fsync(fd)
+
+
+def run(fn: str, deferred: bool) -> tuple[float, int]:
+    global fsyncs
+    fsyncs = 0
+    t = time.perf_counter()
+    for i in range(CHANGES):
+        persist.save({"state": "on" if i % 2 else "off", "count": i}, fn, deferred=deferred)
+    persist.flush_all()
+    return time.perf_counter() - t, fsyncs
+
+
+def main():
+    os.fsync = counting_fsync
+
+    # Somewhere on a real disk, /tmp may be in RAM
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        for deferred in (False, True):
+            elapsed, n = run(os.path.join(d, f"state{deferred}.json"), deferred)
+            print(f"{CHANGES} changes, deferred={deferred}: {elapsed:.3f}s, {n} fsyncs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Encode and decode time, and size, for each file format and compression persist knows.
+Formats whose library isn't installed are skipped.
+
+Run with: python benchmarks/bench_persist_formats.py [--records 20000]
+"""
+
+import argparse
+import time
+
+from scullery import persist
+
+FORMATS = ["json", "yaml", "msgpack", "cbor", "toml"]
+COMPRESSION = ["", ".gz", ".bz2", ".zst", ".lz4"]
+
+
+def config(n: int) -> dict:
+    "Something shaped like a big config file"
+    return {
+        "version": 3,
+        "devices": {
+            f"device{i}": {"name": f"Device {i}", "enabled": i % 3 == 0, "gain": i * 0.25, "tags": ["a", "b"], "channels": [1, 2, i]}
+            for i in range(n)
+        },
+    }
+
+
+def measure(data, fn: str) -> tuple[float, float, int]:
+    t = time.perf_counter()
+    raw = persist._encode(data, fn)
+    encode = time.perf_counter() - t
+
+    t = time.perf_counter()
+    persist._decode(raw, fn)
+    decode = time.perf_counter() - t
+    return encode, decode, len(raw)
+
+
+def pure_python_yaml(data) -> tuple[float, float, int]:
+    "How .yaml worked before, without libyaml"
+    import yaml
+
+    t = time.perf_counter()
+    text = yaml.dump(data)
+    encode = time.perf_counter() - t
+
+    t = time.perf_counter()
+    yaml.load(text, Loader=yaml.SafeLoader)
+    decode = time.perf_counter() - t
+    return encode, decode, len(text.encode("utf8"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000)
+    args = parser.parse_args()
+    data = config(args.records)
+
+    print(f"{'format':<22}{'encode':>10}{'decode':>10}{'size':>12}")
+
+    def row(name, r):
+        print(f"{name:<22}{r[0] * 1000:>8.1f}ms{r[1] * 1000:>8.1f}ms{r[2] / 1024:>9.0f}KiB")
+
+    row("yaml (pure Python)", pure_python_yaml(data))
+
+    for fmt in FORMATS:
+        for comp in COMPRESSION:
+            fn = f"data.{fmt}{comp}"
+            try:
+                r = measure(data, fn)
+            except ImportError as e:
+                print(f"{fn:<22}skipped, {e.name} not installed")
+                break
+            row(fn, r)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Change one key at a time in a big key/value state, saving the whole file every time,
+or with a Journal. Also many threads writing to one Journal at once, sharing fsyncs.
+
+Run with: python benchmarks/bench_persist_journal.py [--keys 10000]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from scullery import persist
+
+CHANGES = 500
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=10000)
+    args = parser.parse_args()
+    state = {f"device{i}": {"name": f"Device {i}", "on": False, "level": i} for i in range(args.keys)}
+
+    # Somewhere on a real disk, /tmp may be in RAM
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        fn = os.path.join(d, "state.json")
+        t = time.perf_counter()
+        for i in range(CHANGES):
+            state[f"device{i}"]["on"] = True
+            persist.save(state, fn)
+        elapsed = time.perf_counter() - t
+        print(f"save() per change, {args.keys} keys: {elapsed / CHANGES * 1000:.2f}ms each")
+
+        j = persist.Journal(os.path.join(d, "journal.json"))
+        j.update(state)
+        t = time.perf_counter()
+        for i in range(CHANGES):
+            j[f"device{i}"] = {"name": f"Device {i}", "on": False, "level": i}
+        elapsed = time.perf_counter() - t
+        print(f"Journal per change, {args.keys} keys: {elapsed / CHANGES * 1000:.2f}ms each")
+
+        fsyncs = 0
+        real_fsync = os.fsync
+
+        def counting_fsync(fd):
+            nonlocal fsyncs
+            fsyncs += 1
+            real_fsync(fd)
+
+        os.fsync = counting_fsync
+
+        def worker(n):
+            for i in range(CHANGES // 10):
+                j[f"device{n}"] = {"name": f"Device {n}", "on": True, "level": i}
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(10)]
+        t = time.perf_counter()
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        elapsed = time.perf_counter() - t
+        os.fsync = real_fsync
+        print(f"Journal, 10 threads, {CHANGES} changes: {elapsed:.3f}s, {fsyncs} fsyncs")
+        j.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compare full loads against iter_load() and load_keys() on big files.
+Each case runs in its own child process, so peak memory can be measured separately.
+
+Run with: python benchmarks/bench_persist_lazy_load.py [--size-mb 1024] [--no-full]
+--no-full skips the full loads, which need several times the file size in RAM.
+Linux or macOS only, for fork and ru_maxrss.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from scullery import persist
+
+
+def record(i: int) -> dict:
+    return {"id": i, "name": f"record {i}", "tags": ["a", "b"], "values": [i, i * 2, {"x": i}]}
+
+
+def write_files(d: str, size: int) -> tuple[str, str]:
+    "Write a .jsonl file and a .json file with a small header, a big list, and a small footer"
+    line = json.dumps(record(0)) + "\n"
+    n = size // len(line)
+
+    jsonl = os.path.join(d, "big.jsonl")
+    persist.save((record(i) for i in range(n)), jsonl, stream=True, backup=False)
+
+    js = os.path.join(d, "big.json")
+    with open(js, "w") as f:
+        f.write('{"header": {"version": 1}, "rows": [')
+        for i in range(n):
+            if i:
+                f.write(", ")
+            f.write(json.dumps(record(i)))
+        f.write('], "footer": {"count": %d}}' % n)
+
+    return jsonl, js
+
+
+def child(f, args, conn):
+    t = time.perf_counter()
+    f(*args)
+    elapsed = time.perf_counter() - t
+    conn.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(name: str, f, *args):
+    ctx = multiprocessing.get_context("fork")
+    a, b = ctx.Pipe()
+    p = ctx.Process(target=child, args=(f, args, b))
+    p.start()
+    elapsed, rss = a.recv()
+    p.join()
+    # ru_maxrss is KiB on Linux
+    print(f"{name:>36}: {elapsed:6.2f}s, peak RSS {rss / 1024:8.1f}MiB")
+
+
+def full_load(fn):
+    persist.load(fn)
+
+
+def count_records(fn):
+    for i in persist.iter_load(fn):
+        pass
+
+
+def keys(fn, k):
+    persist.load_keys(fn, k)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--no-full", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        t = time.perf_counter()
+        jsonl, js = write_files(d, args.size_mb * 1024 * 1024)
+        print(f"Wrote {args.size_mb}MiB files in {time.perf_counter() - t:.1f}s")
+
+        if not args.no_full:
+            measure("load() .jsonl", full_load, jsonl)
+        measure("iter_load() .jsonl", count_records, jsonl)
+
+        if not args.no_full:
+            measure("load() .json", full_load, js)
+        measure("load_keys() first key", keys, js, ["header"])
+        measure("load_keys() key after the big one", keys, js, ["footer"])
+
+
+if __name__ == "__main__":
+    main()
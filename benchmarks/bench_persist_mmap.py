@@ -0,0 +1,78 @@
+"""
+Load a big .bin file and read a few slices of it, with load() or open_buffer(),
+and save a big bytearray directly or after copying it into bytes.
+Each case runs in its own child process, so peak memory can be measured separately.
+
+Run with: python benchmarks/bench_persist_mmap.py [--size-mb 1024]
+Linux or macOS only, for fork and ru_maxrss.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from scullery import persist
+
+
+def child(f, args, conn):
+    t = time.perf_counter()
+    f(*args)
+    elapsed = time.perf_counter() - t
+    conn.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(name: str, f, *args):
+    ctx = multiprocessing.get_context("fork")
+    a, b = ctx.Pipe()
+    p = ctx.Process(target=child, args=(f, args, b))
+    p.start()
+    # So recv() fails instead of waiting forever if the child dies
+    b.close()
+    elapsed, rss = a.recv()
+    p.join()
+    # ru_maxrss is KiB on Linux
+    print(f"{name:>32}: {elapsed:6.2f}s, peak RSS {rss / 1024:8.1f}MiB")
+
+
+def slices(data):
+    step = len(data) // 100
+    return sum(bytes(data[i * step : i * step + 4096]).count(0) for i in range(100))
+
+
+def full_load(fn):
+    slices(persist.load(fn))
+
+
+def mapped(fn):
+    slices(persist.open_buffer(fn))
+
+
+def save_buffer(fn, size, copy):
+    data = bytearray(size)
+    persist.save(bytes(data) if copy else data, fn, backup=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    # Somewhere on a real disk, /tmp may be in RAM
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        fn = os.path.join(d, "big.bin")
+        with open(fn, "wb") as f:
+            for i in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        measure("load(), 100 slices", full_load, fn)
+        measure("open_buffer(), 100 slices", mapped, fn)
+        measure("save(bytes(bytearray))", save_buffer, os.path.join(d, "a.bin"), size, True)
+        measure("save(bytearray)", save_buffer, os.path.join(d, "b.bin"), size, False)
+
+
+if __name__ == "__main__":
+    main()
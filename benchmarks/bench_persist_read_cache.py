@@ -0,0 +1,40 @@
+"""
+Repeated loads of the same config file, with and without the read cache.
+
+Run with: python benchmarks/bench_persist_read_cache.py
+"""
+
+import os
+import tempfile
+import time
+
+from scullery import persist
+
+LOADS = 20
+
+
+def config(n: int) -> dict:
+    return {"devices": {f"device{i}": {"name": f"Device {i}", "enabled": i % 3 == 0, "channels": [1, 2, i]} for i in range(n)}}
+
+
+def main():
+    data = config(5000)
+
+    with tempfile.TemporaryDirectory() as d:
+        for ext in ("json", "json.gz", "yaml"):
+            fn = os.path.join(d, f"config.{ext}")
+            persist.save(data, fn)
+
+            for cache in (False, True):
+                persist.clear_read_cache()
+                # The first load always reads the file
+                persist.load(fn, cache=cache)
+                t = time.perf_counter()
+                for i in range(LOADS):
+                    persist.load(fn, cache=cache)
+                elapsed = time.perf_counter() - t
+                print(f"{LOADS} loads of {ext}, cache={cache}: {elapsed / LOADS * 1000:.1f}ms each")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Compare peak memory and time of normal and streaming saves of a large dataset.
+
+Run with: python benchmarks/bench_persist_streaming.py
+"""
+
+import os
+import tempfile
+import time
+import tracemalloc
+
+from scullery import persist
+
+
+def main():
+    data = {"rows": [{"id": i, "name": f"row {i}", "values": list(range(10))} for i in range(300_000)]}
+
+    with tempfile.TemporaryDirectory() as d:
+        for ext in ("json", "json.gz", "json.bz2"):
+            for stream in (False, True):
+                fn = os.path.join(d, f"data{stream}.{ext}")
+                t = time.perf_counter()
+                persist.save(data, fn, stream=stream)
+                elapsed = time.perf_counter() - t
+                os.remove(fn)
+
+                # Separately, since tracing slows everything down
+                tracemalloc.start()
+                persist.save(data, fn, stream=stream)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                size = os.path.getsize(fn) / 1e6
+                mode = "stream" if stream else "normal"
+                print(f"{ext:>9} {mode}: {elapsed:.2f}s, peak {peak / 1e6:.1f}MB extra, file {size:.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
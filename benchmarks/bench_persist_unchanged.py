@@ -0,0 +1,45 @@
+"""
+Measure repeated saves of a large file whose data hasn't changed.
+
+Run with: python benchmarks/bench_persist_unchanged.py [--cold]
+--cold drops the page cache before every save, so reads come from disk. Needs root on Linux.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from scullery import persist
+
+SAVES = 20
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3")
+
+
+def main():
+    cold = "--cold" in sys.argv
+    data = os.urandom(64_000_000)
+
+    # Somewhere on a real disk, /tmp may be in RAM
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as d:
+        fn = os.path.join(d, "big.bin")
+        persist.save(data, fn)
+
+        elapsed = 0.0
+        for i in range(SAVES):
+            if cold:
+                drop_caches()
+            t = time.perf_counter()
+            persist.save(data, fn)
+            elapsed += time.perf_counter() - t
+
+    print(f"{SAVES} unchanged saves of 64MB{' (cold cache)' if cold else ''}: {elapsed / SAVES * 1000:.1f}ms each")
+
+
+if __name__ == "__main__":
+    main()
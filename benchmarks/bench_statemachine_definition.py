@@ -0,0 +1,61 @@
+"""
+Compare building many identical machines one add_state() at a time
+against making them from one shared MachineDefinition.
+
+Run with: python benchmarks/bench_statemachine_definition.py
+"""
+
+import time
+import tracemalloc
+
+from scullery import statemachines
+
+MACHINES = 10_000
+
+DEFINITION = {
+    "start": "idle",
+    "states": {
+        "idle": {"rules": {"start": "running"}},
+        "running": {"rules": {"stop": "idle", "error": "fault"}, "timer": [60, "idle"]},
+        "fault": {"rules": {"reset": "idle"}},
+    },
+}
+
+
+def build() -> statemachines.StateMachine:
+    sm = statemachines.StateMachine(start="idle")
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_state("fault")
+    sm.add_rule("idle", "start", "running")
+    sm.add_rule("running", "stop", "idle")
+    sm.add_rule("running", "error", "fault")
+    sm.add_rule("fault", "reset", "idle")
+    sm.set_timer("running", 60, "idle")
+    sm.freeze()
+    return sm
+
+
+def measure(name, f):
+    tracemalloc.start()
+    t = time.perf_counter()
+    machines = [f() for i in range(MACHINES)]
+    elapsed = time.perf_counter() - t
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Make sure they actually work
+    for sm in machines:
+        sm.event("start")
+
+    print(f"{name:>12}: {MACHINES} machines in {elapsed:.2f}s, {size / MACHINES / 1024:.1f}KiB each")
+
+
+def main():
+    measure("add_state", build)
+    d = statemachines.MachineDefinition(DEFINITION)
+    measure("definition", d.machine)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare broadcasting one event to many separate StateMachines
+against a StateMachineGroup with the same definition.
+
+Run with: python benchmarks/bench_statemachine_group.py
+"""
+
+import time
+
+from scullery import statemachines
+
+MACHINES = 10_000
+ROUNDS = 20
+
+
+def make_definition() -> statemachines.StateMachine:
+    sm = statemachines.StateMachine(start="idle")
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_state("fault")
+    sm.add_rule("idle", "start", "running")
+    sm.add_rule("running", "power_fail", "fault")
+    sm.add_rule("idle", "power_fail", "fault")
+    sm.add_rule("fault", "reset", "idle")
+    sm.set_timer("running", 60, "idle")
+    sm.freeze()
+    return sm
+
+
+def bench_machines() -> float:
+    machines = [make_definition() for i in range(MACHINES)]
+    t = time.perf_counter()
+    for r in range(ROUNDS):
+        for e in ("start", "power_fail", "reset"):
+            for sm in machines:
+                sm.event(e)
+    return time.perf_counter() - t
+
+
+def bench_group() -> float:
+    group = statemachines.StateMachineGroup(make_definition(), MACHINES)
+    t = time.perf_counter()
+    for r in range(ROUNDS):
+        for e in ("start", "power_fail", "reset"):
+            group.event(e)
+    elapsed = time.perf_counter() - t
+    group.close()
+    return elapsed
+
+
+def main():
+    events = MACHINES * ROUNDS * 3
+    for name, f in (("separate machines", bench_machines), ("group", bench_group)):
+        elapsed = f()
+        print(f"{name:>18}: {events} machine events in {elapsed:.2f}s, {events / elapsed:,.0f}/s")
+
+    group = statemachines.StateMachineGroup(make_definition(), MACHINES)
+    group.event("start", mask=[i % 2 == 0 for i in range(MACHINES)])
+    t = time.perf_counter()
+    for r in range(100):
+        group.counts()
+        group.older_than(30, "running")
+    print(f"{'queries':>18}: {(time.perf_counter() - t) / 100 * 1e3:.2f}ms per counts() + older_than()")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Measure how long a StateMachine's lock is held per transition when a subscriber is slow,
+for each hook dispatch mode, along with how long event() takes for the caller.
+
+Run with: python benchmarks/bench_statemachine_hooks.py
+"""
+
+import time
+
+from scullery import statemachines
+
+EVENTS = 200
+SUBSCRIBER_TIME = 0.001
+
+
+def slow_subscriber(state):
+    time.sleep(SUBSCRIBER_TIME)
+
+
+class TimedLock:
+    "Stands in for the machine's RLock, and records how long each outermost acquire is held"
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.depth = 0
+        self.acquired = 0.0
+        self.holds: list[float] = []
+
+    def __enter__(self):
+        self.lock.acquire()
+        # Only changed while holding the lock
+        self.depth += 1
+        if self.depth == 1:
+            self.acquired = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.holds.append(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+def summary(name: str, times: list[float]) -> str:
+    times = sorted(times)
+    return (
+        f"{name} mean {sum(times) / len(times) * 1e6:8.1f}us  "
+        f"p50 {times[len(times) // 2] * 1e6:8.1f}us  "
+        f"max {times[-1] * 1e6:8.1f}us"
+    )
+
+
+def bench(dispatch: str):
+    sm = statemachines.StateMachine(start="a", dispatch=dispatch)
+    sm.add_state("a", enter=lambda: None, exit=lambda: None)
+    sm.add_state("b", enter=lambda: None, exit=lambda: None)
+    sm.add_rule("a", "go", "b")
+    sm.add_rule("b", "go", "a")
+    sm.subscribe(slow_subscriber)
+    sm.freeze()
+    lock = sm.lock = TimedLock(sm.lock)
+
+    calls = []
+    for i in range(EVENTS):
+        t = time.perf_counter()
+        sm.event("go")
+        calls.append(time.perf_counter() - t)
+
+    print(f"{dispatch:>8}: {summary('lock held', lock.holds)}")
+    print(f"{'':>8}  {summary('event()  ', calls)}")
+
+    # Let the background hooks finish before the next run
+    time.sleep(EVENTS * SUBSCRIBER_TIME * 2)
+
+
+def main():
+    print(f"Per transition, subscriber takes {SUBSCRIBER_TIME * 1000}ms")
+    for i in statemachines.hook_dispatch_modes:
+        bench(i)
+
+
+if __name__ == "__main__":
+    main()
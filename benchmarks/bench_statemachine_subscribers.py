@@ -0,0 +1,54 @@
+"""
+Measure StateMachine subscribe/unsubscribe churn with many subscribers.
+
+Run with: python benchmarks/bench_statemachine_subscribers.py
+"""
+
+import time
+
+from scullery import statemachines
+
+SUBSCRIBERS = 5_000
+
+
+def make_subscriber():
+    def f(state):
+        pass
+
+    return f
+
+
+def main():
+    sm = statemachines.StateMachine(start="idle")
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_rule("idle", "start", "running")
+    sm.add_rule("running", "stop", "idle")
+
+    funcs = [make_subscriber() for i in range(SUBSCRIBERS)]
+    states = ("idle", "running", "__all__")
+
+    t = time.perf_counter()
+    for i, f in enumerate(funcs):
+        sm.subscribe(f, states[i % 3])
+    print(f"subscribe {SUBSCRIBERS}: {time.perf_counter() - t:.3f}s")
+
+    t = time.perf_counter()
+    for i in range(20):
+        sm.event("start")
+        sm.event("stop")
+    print(f"40 transitions: {time.perf_counter() - t:.3f}s")
+
+    t = time.perf_counter()
+    for i, f in enumerate(funcs):
+        sm.unsubscribe(f, states[i % 3])
+        sm.subscribe(f, states[i % 3])
+    print(f"unsubscribe and resubscribe {SUBSCRIBERS}: {time.perf_counter() - t:.3f}s")
+
+    t = time.perf_counter()
+    del funcs
+    print(f"drop all {SUBSCRIBERS} subscribers: {time.perf_counter() - t:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Measure StateMachine event dispatch throughput across many small machines,
+with and without transition tracing and stats.
+
+Run with: python benchmarks/bench_statemachines.py
+"""
+
+import time
+import random
+
+from scullery import statemachines
+
+MACHINES = 10_000
+EVENTS = 500_000
+
+
+def make_machine(**kwargs) -> statemachines.StateMachine:
+    sm = statemachines.StateMachine(start="idle", **kwargs)
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_state("fault")
+    sm.add_rule("idle", "start", "running")
+    sm.add_rule("running", "stop", "idle")
+    sm.add_rule("running", "error", "fault")
+    sm.add_rule("fault", "reset", "idle")
+    sm.set_timer("running", 60, "idle")
+    sm.freeze()
+    return sm
+
+
+def run(name: str, **kwargs):
+    t = time.perf_counter()
+    machines = [make_machine(**kwargs) for i in range(MACHINES)]
+    print(f"{name}: created {MACHINES} machines in {time.perf_counter() - t:.2f}s")
+
+    events = ["start", "stop", "error", "reset", "nothing"]
+    rng = random.Random(0)
+    work = [(rng.choice(machines), rng.choice(events)) for i in range(EVENTS)]
+
+    t = time.perf_counter()
+    for sm, e in work:
+        sm.event(e)
+    elapsed = time.perf_counter() - t
+
+    print(f"{name}: {EVENTS} events in {elapsed:.2f}s, {EVENTS / elapsed:,.0f} events/s")
+
+
+def main():
+    run("plain")
+    run("trace=64, stats=True", trace=64, stats=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# SPDX-FileCopyrightText: Copyright Daniel Dunn
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+"""
+Pluggable clocks for scheduling, state machines, and rate limiting.
+
+Everything time-based in scullery asks a clock object for the time
+instead of calling the time module directly. Normally that is the
+shared system_clock, but you can pass a VirtualClock instead and
+move time forward instantly, which runs everything that comes due
+along the way, in order, in the calling thread.
+
+## Example
+```python
+from scullery import clocks, scheduling, statemachines
+
+clock = clocks.VirtualClock()
+sched = scheduling.NewScheduler(clock=clock)
+
+sm = statemachines.StateMachine("off", scheduler=sched)
+sm.add_state("on")
+sm.add_state("off")
+sm.add_rule("off", "motion", "on")
+sm.set_timer("on", 3600, "off")
+
+sm.event("motion")
+
+# An hour goes by in no time at all
+clock.advance(3601)
+assert sm.state == "off"
+```
+"""
+
+from __future__ import annotations
+
+import time
+import threading
+import weakref
+from typing import Any
+
+
+class Clock:
+    """The real system clock. Subclasses must provide time() and monotonic(),
+    with the same meanings as in the time module."""
+
+    # Virtual clocks don't move on their own, so anything
+    # using them must not wait for them in real time.
+    virtual = False
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, t: float):
+        time.sleep(t)
+
+
+class VirtualClock(Clock):
+    """A simulated clock that only moves when told to.
+
+    Schedulers created with a virtual clock don't start any threads,
+    advance() runs their due events directly, in deadline order.
+    """
+
+    virtual = True
+
+    def __init__(self, start: float | None = None):
+        """
+        Args:
+            start (float | None, optional): Initial wall clock time.
+                Defaults to the real time.time() at creation.
+        """
+        self._lock = threading.RLock()
+        self._monotonic = 0.0
+        self._wall_offset = time.time() if start is None else float(start)
+        self._schedulers: weakref.WeakSet[Any] = weakref.WeakSet()
+
+    def __repr__(self) -> str:
+        return f"<VirtualClock at {id(self)}, t={self.time()}>"
+
+    def time(self) -> float:
+        return self._wall_offset + self._monotonic
+
+    def monotonic(self) -> float:
+        return self._monotonic
+
+    def sleep(self, t: float):
+        self.advance(t)
+
+    def attach(self, scheduler: Any):
+        """Register a scheduler to be driven by this clock.
+        NewScheduler does this itself when given a virtual clock."""
+        self._schedulers.add(scheduler)
+
+    def advance(self, t: float):
+        """Move time forward t seconds, running everything that
+        comes due on any attached scheduler along the way."""
+        if t < 0:
+            raise ValueError("Virtual time cannot go backwards")
+
+        with self._lock:
+            target = self._monotonic + t
+
+            while True:
+                # Find whichever scheduler has the soonest deadline
+                soonest = None
+                delay = None
+                for s in list(self._schedulers):
+                    d = s._time_until_next()
+                    if d is not None and (delay is None or d < delay):
+                        delay = d
+                        soonest = s
+
+                if soonest is None or delay is None:
+                    break
+                if self._monotonic + max(delay, 0.0) > target:
+                    break
+
+                self._monotonic += max(delay, 0.0)
+                soonest._run_due()
+
+            self._monotonic = target
+
+    def step(self, t: float):
+        """Step the wall clock by t seconds without moving the
+        monotonic clock, like an NTP correction or a user changing the time."""
+        with self._lock:
+            self._wall_offset += t
+            for s in list(self._schedulers):
+                s._check_clock_jump()
+            self.advance(0)
+
+    def advance_to(self, t: float):
+        "Advance until the wall clock reads t"
+        self.advance(max(0.0, t - self.time()))
+
+
+system_clock = Clock()
@@ -23,7 +23,7 @@ from collections.abc import Callable
 
 from pydantic import validate_call
 
-from . import workers
+from . import workers, scheduling
 from collections import defaultdict, OrderedDict
 
 _subscribers_list_modify_lock = threading.RLock()
@@ -92,11 +92,24 @@ class MessageBus:
         self._subscribers_immutable = {}
 
     @validate_call
-    def subscribe(self, topic: str, callback: Callable[..., Any]):
+    def subscribe(
+        self,
+        topic: str,
+        callback: Callable[..., Any],
+        debounce: float | None = None,
+        throttle: float | None = None,
+    ):
+        """Subscribe callback to topic.
+
+        If debounce is set, callback only runs once messages stop arriving
+        for that many seconds, with the last message.
+        If throttle is set, callback runs at most once per that many seconds,
+        on the first message and then with the latest message at the end of each interval.
+        """
         topic = normalize_topic(topic)
 
         with _subscribers_list_modify_lock:
-            wrappedCallback = self._wrap_callback(callback, topic)
+            wrappedCallback = self._wrap_callback(callback, topic, debounce, throttle)
 
             self._subscribers[topic].append(wrappedCallback)
             self._subscribers_immutable = copy.deepcopy(self._subscribers)
@@ -166,7 +179,7 @@ class MessageBus:
         return matchingtopics
 
     @validate_call
-    def _wrap_callback(self, f: Callable[..., Any], topic: str):
+    def _wrap_callback(self, f: Callable[..., Any], topic: str, debounce: float | None = None, throttle: float | None = None):
         """return function g that calls f with (topic,message) or just f(topic), depending
         on how many args there are.
          and if errors is true logs the error"""
@@ -290,6 +303,16 @@ class MessageBus:
         else:
             raise ValueError("Invalid function signature(0,1,2, or 4 args supported, not " + str(args) + ")")
 
+        if debounce or throttle:
+            if debounce:
+                limiter = scheduling.Debouncer(g, debounce)
+            else:
+                limiter = scheduling.Throttler(g, throttle)
+
+            # The limiter only holds the weakref, so this doesn't keep f alive
+            def g(topic, message, errors, timestamp, annotation):
+                limiter(topic, message, errors, timestamp, annotation)
+
         # Ref to the weakref so it's easy to check if the function we are wrapping
         # Still exists.
         g.originalFunction = f
@@ -12,7 +12,18 @@ import json
 import time
 import logging
 import hashlib
-import threading
+import re
+import contextlib
+import atexit
+import pickle
+import weakref
+import mmap
+import asyncio
+import collections
+import concurrent.futures
+import functools
+from typing import Any, NamedTuple
+from collections.abc import Awaitable, Callable, Iterator, Iterable, MutableMapping
 
 posix_rename = False
 if sys.platform.startswith("linux"):
@@ -27,12 +38,78 @@ def resolve_path(fn, expand=True):
     return os.path.expandvars(os.path.expanduser(fn))
 
 
-# TODO: Ensure only one thread can save a file at a time
 strio = io.BytesIO
 
-# must be Rlock because load is recursive
+# No longer used here, saves and loads only lock the file they are working on.
+# Kept for anything outside that used it.
 lock = threading.RLock()
 
+# Striped locks, one for each file at a time, without keeping a lock for every path we ever saw.
+# Re-entrant in case something saves or loads from inside something holding one.
+_path_locks = [threading.RLock() for i in range(64)]
+
+
+def _path_lock(fn: str) -> threading.RLock:
+    "Get the lock for a resolved path. Different spellings of one path get the same lock."
+    return _path_locks[hash(os.path.normcase(os.path.abspath(fn))) % len(_path_locks)]
+
+
+# Digest of what we last wrote, or found was already there, for each path, along with the file's stat signature at the time.
+# If the signature still matches, we know what's in the file without reading it.
+# Only touched under the path's lock.
+_digests: dict[str, tuple[tuple[int, int, int, int], bytes]] = {}
+digest_cache_size = 4096
+
+
+def _stat_signature(st: os.stat_result) -> tuple[int, int, int, int]:
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev)
+
+
+def _digest(data: bytes) -> bytes:
+    # SHA-256 rather than BLAKE2, since most CPUs have instructions for it that make it about twice as fast
+    return hashlib.sha256(data).digest()
+
+
+def _remember_digest(fn: str, st: os.stat_result, digest: bytes):
+    "Needs to be called under the path lock"
+    key = os.path.abspath(fn)
+    _digests.pop(key, None)
+    if len(_digests) >= digest_cache_size:
+        # Forget the oldest entry, dicts keep insertion order
+        del _digests[next(iter(_digests))]
+    _digests[key] = (_stat_signature(st), digest)
+
+
+def _cached_match(fn: str, st: os.stat_result, digest: bytes) -> bool | None:
+    "Whether the file matches the digest, or None if we don't know what's in it. Needs to be called under the path lock."
+    cached = _digests.get(os.path.abspath(fn))
+    if cached and cached[0] == _stat_signature(st):
+        return cached[1] == digest
+    return None
+
+
+def _unchanged(fn: str, data: bytes, digest: bytes) -> bool:
+    """Check if the file already holds exactly data. Needs to be called under the path lock.
+    Only reads the file if it has been changed by someone else since we last saw it."""
+    try:
+        st = os.stat(fn)
+    except FileNotFoundError:
+        return False
+
+    known = _cached_match(fn, st, digest)
+    if known is not None:
+        return known
+
+    # Different sizes can't be the same
+    if not st.st_size == len(data):
+        return False
+
+    with open(fn, "rb") as f:
+        if f.read() == data:
+            _remember_digest(fn, st, digest)
+            return True
+    return False
+
 
 def chmod_private_try(p, execute=True):
     try:
@@ -50,9 +127,469 @@ def ensure_dir(f):
         os.makedirs(d)
 
 
-def save(data, fn, *, private=False, backup=True, expand=True, md5=False, nolog=False):
-    """Save data to file. Filename must end in .json, .yaml, .txt, or .bin. Data will be encoded appropriately.
-    Also supports compressed versions via filenames ending in .gz or .bz2.
+def _encode(data, fn: str, level=None) -> bytes:
+    "Encode and compress data according to the file extension. Doesn't touch the file."
+    codec, compressor = _formats(fn)
+    data = codec.encode(data)
+    # Compress in memory first, so we can compare before writing
+    if compressor:
+        data = _compress(compressor, data, level)
+    return data
+
+
+def _prepare_dir(fn: str, private: bool):
+    "Make the file's directory if needed, without ever replacing a file with a directory or the other way around"
+    # Make sure we don't overwrite a file when we create our dirs, because that behavior is undocumented in makedirs.
+    x = os.path.split(fn)[0]
+    already = {}
+
+    # Safety counter to stop really wierd loops
+    for i in range(64):
+        if os.path.isfile(x):
+            raise RuntimeError("Required intermediate directory is already present as a file, refusing to overwrite file")
+        x = os.path.split(x)[0]
+        # Loop prevention
+        if x in already:
+            break
+        already[x] = True
+
+    if not os.path.exists(os.path.dirname(fn)):
+        if private:
+            os.makedirs(os.path.dirname(fn), mode=0o700, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+    if os.path.isdir(fn):
+        raise RuntimeError("Filename is already present as a directory, refusing to overwrite directory")
+
+
+class _DigestWriter(io.RawIOBase):
+    "Passes writes through to a file, hashing everything on the way"
+
+    def __init__(self, f, md5: bool = False):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.md5 = hashlib.md5() if md5 else None
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.f.write(b)
+        self.hash.update(b)
+        if self.md5:
+            self.md5.update(b)
+        n = len(memoryview(b).cast("B"))
+        self.size += n
+        return n
+
+
+class _TextSink:
+    """Collects text from an encoder and writes it on as UTF-8 in large chunks.
+    Never flushes what's under it, since flushing a compressor changes its output."""
+
+    def __init__(self, out, chunk_size: int = 1 << 16):
+        self.out = out
+        self.chunk_size = chunk_size
+        self.pending: list[str] = []
+        self.pending_size = 0
+
+    def write(self, s: str):
+        self.pending.append(s)
+        self.pending_size += len(s)
+        if self.pending_size >= self.chunk_size:
+            self.finish()
+        return len(s)
+
+    def finish(self):
+        if self.pending:
+            self.out.write("".join(self.pending).encode("utf8"))
+            self.pending = []
+            self.pending_size = 0
+
+
+def _json_chunks(obj, split: int = 64, top: bool = True):
+    """Same text as json.dumps(obj), a piece at a time. Runs of small items go through json.dumps
+    together, which is much faster than json.dump, and big lists and dicts get split up,
+    as does everything directly under the top level, so no one piece is ever very big."""
+    if isinstance(obj, list):
+        pairs = False
+        items: Any = obj
+        yield "["
+    elif isinstance(obj, dict) and all(isinstance(k, str) for k in obj):
+        pairs = True
+        items = obj.items()
+        yield "{"
+    else:
+        yield json.dumps(obj)
+        return
+
+    batch: list = []
+    sep = ""
+
+    for x in items:
+        v = x[1] if pairs else x
+        if isinstance(v, (list, dict)) and (top or len(v) > split):
+            if batch:
+                yield sep + json.dumps(dict(batch) if pairs else batch)[1:-1]
+                sep = ", "
+                batch = []
+            yield sep + (json.dumps(x[0]) + ": " if pairs else "")
+            sep = ", "
+            yield from _json_chunks(v, split, False)
+        else:
+            batch.append(x)
+            if len(batch) >= split:
+                yield sep + json.dumps(dict(batch) if pairs else batch)[1:-1]
+                sep = ", "
+                batch = []
+
+    if batch:
+        yield sep + json.dumps(dict(batch) if pairs else batch)[1:-1]
+    yield "}" if pairs else "]"
+
+
+class Codec(NamedTuple):
+    """A file format, turning data into bytes and back.
+    If dump(data, f) is given, streaming saves use it to write to a binary file object
+    a piece at a time, otherwise they write what encode() returns."""
+
+    encode: Callable[[Any], bytes]
+    decode: Callable[[bytes], Any]
+    dump: Callable[[Any, Any], None] | None = None
+
+
+class Compressor(NamedTuple):
+    """A compression format.
+    writer(f, level) wraps a binary file object for writing, and closing it must finish the
+    compressed data without closing f. reader(f) wraps one for reading.
+    level is the default for saves that don't give one. decompress(bytes), if given,
+    is used instead of a reader for whole files, if the library has something faster."""
+
+    writer: Callable[[Any, Any], Any]
+    reader: Callable[[Any], Any]
+    level: Any = None
+    decompress: Callable[[bytes], bytes] | None = None
+
+
+# File extension, including the dot, to format.
+# Libraries for optional formats are only imported when a file of that type is used.
+codecs: dict[str, Codec] = {}
+compressors: dict[str, Compressor] = {}
+
+
+def register_codec(ext: str, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any], dump=None):
+    "Save and load files ending in ext, like '.json', with these functions. Replaces any existing codec for it."
+    codecs[ext] = Codec(encode, decode, dump)
+
+
+def register_compressor(ext: str, writer, reader, level=None, decompress=None):
+    "Compress files ending in ext, like '.gz'. They can then be used after any codec's extension, like data.json.gz"
+    compressors[ext] = Compressor(writer, reader, level, decompress)
+
+
+def _formats(fn: str) -> tuple[Codec, Compressor | None]:
+    "The codec and compressor, if any, for a file name"
+    base, ext = os.path.splitext(fn)
+    compressor = compressors.get(ext)
+    if compressor:
+        ext = os.path.splitext(base)[1]
+    codec = codecs.get(ext)
+    if codec is None:
+        raise ValueError("Unsupported or missing File Extension")
+    return codec, compressor
+
+
+def _level(compressor: Compressor, level):
+    return compressor.level if level is None else level
+
+
+def _compress(compressor: Compressor, data: bytes, level=None) -> bytes:
+    # Through the same writer as streaming saves, so both give exactly the same bytes
+    i = io.BytesIO()
+    with compressor.writer(i, _level(compressor, level)) as f:
+        f.write(data)
+    return i.getvalue()
+
+
+def _dump_text(chunks: Iterable[str], f):
+    text = _TextSink(f)
+    for i in chunks:
+        text.write(i)
+    text.finish()
+
+
+def _as_bytes(data) -> bytes | memoryview:
+    """Anything with the buffer protocol, like bytearray, memoryview, array.array or numpy arrays,
+    as something like bytes, without copying it unless it isn't all in one piece"""
+    if isinstance(data, bytes):
+        return data
+    view = memoryview(data)
+    if view.c_contiguous:
+        return view.cast("B")
+    return view.tobytes()
+
+
+def _dump_bin(data, f):
+    # Either anything with the buffer protocol, or an iterable of chunks of it
+    try:
+        data = _as_bytes(data)
+    except TypeError:
+        for i in data:
+            f.write(_as_bytes(i))
+    else:
+        f.write(data)
+
+
+def _yaml_dumper():
+    import yaml
+
+    # The libyaml versions are several times faster, and give the same results
+    return yaml, getattr(yaml, "CDumper", yaml.Dumper)
+
+
+def _yaml_encode(data) -> bytes:
+    yaml, dumper = _yaml_dumper()
+    return yaml.dump(data, Dumper=dumper).encode("utf8")
+
+
+def _yaml_dump(data, f):
+    yaml, dumper = _yaml_dumper()
+    text = _TextSink(f)
+    yaml.dump(data, text, Dumper=dumper)
+    text.finish()
+
+
+def _yaml_decode(raw: bytes):
+    import yaml
+
+    return yaml.load(raw.decode("utf8"), Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _toml_encode(data) -> bytes:
+    import toml
+
+    return toml.dumps(data).encode("utf8")
+
+
+def _toml_decode(raw: bytes):
+    import toml
+
+    return toml.loads(raw.decode("utf8"))
+
+
+def _msgpack_encode(data) -> bytes:
+    import msgpack
+
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _msgpack_decode(raw: bytes):
+    import msgpack
+
+    # Integer keys are fine in msgpack, even though they aren't in JSON
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def _cbor_encode(data) -> bytes:
+    import cbor2
+
+    return cbor2.dumps(data)
+
+
+def _cbor_dump(data, f):
+    import cbor2
+
+    cbor2.dump(data, f)
+
+
+def _cbor_decode(raw: bytes):
+    import cbor2
+
+    return cbor2.loads(raw)
+
+
+def _jsonl_chunks(data):
+    for i in data:
+        yield json.dumps(i) + "\n"
+
+
+register_codec(
+    ".json",
+    lambda data: json.dumps(data).encode("utf8"),
+    lambda raw: json.loads(raw.decode("utf8")),
+    lambda data, f: _dump_text(_json_chunks(data), f),
+)
+
+for _ext in (".jsonl", ".ndjson"):
+    # Any iterable of records, one per line
+    register_codec(
+        _ext,
+        lambda data: "".join(_jsonl_chunks(data)).encode("utf8"),
+        lambda raw: [json.loads(i) for i in raw.decode("utf8").splitlines() if i.strip()],
+        lambda data, f: _dump_text(_jsonl_chunks(data), f),
+    )
+
+for _ext in (".txt", ".md", ".rst"):
+    register_codec(
+        _ext,
+        lambda data: str(data).encode("utf8"),
+        lambda raw: raw.decode("utf8"),
+        lambda data, f: _dump_text([str(data)], f),
+    )
+
+register_codec(".yaml", _yaml_encode, _yaml_decode, _yaml_dump)
+register_codec(".toml", _toml_encode, _toml_decode)
+register_codec(".bin", _as_bytes, lambda raw: raw, _dump_bin)
+register_codec(".msgpack", _msgpack_encode, _msgpack_decode)
+register_codec(".cbor", _cbor_encode, _cbor_decode, _cbor_dump)
+
+
+def _zstd_writer(f, level):
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False)
+
+
+def _zstd_reader(f):
+    import zstandard
+
+    # Buffered so it can be read by line, and closing it doesn't close f
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f, closefd=False, read_across_frames=True))
+
+
+def _zstd_decompress(raw: bytes) -> bytes:
+    import zstandard
+
+    # Streamed frames don't record their size, which decompress() needs.
+    # Files can hold several frames one after another, like appended logs.
+    out = []
+    while raw:
+        d = zstandard.ZstdDecompressor().decompressobj()
+        out.append(d.decompress(raw))
+        raw = d.unused_data
+    return b"".join(out)
+
+
+def _lz4_writer(f, level):
+    import lz4.frame
+
+    return lz4.frame.LZ4FrameFile(f, mode="wb", compression_level=level)
+
+
+def _lz4_reader(f):
+    import lz4.frame
+
+    return lz4.frame.LZ4FrameFile(f, mode="rb")
+
+
+def _lz4_decompress(raw: bytes) -> bytes:
+    import lz4.frame
+
+    # Same as zstd, there may be several frames
+    out = []
+    while raw:
+        d = lz4.frame.LZ4FrameDecompressor()
+        out.append(d.decompress(raw))
+        raw = d.unused_data
+    return b"".join(out)
+
+
+register_compressor(
+    # No timestamp, so the same data always compresses to the same bytes, and unchanged saves can be skipped
+    ".gz",
+    lambda f, level: gzip.GzipFile(mode="wb", fileobj=f, mtime=0, compresslevel=level),
+    lambda f: gzip.GzipFile(mode="rb", fileobj=f),
+    9,
+    gzip.decompress,
+)
+register_compressor(
+    ".bz2",
+    lambda f, level: bz2.BZ2File(f, mode="wb", compresslevel=level),
+    lambda f: bz2.BZ2File(f, mode="rb"),
+    9,
+    bz2.decompress,
+)
+register_compressor(".zst", _zstd_writer, _zstd_reader, 3, _zstd_decompress)
+register_compressor(".lz4", _lz4_writer, _lz4_reader, 0, _lz4_decompress)
+
+
+def _encode_to(data, fn: str, out: _DigestWriter, level=None):
+    "Like _encode, but write incrementally through the compressor into out"
+    codec, compressor = _formats(fn)
+    layer = compressor.writer(out, _level(compressor, level)) if compressor else out
+
+    if codec.dump:
+        codec.dump(data, layer)
+    else:
+        layer.write(codec.encode(data))
+
+    # Closing the compressor writes its trailer, but doesn't close the file under it
+    if compressor:
+        layer.close()
+
+
+def _files_equal(a: str, b: str) -> bool:
+    "Compare two files a chunk at a time"
+    with open(a, "rb") as f1, open(b, "rb") as f2:
+        while True:
+            x = f1.read(1 << 20)
+            if not x == f2.read(1 << 20):
+                return False
+            if not x:
+                return True
+
+
+def _save_streaming(data, fn: str, private: bool, md5: bool, nolog: bool, level=None):
+    """Encode and compress straight into a temp file, so only a bounded amount is ever in memory,
+    then under the path lock, either rename it into place or throw it away if nothing changed."""
+    _prepare_dir(fn, private)
+
+    # Unique, since we write it without holding the lock
+    tempfn = fn + str(time.time()) + "-" + str(threading.get_ident())
+    try:
+        with open(tempfn, "wb") as f:
+            if private:
+                chmod_private_try(tempfn)
+            out = _DigestWriter(f, md5)
+            _encode_to(data, fn, out, level)
+            f.flush()
+            os.fsync(f.fileno())
+
+        digest = out.hash.digest()
+
+        with _path_lock(fn):
+            _drop_pending(fn)
+            if os.path.exists(fn):
+                st = os.stat(fn)
+                same = _cached_match(fn, st, digest)
+                if same is None:
+                    same = st.st_size == out.size and _files_equal(tempfn, fn)
+                if same:
+                    _remember_digest(fn, st, digest)
+                    return
+
+            if not nolog:
+                logging.debug("Writing: " + fn)
+            _forget_cached(fn)
+            os.replace(tempfn, fn)
+            _remember_digest(fn, os.stat(fn), digest)
+
+            if md5 and out.md5:
+                with open(fn + ".md5", "w") as md5f:
+                    md5f.write(out.md5.hexdigest())
+    finally:
+        if os.path.exists(tempfn):
+            os.remove(tempfn)
+
+
+def save(data, fn, *, private=False, backup=True, expand=True, md5=False, nolog=False, stream=False, level=None, deferred=False):
+    """Save data to file. Filename must end in .json, .yaml, .txt, .bin, or any other extension in codecs,
+    like .msgpack or .cbor. Data will be encoded appropriately.
+    Also supports compressed versions via filenames ending in .gz, .bz2, .zst, or .lz4.
+    Only one save or load of the same file runs at a time, but different files don't wait for each other,
+    and encoding happens before taking the file's lock.
     Args:
         data:
             the data to be written. if fn is a .json or .yaml, must be serializable. If filename is .txt, must be a string.
@@ -62,78 +599,55 @@ def save(data, fn, *, private=False, backup=True, expand=True, md5=False, nolog=
             If False(the default), file created with default mode
         backup:
             Setting this to true is an alias for mode="backup"
+        stream:
+            Encode and compress straight into a temp file as we go, instead of building the whole
+            file in memory first, so memory use doesn't grow with the data. Always writes a temp file
+            and renames it, even if backup is False. With .bin, data may also be an iterable of bytes chunks.
+        level:
+            Compression level, if compressed. Defaults to the compressor's level,
+            9 for .gz and .bz2, 3 for .zst and 0 for .lz4.
+        deferred:
+            Encode now, but write the file later, from a background thread, within flush_interval seconds.
+            Saving the same file again meanwhile replaces the waiting data, so it only gets written once.
+            load() sees the waiting data right away. Use flush() or flush_all() to write it sooner.
+            Anything still waiting is written at exit.
     """
     fn = resolve_path(fn, expand)
-    with lock:
-        # Make sure we don't overwrite a file when we create our dirs, because that behavior is undocumented in makedirs.
-        x = os.path.split(fn)[0]
-        already = {}
-
-        # Safety counter to stop really wierd loops
-        for i in range(64):
-            if os.path.isfile(x):
-                raise RuntimeError("Required intermediate directory is already present as a file, refusing to overwrite file")
-            x = os.path.split(x)[0]
-            # Loop prevention
-            if x in already:
-                break
-            already[x] = True
 
-        if not os.path.exists(os.path.dirname(fn)):
-            if private:
-                os.makedirs(os.path.dirname(fn), mode=0o700)
-            else:
-                os.makedirs(os.path.dirname(fn))
-
-        if os.path.isdir(fn):
-            raise RuntimeError("Filename is already present as a directory, refusing to overwrite directory")
-        # Get base type without compression
-        if fn.endswith(".gz"):
-            x = fn[:-3]
-        elif fn.endswith(".bz2"):
-            x = fn[:-4]
-        else:
-            x = fn
-        # Encode the data into our chosen format
-        if x.endswith(".json"):
-            data = json.dumps(data).encode("utf8")
-        elif x.endswith(".yaml"):
-            import yaml
+    if deferred and stream:
+        raise ValueError("Deferred saves can't be streamed")
 
-            data = yaml.dump(data).encode("utf8")
+    if stream:
+        _save_streaming(data, fn, private, md5, nolog, level)
+        return
 
-        elif x.endswith(".toml"):
-            import toml
+    # Do the slow part first, without holding anyone up
+    data = _encode(data, fn, level)
 
-            data = toml.dumps(data).encode("utf8")
+    if deferred:
+        # A .bin save may still be the caller's own buffer, which they could change before it gets written
+        _defer(fn, bytes(data), private, backup, md5, nolog)
+        return
 
-        elif x.endswith((".txt", ".md", ".rst")):
-            data = str(data).encode("utf8")
-        elif x.endswith(".bin"):
-            data = data
-        else:
-            raise ValueError("Unsupported or missing File Extension")
+    with _path_lock(fn):
+        # Anything deferred for this file is older than what we have now
+        _drop_pending(fn)
+        _write(data, fn, private, backup, md5, nolog)
 
-        # We have selected a compressed type. Compress in-memory first so we can read-before-write
-        # Note that disk access is slow enough the call to  basically makes no difference in speed here if it's already imported
-        if fn.endswith(".gz"):
-            i = strio()
-            f = gzip.GzipFile(fn, mode="wb", fileobj=i)
-            f.write(data)
-            f.close()
-            data = i.getvalue()
-
-        elif fn.endswith(".bz2"):
-            c = bz2.BZ2Compressor()
-            c.compress(data)
-            data = c.flush()
-            del c
-
-        # Do a read-before-write. We don't write if we don't have to
-        if os.path.exists(fn):
-            with open(fn, "rb") as f:
-                if f.read() == data:
-                    return
+
+def _write(data: bytes, fn: str, private: bool, backup: bool, md5: bool, nolog: bool):
+    "Write encoded data to the file, unless it's already there"
+    with _path_lock(fn):
+        _prepare_dir(fn, private)
+
+        # Writing in place would change what's mapped under someone, or crash them if it got shorter
+        if not backup and _is_mapped(fn):
+            backup = True
+
+        # We don't write if we don't have to
+        digest = _digest(data)
+        if _unchanged(fn, data, digest):
+            return
 
         ensure_dir(os.path.split(fn)[0])
 
@@ -144,6 +658,7 @@ def save(data, fn, *, private=False, backup=True, expand=True, md5=False, nolog=
 
         if not nolog:
             logging.debug("Writing: " + fn)
+        _forget_cached(fn)
         # Actually write it
         with open(tempfn, "wb") as f:
             # In backup mode, pre truncate and flush.
@@ -163,59 +678,869 @@ def save(data, fn, *, private=False, backup=True, expand=True, md5=False, nolog=
         if backup:
             os.replace(tempfn, fn)
 
+        _remember_digest(fn, os.stat(fn), digest)
+
         if md5:
             with open(fn + ".md5", "w") as md5f:
                 md5f.write(hashlib.md5(data).hexdigest())
 
 
-def load(filename, *, expand=True):
-    """Load a file. Return str if file extension is .txt, bytes on .bin, dict on .yaml or .json.
+# Deferred saves not written yet, by absolute path, as the encoded data and the rest of _write()'s arguments.
+# Saving again before they are written just replaces them, so they only get written once.
+_pending: dict[str, tuple[bytes, tuple[bool, bool, bool, bool]]] = {}
+_pending_lock = threading.Lock()
+_flush_timer: threading.Timer | None = None
+
+# How long deferred saves wait before being written, in seconds
+flush_interval = 5.0
+
+
+def _defer(fn: str, data: bytes, *args):
+    with _pending_lock:
+        _pending[os.path.abspath(fn)] = (data, args)
+        _schedule_flush()
+
+
+def _schedule_flush():
+    "Needs to be called under _pending_lock. The timer only exists while something is waiting."
+    global _flush_timer
+    if _pending and _flush_timer is None:
+        _flush_timer = threading.Timer(flush_interval, _flush_later)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+    elif not _pending and _flush_timer is not None:
+        _flush_timer.cancel()
+        _flush_timer = None
+
+
+def _flush_later():
+    global _flush_timer
+    try:
+        flush_all()
+    except Exception:
+        logging.exception("Error writing deferred saves, will retry")
+
+    with _pending_lock:
+        # Anything that failed, or was saved while we were writing, gets another go later
+        if _flush_timer is threading.current_thread():
+            _flush_timer = None
+        _schedule_flush()
+
+
+def _drop_pending(fn: str):
+    with _pending_lock:
+        _pending.pop(os.path.abspath(fn), None)
+        _schedule_flush()
 
-    After that may be a .bz2 or a .gz for compression.
 
+def _pending_data(fn: str) -> bytes | None:
+    "What a deferred save will write to the file, if there is one waiting"
+    with _pending_lock:
+        item = _pending.get(os.path.abspath(fn))
+    return item[0] if item else None
+
+
+def flush(fn, *, expand=True):
+    "Write a deferred save of the file right now, if there is one waiting"
+    fn = resolve_path(fn, expand)
+    key = os.path.abspath(fn)
+
+    # Taken and written under the path lock, so a normal save can't get in between and be overwritten by older data
+    with _path_lock(fn):
+        with _pending_lock:
+            item = _pending.pop(key, None)
+            _schedule_flush()
+        if item is None:
+            return
+        try:
+            _write(item[0], fn, *item[1])
+        except Exception:
+            # Try again later, unless there's something newer by now
+            with _pending_lock:
+                _pending.setdefault(key, item)
+                _schedule_flush()
+            raise
+
+
+def flush_all():
+    """Write all deferred saves right now. Also runs at exit.
+    If any fail, the rest still get written, then the first error is raised."""
+    with _pending_lock:
+        paths = list(_pending)
+
+    error = None
+    for fn in paths:
+        try:
+            flush(fn, expand=False)
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+
+
+atexit.register(flush_all)
+
+
+def _decode(raw: bytes, filename: str):
+    "Decompress and decode the raw contents of a file according to its extension"
+    codec, compressor = _formats(filename)
+    if compressor:
+        if compressor.decompress:
+            raw = compressor.decompress(raw)
+        else:
+            with compressor.reader(io.BytesIO(raw)) as f:
+                raw = f.read()
+    return codec.decode(raw)
+
+
+# Maps from open_buffer(), by absolute path
+_mapped: dict[str, list[weakref.ref]] = {}
+_mapped_lock = threading.Lock()
+
+
+def _is_mapped(fn: str) -> bool:
+    with _mapped_lock:
+        refs = [i for i in _mapped.get(os.path.abspath(fn), []) if i() is not None]
+        if refs:
+            _mapped[os.path.abspath(fn)] = refs
+        else:
+            _mapped.pop(os.path.abspath(fn), None)
+        return bool(refs)
+
+
+def open_buffer(filename, *, expand=True) -> memoryview:
+    """Map an uncompressed .bin file into memory, and return a read only memoryview of it, without reading it.
+    Pages are read from disk as they are used, and slicing doesn't copy anything.
+    The map stays open for as long as the view, or anything sliced from it, is around.
+
+    It keeps showing the file as it was when mapped. Saves replace the file by renaming a new one over it,
+    even with backup=False while a map of it is open.
     """
     filename = resolve_path(filename, expand)
+    if not filename.endswith(".bin"):
+        raise ValueError("Only uncompressed .bin files can be mapped")
+
+    raw = _pending_data(filename)
+    if raw is not None:
+        return memoryview(raw)
+
+    with _path_lock(filename):
+        with open(filename, "rb") as f:
+            # Empty files can't be mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with _mapped_lock:
+            _mapped.setdefault(os.path.abspath(filename), []).append(weakref.ref(m))
+
+    return memoryview(m)
+
+
+# Loaded values for load(cache=True), by absolute path, with the file's stat signature when it was read.
+# Kept pickled, so every load gets its own copy that it can change without affecting anyone else.
+# Oldest first, and used entries move to the end.
+_read_cache: dict[str, tuple[tuple[int, int, int, int], Any, bool]] = {}
+_read_cache_bytes = 0
+_read_cache_lock = threading.Lock()
+
+# Most bytes of pickled values to keep in the read cache
+read_cache_size = 64 * 1024 * 1024
+
 
-    with lock:
+def _cache_get(fn: str, st: os.stat_result) -> tuple[bool, Any]:
+    "Returns (True, value) if the cache holds what's in the file now"
+    key = os.path.abspath(fn)
+    with _read_cache_lock:
+        item = _read_cache.pop(key, None)
+        if item is None:
+            return False, None
+        if not item[0] == _stat_signature(st):
+            _drop_cached(item)
+            return False, None
+        _read_cache[key] = item
+
+    return True, pickle.loads(item[1]) if item[2] else item[1]
+
+
+def _cache_put(fn: str, st: os.stat_result, value: Any):
+    global _read_cache_bytes
+    # Strings and bytes can't be changed, so they don't need copying
+    pickled = not isinstance(value, (str, bytes))
+    if not pickled:
+        blob = value
+    else:
         try:
-            # Open the file and get the filename without the compression type attached to it.
-            if filename.endswith(".gz"):
-                f = gzip.GzipFile(filename, mode="rb")
-                x = filename[:-3]
-            elif filename.endswith(".bz2"):
-                x = filename[:-4]
-                f = bz2.BZ2File(filename, mode="rb")
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+    if len(blob) > read_cache_size:
+        return
+
+    key = os.path.abspath(fn)
+    with _read_cache_lock:
+        old = _read_cache.pop(key, None)
+        if old:
+            _drop_cached(old)
+        while _read_cache and _read_cache_bytes + len(blob) > read_cache_size:
+            _drop_cached(_read_cache.pop(next(iter(_read_cache))))
+        _read_cache[key] = (_stat_signature(st), blob, pickled)
+        _read_cache_bytes += len(blob)
+
+
+def _drop_cached(item: tuple[Any, Any, bool]):
+    "Needs to be called under _read_cache_lock, after removing item from the cache"
+    global _read_cache_bytes
+    _read_cache_bytes -= len(item[1])
+
+
+def _forget_cached(fn: str):
+    "Called whenever we write a file, in case the stat signature doesn't change enough to tell"
+    with _read_cache_lock:
+        item = _read_cache.pop(os.path.abspath(fn), None)
+        if item:
+            _drop_cached(item)
+
+
+def clear_read_cache():
+    "Forget everything in the read cache"
+    global _read_cache_bytes
+    with _read_cache_lock:
+        _read_cache.clear()
+        _read_cache_bytes = 0
+
+
+def load(filename, *, expand=True, cache=False, mmap=False):
+    """Load a file. Return str if file extension is .txt, bytes on .bin, dict on .yaml or .json,
+    list of records on .jsonl or .ndjson.
+
+    Also .msgpack, .cbor, or anything else in codecs.
+    After that may be a .bz2, .gz, .zst, or .lz4 for compression.
+
+    Only reading the file happens under the file's lock, decompressing and decoding happen after.
+
+    With cache=True, keep what was loaded, and next time, if the file's mtime, size and inode haven't changed,
+    return a copy of it without reading the file again. Copies are independent, so changing one is safe.
+    Saving a file through here always invalidates it. At most read_cache_size bytes are kept,
+    least recently used first to go.
+
+    With mmap=True, an uncompressed .bin file is mapped instead of read, see open_buffer().
+    """
+    filename = resolve_path(filename, expand)
+    if mmap:
+        return open_buffer(filename, expand=False)
+
+    # A deferred save that hasn't been written yet is what the file is about to hold
+    raw = _pending_data(filename)
+    if raw is not None:
+        return _decode(raw, filename)
+
+    if cache:
+        try:
+            hit, value = _cache_get(filename, os.stat(filename))
+            if hit:
+                return value
+        except FileNotFoundError:
+            pass
+
+    with _path_lock(filename):
+        with open(filename, "rb") as f:
+            st = os.fstat(f.fileno())
+            raw = f.read()
+
+    value = _decode(raw, filename)
+    if cache:
+        _cache_put(filename, st, value)
+    return value
+
+
+@contextlib.contextmanager
+def _open_raw(filename: str):
+    """Open a file for reading in binary, decompressing as we go if needed.
+    Only the open happens under the path lock. Files are replaced by renaming,
+    so we keep reading the version we opened even if someone saves over it meanwhile."""
+    raw = _pending_data(filename)
+    with _path_lock(filename):
+        f = open(filename, "rb") if raw is None else io.BytesIO(raw)
+    with f:
+        compressor = compressors.get(os.path.splitext(filename)[1])
+        if compressor is None:
+            yield f
+        else:
+            with compressor.reader(f) as r:
+                yield r
+
+
+def _strip_compression(filename: str) -> str:
+    base, ext = os.path.splitext(filename)
+    return base if ext in compressors else filename
+
+
+def iter_load(filename, *, expand=True) -> Iterator[Any]:
+    """Iterate over the records in a .jsonl or .ndjson file, optionally compressed,
+    one line at a time, without loading the whole file. Blank lines are skipped."""
+    filename = resolve_path(filename, expand)
+    if not _strip_compression(filename).endswith((".jsonl", ".ndjson")):
+        raise ValueError("iter_load only supports .jsonl and .ndjson files")
+
+    with _open_raw(filename) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class _JsonScanner:
+    """Finds the extent of JSON values in a binary stream without decoding them,
+    reading as little as needed and only keeping what is still being looked at in memory."""
+
+    @staticmethod
+    def _nested(depth: int) -> bytes:
+        "Pattern for plain text, strings, and whole bracketed values nested up to depth levels"
+        item = rb'[^"\[\]{}]++|"(?:[^"\\]++|\\.)*+"'
+        for _ in range(depth):
+            item = rb"[^\"\[\]{}]++|\"(?:[^\"\\]++|\\.)*+\"|[\[{](?:" + item + rb")*+[\]}]"
+        return rb"(?:" + item + rb")*+"
+
+    # Everything up to the next bracket that doesn't close within what we've read, or the
+    # quote of a string that isn't all there yet. Possessive, so a cut off value can't backtrack.
+    run = re.compile(_nested(8), re.S)
+
+    scalar = re.compile(rb"[^,}\]\s]*+")
+    space = re.compile(rb"\s*+")
+    # Inside a string, up to the closing quote or an escape
+    chars = re.compile(rb'[^"\\]*+')
+
+    def __init__(self, f, chunk_size: int = 1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False
+        # Start of a value we are keeping, which must not be thrown away
+        self.mark: int | None = None
+
+    def fill(self):
+        # Throw away everything already dealt with
+        keep = self.pos if self.mark is None else self.mark
+        del self.buf[:keep]
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark -= keep
+
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf += data
+
+    def span(self, pattern: re.Pattern) -> int:
+        """End of the run of characters matching pattern at pos, reading more if it reaches the end of what we have.
+        Carries on from where it got to after each read, so a long run is only scanned once."""
+        i = self.pos
+        while True:
+            i = pattern.match(self.buf, i).end()
+            if i < len(self.buf) or self.eof:
+                return i
+            # fill() moves everything down by what it throws away, but never past pos
+            offset = i - self.pos
+            self.fill()
+            i = self.pos + offset
+
+    def peek(self) -> int:
+        "Skip whitespace and return the next byte, or -1 at the end"
+        self.pos = self.span(self.space)
+        return self.buf[self.pos] if self.pos < len(self.buf) else -1
+
+    def expect(self, c: bytes):
+        if not self.peek() == c[0]:
+            raise ValueError(f"Expected {c!r} near {bytes(self.buf[self.pos : self.pos + 20])!r}")
+        self.pos += 1
+
+    def key(self) -> str:
+        if not self.peek() == ord('"'):
+            raise ValueError(f"Expected a key near {bytes(self.buf[self.pos : self.pos + 20])!r}")
+        self.mark = self.pos
+        try:
+            self.skip_string()
+            return json.loads(bytes(self.buf[self.mark : self.pos]))
+        finally:
+            self.mark = None
+
+    def skip_string(self):
+        "Move past the string whose opening quote is at pos"
+        # Like span(), keeps its place across reads, so a huge string is only scanned once
+        i = self.pos + 1
+        while True:
+            i = self.chars.match(self.buf, i).end()
+            if i < len(self.buf):
+                if self.buf[i] == ord('"'):
+                    self.pos = i + 1
+                    return
+                # A backslash, skip what it escapes if we have it yet
+                if i + 1 < len(self.buf):
+                    i += 2
+                    continue
+            if self.eof:
+                raise ValueError("Unterminated string in JSON")
+            offset = i - self.pos
+            self.fill()
+            i = self.pos + offset
+
+    def skip_value(self):
+        "Move past the value at pos, without decoding it"
+        c = self.peek()
+        if c == ord('"'):
+            self.skip_string()
+        elif c in b"[{":
+            self.pos += 1
+            depth = 1
+            while depth:
+                # Whole nested values are consumed here, only ones cut off by the
+                # end of the buffer or nested too deep come back to this loop.
+                self.pos = self.run.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf):
+                    if self.eof:
+                        raise ValueError("Unexpected end of JSON")
+                    self.fill()
+                    continue
+                c = self.buf[self.pos]
+                if c in b"[{":
+                    depth += 1
+                elif c in b"]}":
+                    depth -= 1
+                else:
+                    # A string that isn't all there yet
+                    self.skip_string()
+                    continue
+                self.pos += 1
+        else:
+            end = self.span(self.scalar)
+            if end == self.pos:
+                raise ValueError(f"Invalid JSON near {bytes(self.buf[self.pos : self.pos + 20])!r}")
+            self.pos = end
+
+    def value(self) -> Any:
+        "Decode the value at pos"
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return json.loads(bytes(self.buf[self.mark : self.pos]))
+        finally:
+            self.mark = None
+
+
+def load_keys(filename, keys: Iterable[str], *, expand=True) -> dict[str, Any]:
+    """Load only the given top level keys of a .json file, optionally compressed,
+    reading it as a stream. Everything else is skipped over without being decoded,
+    and reading stops as soon as all the keys have been found.
+    Keys that aren't in the file are left out of the result."""
+    filename = resolve_path(filename, expand)
+    if not _strip_compression(filename).endswith(".json"):
+        raise ValueError("load_keys only supports .json files")
+
+    wanted = set(keys)
+    r: dict[str, Any] = {}
+
+    with _open_raw(filename) as f:
+        scanner = _JsonScanner(f)
+        scanner.expect(b"{")
+        if scanner.peek() == ord("}"):
+            return r
+
+        while wanted:
+            scanner.peek()
+            k = scanner.key()
+            scanner.expect(b":")
+            if k in wanted:
+                r[k] = scanner.value()
+                # Later duplicates win in json.loads, but we stop at the first
+                wanted.discard(k)
             else:
-                f = open(filename, "rb")
-                x = filename
+                scanner.skip_value()
+
+            c = scanner.peek()
+            if c == ord("}"):
+                break
+            scanner.expect(b",")
+
+    return r
+
+
+def _fsync_dir(d: str):
+    "Make renames and new files in a directory durable. Not possible everywhere, so it's best effort."
+    try:
+        fd = os.open(d or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Journals with changes that may not be written yet, to commit at exit
+# Mappings aren't hashable, so these are by id.
+_journals: "weakref.WeakValueDictionary[int, Journal]" = weakref.WeakValueDictionary()
+
+
+@atexit.register
+def _commit_journals():
+    for j in list(_journals.values()):
+        j.commit()
+
+
+class Journal(MutableMapping):
+    """A dict of JSON values, stored as a snapshot file plus a log of changes made since.
+
+    Setting or deleting a key appends one line to the log, so it costs about the size of the change,
+    not the size of everything. Once the log is bigger than compact_size and the last snapshot,
+    a new log is started and a new snapshot is written in the background, then the old logs are deleted.
+    Opening one reads the snapshot and replays the logs after it, ignoring a partly written last record.
 
-            if x.endswith(".json"):
-                r = json.loads(f.read().decode("utf8"))
-            elif x.endswith(".yaml"):
-                import yaml
+    fn must be a .json file, and may be compressed, like state.json.gz, in which case logs are too.
+    Logs are next to it, named like state.json.12.jsonl.gz.
 
-                r = yaml.load(f.read().decode("utf8"), Loader=yaml.SafeLoader)
+    With sync=True, setting something returns once it is on disk. Writers at the same time share one fsync.
+    With sync=False, changes are written within commit_interval seconds, or by commit(), close(), or at exit.
 
-            elif x.endswith(".toml"):
-                import toml
+    Values are stored as JSON, and reading one decodes a new copy, so changing it doesn't change the journal.
+    """
+
+    def __init__(
+        self, fn, *, sync: bool = True, commit_interval: float = 1.0, compact_size: int = 4 * 1024 * 1024, private=False, expand=True
+    ):
+        fn = resolve_path(fn, expand)
+        self.fn = os.path.abspath(fn)
+        base = _strip_compression(self.fn)
+        if not base.endswith(".json"):
+            raise ValueError("Journal files must be .json, optionally compressed")
+        self._compressor = compressors.get(self.fn[len(base) :])
+        self._log_prefix = base + "."
+        self._log_suffix = ".jsonl" + self.fn[len(base) :]
+
+        self.sync = sync
+        self.commit_interval = commit_interval
+        self.compact_size = compact_size
+        self.private = private
+
+        # Key to its value as JSON text
+        self._data: dict[str, str] = {}
+        # Log lines not written yet, and how many changes there have been, and have been written
+        self._buffer: list[str] = []
+        self._seq = 0
+        self._synced = 0
+
+        # Changes and the buffer. Writing the log takes _io_lock first, and never the other way around.
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        self._compacting: threading.Thread | None = None
+        self._closed = False
+        # Bytes of log since the last snapshot, and of the snapshot, to know when to compact
+        self._log_size = 0
+        self._snapshot_size = 0
+
+        _prepare_dir(self.fn, private)
+        generation = self._recover()
+
+        self._generation = generation
+        self._log = self._open_log(generation)
+        _journals[id(self)] = self
+
+    def __repr__(self) -> str:
+        return f"<Journal {self.fn}, {len(self._data)} keys>"
+
+    def _log_name(self, generation: int) -> str:
+        return f"{self._log_prefix}{generation}{self._log_suffix}"
+
+    def _logs(self) -> dict[int, str]:
+        "Generation numbers of the log files on disk"
+        d, prefix = os.path.split(self._log_prefix)
+        r = {}
+        for i in os.listdir(d):
+            if i.startswith(prefix) and i.endswith(self._log_suffix):
+                g = i[len(prefix) : -len(self._log_suffix)]
+                if g.isdigit():
+                    r[int(g)] = os.path.join(d, i)
+        return r
 
-                r = toml.loads(f.read().decode("utf8"))
+    def _open_log(self, generation: int):
+        f = open(self._log_name(generation), "ab")
+        if self.private:
+            chmod_private_try(self._log_name(generation), execute=False)
+        return f
 
-            elif x.endswith((".txt", ".md", ".rst")):
-                r = f.read().decode("utf8")
-            elif x.endswith(".bin"):
-                r = f.read()
+    def _recover(self) -> int:
+        "Load the snapshot and replay the logs after it. Returns the generation to write next."
+        first = 0
+        if os.path.exists(self.fn):
+            snapshot = load(self.fn, expand=False)
+            first = snapshot["generation"]
+            self._data = {k: json.dumps(v) for k, v in snapshot["data"].items()}
+            self._snapshot_size = os.path.getsize(self.fn)
+
+        logs = self._logs()
+        for g in sorted(logs):
+            if g < first:
+                # Already in the snapshot, left over from a compaction that didn't finish cleaning up
+                os.remove(logs[g])
             else:
-                raise ValueError("Unsupported File Extension")
-        except Exception as e:
+                self._replay(logs[g])
+                self._log_size += os.path.getsize(logs[g])
+
+        # Never append to an old log, the end of it may be a partly written record
+        return max([first, *(g + 1 for g in logs)])
+
+    def _replay(self, fn: str):
+        f = open(fn, "rb")
+        with f:
+            if self._compressor:
+                f = self._compressor.reader(f)
             try:
-                f.close()
-            except Exception:
-                pass
-            raise
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    record = json.loads(line)
+                    if "v" in record:
+                        self._data[record["k"]] = json.dumps(record["v"])
+                    else:
+                        self._data.pop(record["k"], None)
+            except (EOFError, ValueError):
+                # The last write was cut off, so it never returned, and nobody was told it was saved
+                logging.warning(f"Ignoring partly written end of journal log {fn}")
+
+    def __getitem__(self, key: str) -> Any:
+        return json.loads(self._data[key])
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._data))
+
+    def __setitem__(self, key: str, value: Any):
+        self.update({key: value})
+
+    def __delitem__(self, key: str):
+        with self._lock:
+            if key not in self._data:
+                raise KeyError(key)
+            del self._data[key]
+            seq = self._append(json.dumps({"k": key}) + "\n")
+        self._after_write(seq)
+
+    def update(self, other=(), /, **kwargs):
+        "Set many keys, as one write to the log"
+        items = dict(other, **kwargs)
+        for k in items:
+            if not isinstance(k, str):
+                raise TypeError("Journal keys must be strings")
+
+        # Encode before taking the lock
+        encoded = [(k, json.dumps(k), json.dumps(v)) for k, v in items.items()]
+        lines = "".join(f'{{"k": {k}, "v": {v}}}\n' for _, k, v in encoded)
+        if not lines:
+            return
+
+        with self._lock:
+            for k, _, v in encoded:
+                self._data[k] = v
+            seq = self._append(lines)
+        self._after_write(seq)
+
+    def _append(self, lines: str) -> int:
+        "Needs to be called under _lock"
+        if self._closed:
+            raise RuntimeError("Journal is closed")
+        self._buffer.append(lines)
+        self._seq += 1
+        return self._seq
+
+    def _after_write(self, seq: int):
+        if self.sync:
+            self.commit(seq)
+        else:
+            with self._lock:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.commit_interval, self._commit_later)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if self._log_size > max(self.compact_size, self._snapshot_size) and self._compacting is None:
+            self.compact()
+
+    def _commit_later(self):
+        with self._lock:
+            self._timer = None
         try:
-            f.close()
+            self.commit()
         except Exception:
-            pass
+            logging.exception(f"Error writing journal {self.fn}")
 
-        return r
+    def commit(self, seq: int | None = None):
+        """Write and fsync everything changed so far, or up to seq.
+        Anyone who comes along while a commit is in progress waits for it,
+        then the next one writes everything they all changed, with one fsync."""
+        with self._io_lock:
+            self._commit_locked(seq)
+
+    def _commit_locked(self, seq: int | None = None):
+        "Needs to be called under _io_lock"
+        with self._lock:
+            if seq is not None and self._synced >= seq:
+                return
+            lines, self._buffer = self._buffer, []
+            end = self._seq
+        if lines:
+            data = "".join(lines).encode("utf8")
+            if self._compressor:
+                # Each commit is a complete compressed stream, and they can be read one after another
+                data = _compress(self._compressor, data)
+            self._log.write(data)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log_size += len(data)
+        with self._lock:
+            self._synced = end
+
+    def compact(self, wait: bool = False):
+        """Start a new log, and write everything up to now as a new snapshot in the background.
+        Then delete the old logs. With wait, return once done."""
+        with self._io_lock:
+            if self._compacting is not None:
+                thread = self._compacting
+            else:
+                # Whatever was changed before now goes in the old log, and in the snapshot
+                self._commit_locked()
+                with self._lock:
+                    data = dict(self._data)
+                self._log.close()
+                self._generation += 1
+                self._log = self._open_log(self._generation)
+                self._log_size = 0
+
+                thread = threading.Thread(target=self._write_snapshot, args=(data, self._generation), daemon=True)
+                self._compacting = thread
+                thread.start()
+        if wait:
+            thread.join()
+
+    def _write_snapshot(self, data: dict[str, str], generation: int):
+        try:
+            # The values are already JSON
+            text = f'{{"generation": {generation}, "data": {{' + ", ".join(f"{json.dumps(k)}: {v}" for k, v in data.items()) + "}}"
+            raw = text.encode("utf8")
+            if self._compressor:
+                raw = _compress(self._compressor, raw)
+            _write(raw, self.fn, self.private, True, False, True)
+            self._snapshot_size = len(raw)
+            # The rename must be on disk before the logs it replaces are gone
+            _fsync_dir(os.path.dirname(self.fn))
+
+            for g, fn in self._logs().items():
+                if g < generation:
+                    os.remove(fn)
+        except Exception:
+            logging.exception(f"Error compacting journal {self.fn}, will retry")
+        finally:
+            self._compacting = None
+
+    def close(self):
+        "Write everything, wait for any compaction, and close the log"
+        if self._closed:
+            return
+        self.commit()
+        thread = self._compacting
+        if thread:
+            thread.join()
+        with self._io_lock:
+            with self._lock:
+                self._closed = True
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+            self._log.close()
+        _journals.pop(id(self), None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Async saves and loads waiting to run, by absolute path, as (function, future, run even if cancelled).
+# A path is in here while a worker is running its jobs, one at a time, in the order they were called.
+_io_queues: dict[str, collections.deque[tuple[Callable[[], Any], concurrent.futures.Future, bool]]] = {}
+_io_queues_lock = threading.Lock()
+_io_pool: concurrent.futures.ThreadPoolExecutor | None = None
+
+# Most threads doing async saves and loads at once. Set before the first one.
+io_workers = 4
+
+
+def _io_submit(fn: str, job: Callable[[], Any], always: bool) -> asyncio.Future:
+    global _io_pool
+    # Before anything else, so nothing is queued if there's no loop to get the result
+    loop = asyncio.get_running_loop()
+    f: concurrent.futures.Future = concurrent.futures.Future()
+    key = os.path.abspath(fn)
+
+    with _io_queues_lock:
+        if _io_pool is None:
+            _io_pool = concurrent.futures.ThreadPoolExecutor(io_workers, thread_name_prefix="persist-io")
+
+        if key in _io_queues:
+            # The worker already running this path's jobs will get to it
+            _io_queues[key].append((job, f, always))
+        else:
+            _io_queues[key] = collections.deque([(job, f, always)])
+            _io_pool.submit(_io_run, key)
+
+    return asyncio.wrap_future(f, loop=loop)
+
+
+def _io_run(key: str):
+    "Run a path's queued jobs until there are none left"
+    while True:
+        with _io_queues_lock:
+            q = _io_queues[key]
+            if not q:
+                del _io_queues[key]
+                return
+            job, f, always = q.popleft()
+
+        if f.cancelled() and not always:
+            continue
+        try:
+            r = job()
+        except BaseException as e:
+            with contextlib.suppress(concurrent.futures.InvalidStateError):
+                f.set_exception(e)
+        else:
+            with contextlib.suppress(concurrent.futures.InvalidStateError):
+                f.set_result(r)
+
+
+def asave(data, fn, **kwargs) -> Awaitable[None]:
+    """Like save(), with the same arguments, but encodes and writes in a background thread,
+    without blocking the event loop. Must be called from a running event loop.
+
+    Saves and loads of the same file through here run one at a time in the order they were called,
+    not the order they were awaited. It is queued right away, and runs even if never awaited, or cancelled.
+    Don't change data until it's done, since it isn't encoded until then.
+    """
+    fn = resolve_path(fn, kwargs.pop("expand", True))
+    return _io_submit(fn, functools.partial(save, data, fn, expand=False, **kwargs), True)
+
+
+def aload(filename, **kwargs) -> Awaitable[Any]:
+    """Like load(), with the same arguments, but reads and decodes in a background thread.
+    Runs after any asave() of the same file called before it. Must be called from a running event loop."""
+    filename = resolve_path(filename, kwargs.pop("expand", True))
+    return _io_submit(filename, functools.partial(load, filename, expand=False, **kwargs), False)
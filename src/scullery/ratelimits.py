@@ -1,6 +1,6 @@
 """Module for managing rate limits."""
 
-import time
+from scullery import clocks
 
 
 class RateLimiter:
@@ -9,10 +9,12 @@ class RateLimiter:
     "credits" for fast bursts.
     """
 
-    def __init__(self, hz: float, burst: float = 250) -> None:
+    def __init__(self, hz: float, burst: float = 250, clock: clocks.Clock | None = None) -> None:
         """The rate limiter will begin with accum_limit credits and
         cannot go above that.  rate is in number of credits added per second.
+        clock defaults to the system clock.
         """
+        self.clock = clock or clocks.system_clock
         self.rate = hz
         # The max number of credits we can accumulate
         self.accum_limit = burst
@@ -21,7 +23,7 @@ class RateLimiter:
 
         # The last time we were called
         # and calculated credits
-        self.timestamp = time.monotonic()
+        self.timestamp = self.clock.monotonic()
 
     def limit(self) -> float:
         """If it hasn't been called too often, subtract one
@@ -29,13 +31,13 @@ class RateLimiter:
 
         Credits refill at "rate" per second up to a max of accum_limit
         """
-        elapsed = time.monotonic() - self.timestamp
+        elapsed = self.clock.monotonic() - self.timestamp
 
         # Monotonic can go backwards with time travel testing
         elapsed = max(0.0, elapsed)
         self.current_limit += self.rate * elapsed
         self.current_limit = min(self.current_limit, self.accum_limit)
-        self.timestamp = time.monotonic()
+        self.timestamp = self.clock.monotonic()
         if self.current_limit >= 1:
             self.current_limit -= 1
             return self.current_limit
@@ -5,6 +5,11 @@
 Wraps the very simple scheduling module in a way that supports
 repeating events, error reporting, and weakref-based cleanup.
 
+Internally everything runs on the monotonic clock, so stepping the
+wall clock doesn't cause a burst of "overdue" repeating events or a stall.
+Events scheduled for a specific wall clock time are tracked separately,
+and get moved if the scheduler notices that the wall clock jumped.
+
 Note that weakref cleanup is never a good idea to
 rely on for correctness, it's just a tool to manage resources.
 
@@ -55,6 +60,8 @@ time.sleep(3)
 ```
 """
 
+from __future__ import annotations
+
 import threading
 import sys
 import time
@@ -62,10 +69,14 @@ import sched
 import traceback
 import logging
 import types
+import bisect
+import heapq
+import asyncio
+import inspect
 from typing import Any, overload
 from collections.abc import Callable
 
-from scullery import workers, util
+from scullery import workers, util, clocks
 
 
 logger = logging.getLogger("system.scheduling")
@@ -86,10 +97,97 @@ def handle_first_error(f: Callable):
 enumerate = enumerate
 
 
+# Upper edges in seconds of the fire lateness histogram buckets.
+# There is one more bucket at the end for anything later than the last.
+lateness_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class EventStats:
+    "Counters for one event, or for everything in a scheduler"
+
+    __slots__ = (
+        "name",
+        "runs",
+        "skipped",
+        "overruns",
+        "recoveries",
+        "errors",
+        "total_duration",
+        "max_duration",
+        "last_duration",
+        "total_lateness",
+        "max_lateness",
+        "lateness_histogram",
+    )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.runs = 0
+        # Runs that were dropped because they came too soon after the last one
+        self.skipped = 0
+        # Runs that took longer than the repeat interval
+        self.overruns = 0
+        # Times error recovery had to reschedule the event
+        self.recoveries = 0
+        self.errors = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.last_duration = 0.0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.lateness_histogram = [0] * (len(lateness_buckets) + 1)
+
+    def record_run(self, lateness: float, duration: float, interval: float | None = None):
+        self.runs += 1
+        self.total_duration += duration
+        self.last_duration = duration
+        if duration > self.max_duration:
+            self.max_duration = duration
+        if interval and duration > interval:
+            self.overruns += 1
+
+        lateness = max(lateness, 0.0)
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        self.lateness_histogram[bisect.bisect_left(lateness_buckets, lateness)] += 1
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "overruns": self.overruns,
+            "recoveries": self.recoveries,
+            "errors": self.errors,
+            "total_duration": self.total_duration,
+            "max_duration": self.max_duration,
+            "last_duration": self.last_duration,
+            "avg_duration": self.total_duration / self.runs if self.runs else 0.0,
+            "max_lateness": self.max_lateness,
+            "avg_lateness": self.total_lateness / self.runs if self.runs else 0.0,
+            "lateness_buckets": list(lateness_buckets),
+            "lateness_histogram": list(self.lateness_histogram),
+        }
+
+
 class BaseEvent:
-    def __init__(self):
+    # If true, self.wall_time is a time.time() style timestamp that must be
+    # converted to the monotonic queue time whenever we insert.
+    wall_clock = False
+
+    def __init__(self, scheduler: NewScheduler | None = None):
         self.exact = 0
         self.schedID = None
+        # When to run, on the scheduler's monotonic clock
+        self.time = 0.0
+        # Default to the global scheduler, which is defined at the bottom of this module
+        self.scheduler: NewScheduler = scheduler or globals()["scheduler"]
+        self.fstr = ""
+        self.stats = EventStats(self.fstr)
 
 
 # Event API(not public):
@@ -107,29 +205,46 @@ class BaseEvent:
 class Event(BaseEvent):
     "Does function at time provided there is a strong referemce to f still by then"
 
-    def __init__(self, function: Callable[[], Any], time: float):
+    def __init__(
+        self,
+        function: Callable[[], Any],
+        time: float,
+        scheduler: NewScheduler | None = None,
+        wall_clock: bool = True,
+    ):
         """_summary_
 
         Args:
             function (Callable[[],Any]): The function to call
             time (float): The time.time() at which to schedule.
+            scheduler (NewScheduler, optional): Defaults to the global scheduler
+            wall_clock (bool, optional): If False, time is on the scheduler's monotonic clock instead,
+                and is not affected by wall clock jumps.
         """
-        BaseEvent.__init__(self)
+        BaseEvent.__init__(self, scheduler)
         self.f = util.universal_weakref(function)
         self.fstr = str(function)
-        self.time = time
+        self.stats.name = self.fstr
+        self.wall_clock = wall_clock
+        if wall_clock:
+            self.wall_time = time
+        else:
+            self.time = time
         self.errored = False
         self.stopped = False
 
     def schedule(self):
-        scheduler._insert(self)
+        self.scheduler._insert(self)
 
     def run(self):
-        workers.do(self._run)
+        self.scheduler._wall_events.discard(self)
+        self.scheduler.do(self._run)
 
     def _run(self):
         if self.stopped:
             return
+        lateness = self.scheduler.clock.monotonic() - self.time
+        start = time.perf_counter()
         try:
             f = self.f()
             if not f:
@@ -138,14 +253,16 @@ class Event(BaseEvent):
             else:
                 f()
         except Exception:
+            self.scheduler._record_error(self)
             if f:
                 for i in function_error_hooks:
                     i(f)
         finally:
             del f
+            self.scheduler._record_run(self, lateness, time.perf_counter() - start)
 
     def _unregister(self):
-        scheduler.remove(self)
+        self.scheduler.remove(self)
 
     # We want to use the worker pool to unregister so
     # that we know which thread the scheduler.unregister call is
@@ -154,7 +271,7 @@ class Event(BaseEvent):
     def unregister(self, dummy: Any = None):
         "Cancel running the event"
         self.stopped = True
-        workers.do(self._unregister)
+        self.scheduler.do(self._unregister)
 
 
 class BaseRepeatingEvent(BaseEvent):
@@ -165,15 +282,18 @@ class BaseRepeatingEvent(BaseEvent):
         self,
         function: Callable[[], Any],
         interval: float,
+        scheduler: NewScheduler | None = None,
     ):
         """
         Args:
             function (Callable[[],Any]): Function to call
             interval (float): Interval
+            scheduler (NewScheduler, optional): Defaults to the global scheduler
         """
-        BaseEvent.__init__(self)
+        BaseEvent.__init__(self, scheduler)
         self.f = util.universal_weakref(function)
         self.fstr = str(function)
+        self.stats.name = self.fstr
         self.interval = float(interval)
 
         # True if the event is in the scheduler queue or the worker queue,
@@ -225,7 +345,7 @@ class BaseRepeatingEvent(BaseEvent):
                 if self.scheduled:
                     return
                 if not self.lastrun:
-                    self.lastrun = time.time()
+                    self.lastrun = self.scheduler.clock.monotonic()
                 self._schedule()
             finally:
                 self.lock.release()
@@ -239,20 +359,20 @@ class BaseRepeatingEvent(BaseEvent):
         """Register self in the list of
         repeating events to be automatically scheduled."""
         self.stop = False
-        scheduler.register_repeating(self)
+        self.scheduler.register_repeating(self)
         self.schedule()
 
     def _unregister(self):
-        scheduler.unregister(self)
+        self.scheduler.unregister(self)
 
     # We want to use the worker pool to unregister so that we know which thread the scheduler.unregister call is
     # going to be in to prevent deadlocks. Also, we take a dummy var so we can use this as a weakref callback
     def unregister(self, dummy: Any = None):
         self.stop = True
-        workers.do(self._unregister)
+        self.scheduler.do(self._unregister)
 
     def run(self):
-        workers.do(self._run)
+        self.scheduler.do(self._run)
 
     def _run(self):
         # Safe to set outside lock I think. If there is
@@ -263,10 +383,14 @@ class BaseRepeatingEvent(BaseEvent):
             return
 
         # Don't run way too fast but do allow some tolerance in the speed.
-        if time.time() - self.lastrun < (self.interval / 3):
+        now = self.scheduler.clock.monotonic()
+        if now - self.lastrun < (self.interval / 3):
+            self.scheduler._record_skip(self)
             return
 
-        self.lastrun = time.time()
+        self.lastrun = now
+        lateness = now - self.time
+        start = time.perf_counter()
 
         # We must have been pulled out of the event queue or we wouldn't be running.
         # If somehow there is another copy, exit and let recovery reschedule us later.
@@ -281,6 +405,7 @@ class BaseRepeatingEvent(BaseEvent):
                     f()
                 # self._schedule()
             except Exception:
+                self.scheduler._record_error(self)
                 if f:
                     for i in function_error_hooks:
                         i(f)
@@ -306,6 +431,7 @@ class BaseRepeatingEvent(BaseEvent):
                 self.lock.release()
                 del f
                 sys.last_traceback = None
+                self.scheduler._record_run(self, lateness, time.perf_counter() - start, self.interval)
         else:
             print(self.lock)
 
@@ -324,18 +450,18 @@ class RepeatingEvent(BaseRepeatingEvent):
             return
 
         # Don't alow unlimited amounts of winding up a big queue.
-        t = max((self.lastrun + self.interval), ((time.time() + self.interval) - 5))
+        t = max((self.lastrun + self.interval), ((self.scheduler.clock.monotonic() + self.interval) - 5))
         self.time = t
         self.scheduled = True
-        scheduler._insert(self)
+        self.scheduler._insert(self)
 
 
 class RepeatWhileEvent(RepeatingEvent):
     "Does function every interval seconds, and stops if you don't keep a reference to function"
 
-    def __init__(self, function, interval):
+    def __init__(self, function, interval, scheduler: NewScheduler | None = None):
         self.ended = False
-        RepeatingEvent.__init__(self, function, interval)
+        RepeatingEvent.__init__(self, function, interval, scheduler)
 
     def _run(self):
         if self.ended:
@@ -355,7 +481,153 @@ class RepeatWhileEvent(RepeatingEvent):
                 del f
 
 
+def _get_loop(loop: asyncio.AbstractEventLoop | None) -> asyncio.AbstractEventLoop:
+    if loop:
+        return loop
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        raise RuntimeError("Coroutine functions need an event loop, pass loop= or schedule from inside a running loop") from None
+
+
+class AsyncEvent(Event):
+    """Runs a coroutine function at the given time, as a task on loop.
+    The scheduler thread hands it straight to the loop, without using the worker pool."""
+
+    def __init__(self, function, time, scheduler=None, wall_clock=True, loop: asyncio.AbstractEventLoop | None = None):
+        Event.__init__(self, function, time, scheduler, wall_clock)
+        self.loop = _get_loop(loop)
+        self.task: asyncio.Task | None = None
+
+    def run(self):
+        self.scheduler._wall_events.discard(self)
+        try:
+            self.loop.call_soon_threadsafe(self._start)
+        except RuntimeError:
+            logger.warning(f"Loop for {self.fstr} was closed before it could run")
+
+    def _start(self):
+        if self.stopped:
+            return
+        f = self.f()
+        if not f:
+            self.unregister()
+            logger.warning(f"{self.fstr} was deleted before being called.")
+            return
+        self.task = self.loop.create_task(self._await(f, self.scheduler.clock.monotonic() - self.time))
+
+    async def _await(self, f, lateness: float):
+        start = time.perf_counter()
+        try:
+            await f()
+        except Exception:
+            self.scheduler._record_error(self)
+            for i in function_error_hooks:
+                i(f)
+        finally:
+            self.task = None
+            self.scheduler._record_run(self, lateness, time.perf_counter() - start)
+
+    def unregister(self, dummy: Any = None):
+        "Cancel running the event, including cancelling the task if it already started"
+        Event.unregister(self)
+        t = self.task
+        if t:
+            try:
+                self.loop.call_soon_threadsafe(t.cancel)
+            except RuntimeError:
+                pass
+
+
+class AsyncRepeatingEvent(RepeatingEvent):
+    """Runs a coroutine function every interval seconds on loop,
+    and stops if you don't keep a reference to function.
+
+    The next run is scheduled when the task finishes, so runs never overlap.
+    """
+
+    def __init__(self, function, interval, scheduler=None, loop: asyncio.AbstractEventLoop | None = None):
+        RepeatingEvent.__init__(self, function, interval, scheduler)
+        self.loop = _get_loop(loop)
+        self.task: asyncio.Task | None = None
+
+    def run(self):
+        # Straight from the scheduler thread to the loop, no worker pool hop
+        try:
+            self.loop.call_soon_threadsafe(self._start)
+        except RuntimeError:
+            logger.warning(f"Loop for {self.fstr} was closed, unregistering")
+            self.unregister()
+
+    def _start(self):
+        self.scheduled = False
+
+        if self.stop:
+            return
+
+        # Error recovery can reschedule us while a slow run is still going.
+        # The sync version is kept out by its lock, we have to check.
+        # The running task schedules the next run when it finishes.
+        if self.task is not None and not self.task.done():
+            self.scheduler._record_skip(self)
+            return
+
+        now = self.scheduler.clock.monotonic()
+        if now - self.lastrun < (self.interval / 3):
+            self.scheduler._record_skip(self)
+            return
+
+        self.lastrun = now
+
+        f = self.f()
+        if not f:
+            self.unregister()
+            logger.warning(f"{self.fstr} was automatically unregistered.")
+            return
+
+        self.task = self.loop.create_task(self._await(f, now - self.time))
+
+    async def _await(self, f, lateness: float):
+        start = time.perf_counter()
+        try:
+            await f()
+        except asyncio.CancelledError:
+            # Whoever cancelled us, we are done for good
+            BaseRepeatingEvent.unregister(self)
+            raise
+        except Exception:
+            self.scheduler._record_error(self)
+            for i in function_error_hooks:
+                i(f)
+
+            if not self.errored:
+                try:
+                    handle_first_error(f)
+                except Exception:
+                    logging.exception("Error handling first error in repeating event")
+            self.errored = True
+        finally:
+            self.task = None
+            self.scheduler._record_run(self, lateness, time.perf_counter() - start, self.interval)
+            del f
+            if not self.stop:
+                with self.lock:
+                    self._schedule()
+
+    def unregister(self, dummy: Any = None):
+        BaseRepeatingEvent.unregister(self)
+        t = self.task
+        if t:
+            try:
+                self.loop.call_soon_threadsafe(t.cancel)
+            except RuntimeError:
+                pass
+
+
 class WrappedFunction:
+    """What every() returns. Calls through to the function, and can be used as a context manager
+    or async context manager that unregisters the event on exit."""
+
     def __init__(self, f, e: RepeatingEvent):
         self.f = f
         self.e = e
@@ -366,30 +638,70 @@ class WrappedFunction:
     def unregister(self):
         self.e.unregister()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.unregister()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *a):
+        self.unregister()
+
 
 class NewScheduler:
     """
     represents a thread that constantly runs tasks which are objects having a time property that determins when
     their run method gets called. Inserted tasks use a lockless double buffered scheme.
+
+    If given a virtual clock, no threads are used at all. Events run inline, in order,
+    whenever the clock is advanced.
     """
 
-    def __init__(self):
+    def __init__(self, clock: clocks.Clock | None = None):
+        self.clock = clock or clocks.system_clock
         self._lock = threading.RLock()
         self._repeatingtasks = []
         self.daemon = True
         self.name = "SchedulerThread"
-        self._lastrecheckedschedules = time.time()
-        self._lf = time.time()
+        self._lastrecheckedschedules = self.clock.monotonic()
+        self._lf = self.clock.monotonic()
         self._running = False
 
         self._wakeUp = threading.Event()
-        self._sched = sched.scheduler(timefunc=time.time, delayfunc=self.delay)
+        self._sched = sched.scheduler(timefunc=self.clock.monotonic, delayfunc=self.delay)
+
+        # Events that want a specific wall clock time, and have to move if it jumps
+        self._wall_events: set[Event] = set()
+        self._wall_offset = self.clock.time() - self.clock.monotonic()
+        # Discrepancy in seconds between wall and monotonic clocks that counts as a jump
+        self.clock_jump_threshold = 1.0
+
+        # Totals across every event that has ever run here
+        self._stats_lock = threading.Lock()
+        self.stats = EventStats("__all__")
+
+        if self.clock.virtual:
+            self.clock.attach(self)
+
+    def do(self, f: Callable[[], Any]):
+        """Run f in the background using the worker pool,
+        or immediately in this thread if we are on a virtual clock"""
+        if self.clock.virtual:
+            f()
+        else:
+            workers.do(f)
 
     def start(self):
         with self._lock:
             if self._running:
                 return
             self._running = True
+            # The virtual clock drives us directly
+            if self.clock.virtual:
+                return
             self.thread = threading.Thread(daemon=self.daemon, target=self.run, name="schedulerthread")
             self.thread2 = threading.Thread(
                 daemon=self.daemon,
@@ -412,14 +724,14 @@ class NewScheduler:
         return self.every(f, 3600)  # type: ignore
 
     @overload
-    def every(self, interval: float = 0) -> Callable[[Callable[[], Any]], Callable[[], Any]]:
+    def every(self, interval: float = 0, *, loop: asyncio.AbstractEventLoop | None = None) -> Callable[[Callable[[], Any]], Callable[[], Any]]:
         pass
 
     @overload
-    def every(self, f: Callable[[], Any], interval: float = 0) -> WrappedFunction:
+    def every(self, f: Callable[[], Any], interval: float = 0, *, loop: asyncio.AbstractEventLoop | None = None) -> WrappedFunction:
         pass
 
-    def every(self, f: Callable[[], Any] | float, interval: float = 0):  # type: ignore
+    def every(self, f: Callable[[], Any] | float, interval: float = 0, *, loop: asyncio.AbstractEventLoop | None = None):  # type: ignore
         """Overloaded:
         every(interval) returns a decorator
         every(function, interval) calls the function
@@ -429,6 +741,9 @@ class NewScheduler:
 
         Call unregister() when you're done with it to avoid a logging warning
         when you delete it and it unregisters it for you.
+
+        Coroutine functions run as tasks on loop, which defaults to the running loop.
+        Use "async with scheduler.every(f, 1):" to cancel it when the block exits.
         """
 
         if isinstance(f, (int, float)):
@@ -436,7 +751,7 @@ class NewScheduler:
                 raise ValueError("Must supply function and interval, or just interval for decorator.")
 
             def decorate(fn):
-                return self.every(fn, f)
+                return self.every(fn, f, loop=loop)
 
             return decorate
 
@@ -445,25 +760,51 @@ class NewScheduler:
                 raise ValueError("Interval cannot be zero")
 
             interval = float(interval)
-            e = RepeatingEvent(f, interval)
+            if inspect.iscoroutinefunction(f):
+                e = AsyncRepeatingEvent(f, interval, self, loop=loop)
+            else:
+                e = RepeatingEvent(f, interval, self)
             e.register()
             if isinstance(f, types.MethodType):
+                if inspect.iscoroutinefunction(f):
 
-                def f2():
-                    f()
+                    async def f2():
+                        return await f()
+
+                else:
+
+                    def f2():
+                        f()
 
             else:
                 f2 = f
             return WrappedFunction(f2, e)
 
-    def schedule(self, f: Callable[[], Any], t: float, exact=False):
+    def schedule(self, f: Callable[[], Any], t: float, exact=False, *, loop: asyncio.AbstractEventLoop | None = None):
+        """Run f at wall clock time t, as in time.time().
+        If the wall clock jumps, the event moves to match.
+        Coroutine functions run as a task on loop, which defaults to the running loop."""
         t = float(t)
-        e = Event(f, t)
+        if inspect.iscoroutinefunction(f):
+            e = AsyncEvent(f, t, self, loop=loop)
+        else:
+            e = Event(f, t, self)
+        e.schedule()
+        return e
+
+    def schedule_after(self, f: Callable[[], Any], delay: float, *, loop: asyncio.AbstractEventLoop | None = None):
+        """Run f after delay seconds, measured on the monotonic clock,
+        so it is not affected by the wall clock being changed"""
+        t = self.clock.monotonic() + float(delay)
+        if inspect.iscoroutinefunction(f):
+            e = AsyncEvent(f, t, self, wall_clock=False, loop=loop)
+        else:
+            e = Event(f, t, self, wall_clock=False)
         e.schedule()
         return e
 
     def schedule_repeating(self, f: Callable[..., Any], t: float, sync: bool = True):
-        e = RepeatingEvent(f, float(t))
+        e = RepeatingEvent(f, float(t), self)
         e.register()
         return e
 
@@ -478,15 +819,20 @@ class NewScheduler:
             except Exception:
                 pass
 
+        if event.wall_clock:
+            event.time = event.wall_time - self._wall_offset
+            self._wall_events.add(event)
+
         event.schedID = self._sched.enterabs(event.time, 1, event.run)
         # Only very fast events need to use this wake mechanism that burns CPU.
         # We have a min 0.15hz poll rate
-        if event.time < (time.time() + 0.15):
+        if event.time < (self.clock.monotonic() + 0.15):
             self._wakeUp.set()
 
     def remove(self, event):
         "Remove something that has a time and a run property that wants its run to be called at time"
         with self._lock:
+            self._wall_events.discard(event)
             try:
                 self._sched.cancel(event.schedID)
             except ValueError:
@@ -527,9 +873,31 @@ class NewScheduler:
 
     # Custom delay func because we must be able to recieve new events while waiting
     def delay(self, t):
+        self._check_clock_jump()
         self._wakeUp.clear()
         self._wakeUp.wait(min(t, 0.15))
 
+    def _check_clock_jump(self):
+        """If the wall clock moved relative to the monotonic clock,
+        move all the wall clock events to their new monotonic times.
+        Only call from the scheduler thread."""
+        offset = self.clock.time() - self.clock.monotonic()
+        if abs(offset - self._wall_offset) < self.clock_jump_threshold:
+            return
+
+        logger.warning(f"Wall clock jumped by {offset - self._wall_offset:.3f}s, rescheduling wall clock events")
+        self._wall_offset = offset
+
+        with self._lock:
+            for i in list(self._wall_events):
+                try:
+                    self._sched.cancel(i.schedID)
+                except ValueError:
+                    # Already ran or was removed
+                    self._wall_events.discard(i)
+                    continue
+                self._insert(i)
+
     def run(self):
         while 1:
             try:
@@ -537,18 +905,90 @@ class NewScheduler:
             except Exception:
                 logging.exception("Error in scheduler thread")
 
+    def _time_until_next(self) -> float | None:
+        "Seconds until the next queued event is due, or None if nothing is queued"
+        with self._sched._lock:
+            q = self._sched._queue
+            if not q:
+                return None
+            return q[0].time - self.clock.monotonic()
+
+    def _run_due(self):
+        "Run everything that is due right now, used by virtual clocks"
+        self._check_clock_jump()
+        try:
+            self._sched.run(blocking=False)
+        except Exception:
+            logging.exception("Error in scheduler")
+
+    def _record_run(self, event: BaseEvent, lateness: float, duration: float, interval: float | None = None):
+        event.stats.record_run(lateness, duration, interval)
+        with self._stats_lock:
+            self.stats.record_run(lateness, duration, interval)
+
+    def _record_skip(self, event: BaseEvent):
+        event.stats.skipped += 1
+        with self._stats_lock:
+            self.stats.skipped += 1
+
+    def _record_error(self, event: BaseEvent):
+        event.stats.errors += 1
+        with self._stats_lock:
+            self.stats.errors += 1
+
+    def _record_recovery(self, event: BaseEvent):
+        event.stats.recoveries += 1
+        with self._stats_lock:
+            self.stats.recoveries += 1
+
+    @property
+    def queue_size(self) -> int:
+        "Number of events currently waiting in the queue"
+        return len(self._sched._queue)
+
+    def get_stats(self) -> dict[str, Any]:
+        """Aggregate metrics for everything that ran in this scheduler.
+        Durations and lateness are in seconds, see lateness_buckets for the histogram edges."""
+        with self._stats_lock:
+            d = self.stats.to_dict()
+        d["queue_size"] = self.queue_size
+        d["repeating_events"] = len(self._repeatingtasks)
+        return d
+
+    def slowest_events(self, n: int = 10, key: str = "max_duration") -> list[dict[str, Any]]:
+        """Return stats dicts for the n worst live events, sorted by key,
+        which may be any numeric stat such as max_duration, avg_lateness, or overruns.
+        Covers repeating events and one-shot events still in the queue."""
+        with self._lock:
+            events = list(self._repeatingtasks)
+        with self._sched._lock:
+            events.extend(i.action.__self__ for i in self._sched._queue if isinstance(i.action.__self__, Event))
+
+        stats = [i.stats.to_dict() for i in events]
+        return heapq.nlargest(n, stats, key=lambda i: i[key])
+
+    def reset_stats(self):
+        with self._lock:
+            events = list(self._repeatingtasks)
+        for i in events:
+            i.stats.reset()
+        with self._stats_lock:
+            self.stats.reset()
+
     def _do_error_recovery(self):
+        now = self.clock.monotonic()
         for i in self._repeatingtasks:
             try:
-                if not i.scheduled or time.time() - i.lastrun > (i.interval * 2):
+                if not i.scheduled or now - i.lastrun > (i.interval * 2):
                     # Give them 10 seconds to finish what they are doing and schedule themselves.
-                    if i.lastrun < time.time() - 10:
+                    if i.lastrun < now - 10:
                         # Let's maybe not block the entire scheduling thread
                         # If one event takes a long time to schedule or if it
                         # Is already running and can't schedule yet.
 
                         # On the off chance it actually IS scheduled, replace whatever was there last.
-                        workers.do(i.schedule)
+                        self.do(i.schedule)
+                        self._record_recovery(i)
                         logger.debug(
                             "Rescheduled " + str(i) + "using error recovery, could indicate a bug somewhere, or just a long running event."
                         )
@@ -560,3 +1000,197 @@ scheduler = NewScheduler()
 scheduler.start()
 
 every = scheduler.every
+
+
+class _PerInstance:
+    """Lets a Debouncer or Throttler decorate a method.
+    Each instance gets its own copy, bound to it, the first time it looks the method up,
+    so instances don't hold back each other's calls."""
+
+    name: str | None = None
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if not self.name:
+            raise TypeError(f"{type(self).__name__} can only decorate methods in the class body")
+        # Stored on the instance, so later lookups never get here.
+        # setdefault, so two threads looking it up at once agree on the same one.
+        return obj.__dict__.setdefault(self.name, self._copy(types.MethodType(self.f, obj)))
+
+    def _copy(self, f: Callable[..., Any]):
+        raise NotImplementedError
+
+
+class Debouncer(_PerInstance):
+    """Calls f wait seconds after the most recent call, with the most recent arguments.
+    Bursts of calls only ever use one scheduled Event, which is pushed back
+    at most once per wait period instead of once per call.
+    Works as a method decorator too, with a separate Debouncer for each instance."""
+
+    def __init__(self, f: Callable[..., Any], wait: float, scheduler: NewScheduler | None = None):
+        self.f = f
+        self.wait = float(wait)
+        self.scheduler = scheduler or globals()["scheduler"]
+        self.lock = threading.Lock()
+        self.last_call = 0.0
+        self.pending: tuple[tuple, dict] | None = None
+        self.armed = False
+        self._event = Event(self._fire, 0, self.scheduler, wall_clock=False)
+
+    def __call__(self, *a, **k):
+        with self.lock:
+            self.pending = (a, k)
+            self.last_call = self.scheduler.clock.monotonic()
+            if not self.armed:
+                self._arm(self.last_call + self.wait)
+
+    def _arm(self, t: float):
+        "Must be called under lock"
+        self.armed = True
+        self._event.time = t
+        self._event.schedule()
+
+    def _fire(self):
+        with self.lock:
+            due = self.last_call + self.wait
+            # More calls came in since we were armed, wait for things to settle
+            if self.scheduler.clock.monotonic() < due:
+                self._arm(due)
+                return
+            self.armed = False
+            if not self.pending:
+                return
+            a, k = self.pending
+            self.pending = None
+        self.f(*a, **k)
+
+    def flush(self):
+        "Run the pending call now, if there is one"
+        with self.lock:
+            if not self.pending:
+                return
+            a, k = self.pending
+            self.pending = None
+        self.f(*a, **k)
+
+    def cancel(self):
+        "Forget the pending call, if there is one"
+        with self.lock:
+            self.pending = None
+
+    def _copy(self, f: Callable[..., Any]):
+        return Debouncer(f, self.wait, self.scheduler)
+
+
+class Throttler(_PerInstance):
+    """Calls f at most once per interval.
+
+    With leading, a call outside the interval runs right away in the caller's thread.
+    With trailing, calls inside the interval are collapsed into one call with the
+    most recent arguments, at the end of the interval. Only one scheduled Event is ever used.
+    Works as a method decorator too, with a separate Throttler for each instance.
+    """
+
+    def __init__(
+        self,
+        f: Callable[..., Any],
+        interval: float,
+        leading: bool = True,
+        trailing: bool = True,
+        scheduler: NewScheduler | None = None,
+    ):
+        self.f = f
+        self.interval = float(interval)
+        self.leading = leading
+        self.trailing = trailing
+        self.scheduler = scheduler or globals()["scheduler"]
+        self.lock = threading.Lock()
+        self.last_run = -float("inf")
+        self.pending: tuple[tuple, dict] | None = None
+        self.armed = False
+        self._event = Event(self._fire, 0, self.scheduler, wall_clock=False)
+
+    def __call__(self, *a, **k):
+        with self.lock:
+            now = self.scheduler.clock.monotonic()
+            if self.leading and not self.armed and now - self.last_run >= self.interval:
+                self.last_run = now
+            else:
+                if self.trailing:
+                    self.pending = (a, k)
+                    if not self.armed:
+                        self.armed = True
+                        if self.leading:
+                            self._event.time = self.last_run + self.interval
+                        else:
+                            self._event.time = max(self.last_run, now) + self.interval
+                        self._event.schedule()
+                return
+        self.f(*a, **k)
+
+    def _fire(self):
+        with self.lock:
+            self.armed = False
+            if not self.pending:
+                return
+            a, k = self.pending
+            self.pending = None
+            self.last_run = self.scheduler.clock.monotonic()
+        self.f(*a, **k)
+
+    def cancel(self):
+        "Forget the pending trailing call, if there is one"
+        with self.lock:
+            self.pending = None
+
+    def _copy(self, f: Callable[..., Any]):
+        return Throttler(f, self.interval, self.leading, self.trailing, self.scheduler)
+
+
+def debounce(f: Callable[..., Any] | float, wait: float = 0, *, scheduler: NewScheduler | None = None):  # type: ignore
+    """Overloaded:
+    debounce(wait) returns a decorator
+    debounce(function, wait) returns a Debouncer wrapping the function
+
+    Calls run in the worker pool, wait seconds after the last call.
+    """
+    if isinstance(f, (int, float)):
+        if not wait == 0:
+            raise ValueError("Must supply function and wait, or just wait for decorator.")
+
+        def decorate(fn):
+            return Debouncer(fn, f, scheduler)
+
+        return decorate
+
+    return Debouncer(f, wait, scheduler)
+
+
+def throttle(
+    f: Callable[..., Any] | float,
+    interval: float = 0,
+    *,
+    leading: bool = True,
+    trailing: bool = True,
+    scheduler: NewScheduler | None = None,
+):  # type: ignore
+    """Overloaded:
+    throttle(interval) returns a decorator
+    throttle(function, interval) returns a Throttler wrapping the function
+
+    Leading edge calls run in the caller's thread, trailing calls run in the worker pool.
+    """
+    if isinstance(f, (int, float)):
+        if not interval == 0:
+            raise ValueError("Must supply function and interval, or just interval for decorator.")
+
+        def decorate(fn):
+            return Throttler(fn, f, leading, trailing, scheduler)
+
+        return decorate
+
+    return Throttler(f, interval, leading, trailing, scheduler)
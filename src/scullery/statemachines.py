@@ -5,12 +5,17 @@ from __future__ import annotations
 import time
 import threading
 import weakref
+import logging
+import heapq
+import collections
+import array
+from types import MappingProxyType
 
-from pydantic import validate_call
+from pydantic import validate_call, BaseModel, ConfigDict
 
-from typing import Any
-from collections.abc import Callable
-from scullery import workers, util, scheduling
+from typing import Any, NamedTuple
+from collections.abc import Callable, Iterable
+from scullery import workers, util, scheduling, messagebus, persist
 
 # import time
 # import scullery.statemachines
@@ -47,48 +52,719 @@ def unboundProxy(self, f):
     return f2
 
 
-def makechecker(ref: weakref.ref[StateMachine]):
-    def timer_check():
-        m = ref()
-        if m:
-            m._check_timer()
+def runSubscriber(f, state):
+    f(state)
 
-    return timer_check
 
+def _run_hooks(batch: list[tuple[Callable, tuple]]):
+    for f, args in batch:
+        try:
+            f(*args)
+        except Exception:
+            logging.exception(f"Error in state machine hook {f}")
+
+
+class _ConditionPoller:
+    """Polls the conditions of every machine on a scheduler that is currently
+    in a state with polled conditions, from one shared repeating event.
+    Machines join and leave in O(1) as they change state."""
+
+    def __init__(self, scheduler: scheduling.NewScheduler, interval: float = 1 / 24):
+        # Weak, so that we don't keep our own key in _pollers alive
+        self.scheduler = weakref.ref(scheduler)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.machines: weakref.WeakSet[StateMachine] = weakref.WeakSet()
+        self.scheduled: scheduling.WrappedFunction | None = None
+
+    def add(self, m: StateMachine):
+        with self.lock:
+            self.machines.add(m)
+            if not self.scheduled:
+                scheduler = self.scheduler()
+                if scheduler:
+                    self.scheduled = scheduler.every(self.poll, self.interval)
+
+    def discard(self, m: StateMachine):
+        self.machines.discard(m)
+
+    def poll(self):
+        machines = list(self.machines)
+        if not machines:
+            with self.lock:
+                # Nothing to do, stop waking up until someone needs us again
+                if not self.machines and self.scheduled:
+                    self.scheduled.unregister()
+                    self.scheduled = None
+            return
+
+        for i in machines:
+            try:
+                i.check()
+            except Exception:
+                logging.exception(f"Error checking conditions in {i}")
+
+
+class _InputRouter:
+    """Passes messages on to every machine on a scheduler with a watched condition on the topic.
+    Each topic gets one bus subscription no matter how many machines watch it,
+    because every subscribe copies the bus's whole subscriber table."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.machines: dict[str, weakref.WeakSet[StateMachine | StateMachineGroup]] = {}
+        # The bus only holds a weak ref, so we keep the handlers here.
+        # Topics stay subscribed once nobody watches them, it's cheaper than churning the bus.
+        self.handlers: dict[str, Callable[[], None]] = {}
+
+    def add(self, topic: str, m: StateMachine | StateMachineGroup):
+        with self.lock:
+            if topic not in self.machines:
+                self.machines[topic] = weakref.WeakSet()
+                self.handlers[topic] = self._make_handler(self.machines[topic])
+                messagebus.subscribe(topic, self.handlers[topic])
+            self.machines[topic].add(m)
+
+    def discard(self, topic: str, m: StateMachine | StateMachineGroup):
+        machines = self.machines.get(topic)
+        if machines is not None:
+            machines.discard(m)
+
+    def _make_handler(self, machines: weakref.WeakSet[StateMachine | StateMachineGroup]):
+        def on_input():
+            for i in list(machines):
+                try:
+                    i._on_input()
+                except Exception:
+                    logging.exception(f"Error checking conditions in {i}")
+
+        return on_input
+
+
+class _TimerService:
+    """One timer queue for every state machine timer on a scheduler,
+    driven by a single reusable scheduler Event set for the soonest deadline.
+
+    Nothing is ever cancelled. Owners push (deadline, key) entries, and when one comes due
+    we call owner._on_timer(key, deadline), and the owner decides if the entry is stale.
+    Owners only need to push when a deadline moves earlier, so rearming is O(1) in the usual case.
+    """
+
+    def __init__(self, scheduler: scheduling.NewScheduler):
+        # Weak, so that we don't keep our own key in _timer_services alive while idle
+        self.scheduler = weakref.ref(scheduler)
+        self.clock = scheduler.clock
+        self.lock = threading.Lock()
+        self.heap: list[tuple[float, int, weakref.ref, Any]] = []
+        # Tie breaker so the heap never compares weakrefs
+        self.seq = 0
+        # Only exists while there is anything queued
+        self.event: scheduling.Event | None = None
+
+    def push(self, ref: weakref.ref, key: Any, deadline: float):
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.heap, (deadline, self.seq, ref, key))
+            if self.event is None or deadline < self.event.time:
+                self._set_driver(deadline)
+
+    def _set_driver(self, t: float):
+        "Needs to be called under lock"
+        scheduler = self.scheduler()
+        if not scheduler:
+            return
+        if self.event is None:
+            self.event = scheduling.Event(self._fire, t, scheduler, wall_clock=False)
+        else:
+            scheduler.remove(self.event)
+            self.event.time = t
+        self.event.schedule()
+
+    def _fire(self):
+        now = self.clock.monotonic()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+
+        for deadline, seq, ref, key in due:
+            owner = ref()
+            if owner:
+                try:
+                    owner._on_timer(key, deadline)
+                except Exception:
+                    logging.exception(f"Error in timer for {owner}")
+
+        with self.lock:
+            if self.heap:
+                self._set_driver(self.heap[0][0])
+            else:
+                self.event = None
+
+    def __len__(self):
+        return len(self.heap)
 
-def runSubscriber(f, state):
-    f(state)
+
+_pollers: weakref.WeakKeyDictionary[scheduling.NewScheduler, _ConditionPoller] = weakref.WeakKeyDictionary()
+_timer_services: weakref.WeakKeyDictionary[scheduling.NewScheduler, _TimerService] = weakref.WeakKeyDictionary()
+_input_routers: weakref.WeakKeyDictionary[scheduling.NewScheduler, _InputRouter] = weakref.WeakKeyDictionary()
+_services_lock = threading.Lock()
+
+
+def _get_poller(scheduler: scheduling.NewScheduler) -> _ConditionPoller:
+    with _services_lock:
+        if scheduler not in _pollers:
+            _pollers[scheduler] = _ConditionPoller(scheduler)
+        return _pollers[scheduler]
+
+
+def _get_timer_service(scheduler: scheduling.NewScheduler) -> _TimerService:
+    with _services_lock:
+        if scheduler not in _timer_services:
+            _timer_services[scheduler] = _TimerService(scheduler)
+        return _timer_services[scheduler]
+
+
+def _get_input_router(scheduler: scheduling.NewScheduler) -> _InputRouter:
+    with _services_lock:
+        if scheduler not in _input_routers:
+            _input_routers[scheduler] = _InputRouter()
+        return _input_routers[scheduler]
 
 
 class UpdateControl:
     pass
 
 
+class _CompiledState:
+    """One state of a compiled machine. Destinations are state indexes, unknown state names, or callables.
+    Rules and conditions already include the ones inherited from parent states."""
+
+    __slots__ = ("index", "name", "enter", "exit", "timer", "conditions", "watched", "path", "nested", "initial", "timers")
+
+    def __init__(
+        self,
+        index: int,
+        name: str,
+        enter: Callable | None,
+        exit: Callable | None,
+        timer: tuple[float, int | str | Callable] | None,
+        conditions: tuple[tuple[Callable, int | str | Callable], ...],
+        watched: tuple[tuple[Callable, int | str | Callable], ...] = (),
+        path: tuple[int, ...] = (),
+        initial: int | None = None,
+        timers: tuple[tuple[int, float, int | str | Callable], ...] = (),
+    ):
+        self.index = index
+        self.name = name
+        self.enter = enter
+        self.exit = exit
+        # This state's own timer
+        self.timer = timer
+        # Polled conditions
+        self.conditions = conditions
+        # Conditions that only get checked when their input topics change
+        self.watched = watched
+        # Indexes from the outermost parent down to this state
+        self.path = path or (index,)
+        self.nested = len(self.path) > 1
+        # Leaf state to actually go to when something goes here
+        self.initial = initial
+        # (depth in path, duration, dest) for this state's timer and every parent's, outermost first
+        self.timers = timers
+
+
+class _Compiled:
+    """Flat, immutable form of a machine's states.
+    table maps each event to a tuple with one destination per state index, or None for no rule."""
+
+    __slots__ = ("states", "index", "table")
+
+    def __init__(self, states: tuple[_CompiledState, ...], index: dict[str, int], table: dict[str, tuple]):
+        self.states = states
+        self.index = index
+        self.table = table
+
+
+def _compile(states: dict[str, dict[str, Any]]) -> _Compiled:
+    "Turn a states dict as built by add_state and friends into a _Compiled"
+    names = list(states)
+    index = {name: i for i, name in enumerate(names)}
+
+    def resolve(dest):
+        # Leave unknown names as strings so they fail at transition time, like they always have
+        if isinstance(dest, str):
+            return index.get(dest, dest)
+        return dest
+
+    def get_path(name: str) -> tuple[int, ...]:
+        path = [index[name]]
+        parent = states[name].get("parent")
+        while parent:
+            if parent not in index:
+                raise ValueError(f"Parent state {parent} of {name} does not exist")
+            if index[parent] in path:
+                raise ValueError(f"State {name} is its own ancestor")
+            path.insert(0, index[parent])
+            parent = states[parent].get("parent")
+        return tuple(path)
+
+    def get_initial(name: str) -> int | None:
+        initial = states[name].get("initial")
+        if not initial:
+            return None
+        if initial not in index or not states[initial].get("parent") == name:
+            raise ValueError(f"Initial state {initial} of {name} must be a child of it")
+        # Keep going down if the initial state has its own initial state
+        deeper = get_initial(initial)
+        return index[initial] if deeper is None else deeper
+
+    compiled = []
+    table: dict[str, list] = {}
+
+    for i, name in enumerate(names):
+        s = states[name]
+        path = get_path(name)
+        # Outermost first, so that closer states override their parents
+        chain = [states[names[j]] for j in path]
+
+        timer = s.get("timer")
+        timers = tuple(
+            (depth, x["timer"][0], resolve(x["timer"][1])) for depth, x in enumerate(chain) if x.get("timer")
+        )
+
+        compiled.append(
+            _CompiledState(
+                i,
+                name,
+                s["enter"],
+                s["exit"],
+                (timer[0], resolve(timer[1])) if timer else None,
+                # The innermost state's conditions get checked first
+                tuple((f, resolve(dest)) for x in reversed(chain) for f, dest in x["conditions"]),
+                tuple((f, resolve(dest)) for x in reversed(chain) for f, dest, topics in x["watched"]),
+                path,
+                get_initial(name),
+                timers,
+            )
+        )
+
+        rules: dict[str, Any] = {}
+        for x in chain:
+            rules.update(x["rules"])
+
+        for event, dest in rules.items():
+            if event not in table:
+                table[event] = [None] * len(names)
+            table[event][i] = resolve(dest)
+
+    return _Compiled(tuple(compiled), index, {k: tuple(v) for k, v in table.items()})
+
+
+def _transition_path(c: _Compiled, src: int, dest: int) -> tuple[list[_CompiledState], list[_CompiledState], int]:
+    """States to exit, innermost first, and states to enter, outermost first,
+    going from src to dest. Also returns how many levels of the path are kept."""
+    p1 = c.states[src].path
+    p2 = c.states[dest].path
+    k = 0
+    for a, b in zip(p1, p2):
+        if not a == b:
+            break
+        k += 1
+    # Going to the same state exits and reenters it
+    if k == len(p1) == len(p2):
+        k -= 1
+    return [c.states[i] for i in reversed(p1[k:])], [c.states[i] for i in p2[k:]], k
+
+
+def _fit_path(c: _Compiled, r: StateMachine | _Region):
+    """Make sure r has one entry time per level of its current state's path.
+    Before compiling we can't know how deep the start state is, so count every level from when we started."""
+    n = len(c.states[r._state_index].path)
+    if not len(r._path_entered) == n:
+        r._path_entered = [r._entered_monotonic] * n
+
+
+class _Region:
+    """Current state of one extra orthogonal region of a StateMachine.
+    Has the same fields as the machine itself, which acts as the main region."""
+
+    __slots__ = (
+        "name",
+        "state",
+        "prev_state",
+        "entered_state",
+        "_entered_monotonic",
+        "_path_entered",
+        "_state_index",
+        "_time_offset",
+        "_transiton_count",
+        "_timer_deadline",
+        "_timer_count",
+        "_timer_queued",
+    )
+
+    def __init__(self, name: str, start: str, wall: float, monotonic: float):
+        self.name = name
+        self.state = start
+        self.prev_state: str | None = None
+        self.entered_state = wall
+        self._entered_monotonic = monotonic
+        self._path_entered = [monotonic]
+        self._state_index = 0
+        self._time_offset = 0.0
+        self._transiton_count = 0
+        self._timer_deadline: float | None = None
+        self._timer_count = 0
+        self._timer_queued: float | None = None
+
+
+class _ConditionSpec(BaseModel):
+    model_config = ConfigDict(extra="forbid", arbitrary_types_allowed=True)
+
+    # Condition function, or the name of one
+    when: str | Callable
+    to: str | Callable
+    topics: list[str] | None = None
+
+
+class _StateSpec(BaseModel):
+    model_config = ConfigDict(extra="forbid", arbitrary_types_allowed=True)
+
+    rules: dict[str, str | Callable] = {}
+    enter: str | Callable | None = None
+    exit: str | Callable | None = None
+    timer: tuple[float, str | Callable] | None = None
+    parent: str | None = None
+    initial: str | None = None
+    conditions: list[_ConditionSpec] = []
+
+
+class _DefinitionSpec(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    start: str = "start"
+    states: dict[str, _StateSpec]
+    # Region name to start state
+    regions: dict[str, str] = {}
+
+
+class MachineDefinition:
+    """The states, rules, timers, and conditions of a machine, validated and compiled once,
+    and shared by any number of StateMachines or StateMachineGroups. Read only once created.
+
+    The data looks like this, in Python or in any file format persist can load:
+    ```yaml
+    start: idle
+    states:
+      idle:
+        rules: {start: running}
+      running:
+        rules: {stop: idle}
+        timer: [60, idle]
+        enter: on_running
+        conditions:
+          - {when: overheated, to: idle, topics: [/sensors/temp]}
+    regions:
+      fan: fan_off
+    ```
+    enter, exit, and when may be functions, or names to look up in functions.
+    Otherwise, everything means the same as in add_state, add_rule, set_timer, and add_region.
+    """
+
+    def __init__(self, data: dict[str, Any], functions: dict[str, Callable] | None = None):
+        spec = _DefinitionSpec.model_validate(data)
+        functions = functions or {}
+
+        def lookup(f):
+            if isinstance(f, str):
+                if f not in functions:
+                    raise ValueError(f"No function named {f}")
+                return functions[f]
+            return f
+
+        states: dict[str, dict[str, Any]] = {
+            "__closed__": {"rules": {}, "enter": None, "exit": None, "conditions": [], "watched": []}
+        }
+        topics: set[str] = set()
+
+        for name, x in spec.states.items():
+            for i in illegal_name_chars:
+                if i in name:
+                    raise ValueError("Forbidden special character")
+            states[name] = {
+                "rules": dict(x.rules),
+                "enter": lookup(x.enter) if x.enter else None,
+                "exit": lookup(x.exit) if x.exit else None,
+                "conditions": [(lookup(i.when), i.to) for i in x.conditions if not i.topics],
+                "watched": [(lookup(i.when), i.to, tuple(i.topics)) for i in x.conditions if i.topics],
+                "parent": x.parent,
+                "initial": x.initial,
+            }
+            if x.timer:
+                states[name]["timer"] = list(x.timer)
+            for i in x.conditions:
+                topics.update(i.topics or ())
+
+        for name, start in [("start", spec.start), *spec.regions.items()]:
+            if start not in states:
+                raise ValueError(f"Start state {start} does not exist")
+
+        # Functions pick their destination at transition time, but names must be real states
+        for name, x in spec.states.items():
+            dests = [(f"Rule {k}", v) for k, v in x.rules.items()]
+            dests += [("Condition", i.to) for i in x.conditions]
+            if x.timer:
+                dests.append(("Timer", x.timer[1]))
+            if x.initial:
+                dests.append(("Initial state", x.initial))
+            for what, dest in dests:
+                if isinstance(dest, str) and dest not in states:
+                    raise ValueError(f"{what} of {name} goes to {dest}, which does not exist")
+
+        self.start = spec.start
+        self.regions = MappingProxyType(dict(spec.regions))
+        self.topics = frozenset(topics)
+        # Read only all the way down, since every machine made from this shares it
+        self.states = MappingProxyType(
+            {
+                name: MappingProxyType(
+                    {
+                        **x,
+                        "rules": MappingProxyType(x["rules"]),
+                        "conditions": tuple(x["conditions"]),
+                        "watched": tuple(x["watched"]),
+                        **({"timer": tuple(x["timer"])} if "timer" in x else {}),
+                    }
+                )
+                for name, x in states.items()
+            }
+        )
+        self.compiled = _compile(self.states)
+
+    def __repr__(self):
+        return f"<MachineDefinition with {len(self.states) - 1} states, starting in {self.start}>"
+
+    @staticmethod
+    def load(fn: str, functions: dict[str, Callable] | None = None) -> MachineDefinition:
+        "Load a definition from any file that scullery.persist can load"
+        return MachineDefinition(persist.load(fn), functions)
+
+    def machine(self, start: str | None = None, **kwargs) -> StateMachine:
+        "Make a new machine using this definition. Keyword args are passed on to StateMachine."
+        return StateMachine(start, definition=self, **kwargs)
+
+
+# Ways to run enter/exit hooks and subscribers
+hook_dispatch_modes = ("sync", "workers", "ordered")
+
+
+class Transition(NamedTuple):
+    "One entry in a machine's transition trace"
+
+    time: float
+    from_state: str
+    to_state: str
+    # The event name, or __timer__, __condition__, or __goto__
+    trigger: str
+    # None for the main region
+    region: str | None = None
+
+
+class _TransitionTrace:
+    """Fixed size ring buffer of recent transitions.
+    States are stored as indexes and only turned into names when read."""
+
+    __slots__ = ("size", "pos", "count", "times", "src", "dst", "triggers", "regions")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.pos = 0
+        self.count = 0
+        self.times = array.array("d", [0.0]) * size
+        self.src = array.array("i", [0]) * size
+        self.dst = array.array("i", [0]) * size
+        self.triggers: list[str] = [""] * size
+        self.regions: list[str | None] = [None] * size
+
+    def record(self, t: float, src: int, dst: int, trigger: str, region: str | None):
+        i = self.pos
+        self.times[i] = t
+        self.src[i] = src
+        self.dst[i] = dst
+        self.triggers[i] = trigger
+        self.regions[i] = region
+        self.pos = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def entries(self, c: _Compiled) -> list[Transition]:
+        "Oldest first"
+        first = (self.pos - self.count) % self.size
+        order = [(first + i) % self.size for i in range(self.count)]
+        return [
+            Transition(
+                self.times[i],
+                c.states[self.src[i]].name,
+                c.states[self.dst[i]].name,
+                self.triggers[i],
+                self.regions[i],
+            )
+            for i in order
+        ]
+
+
+class StateStats:
+    "Counters for one state of one machine"
+
+    __slots__ = ("name", "entries", "time_in_state", "hook_calls", "hook_time", "max_hook_time")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.entries = 0
+        # Not counting the current visit, get_stats() adds that
+        self.time_in_state = 0.0
+        # Enter and exit functions, and subscribers, when run synchronously
+        self.hook_calls = 0
+        self.hook_time = 0.0
+        self.max_hook_time = 0.0
+
+    def record_hook(self, duration: float):
+        self.hook_calls += 1
+        self.hook_time += duration
+        if duration > self.max_hook_time:
+            self.max_hook_time = duration
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "entries": self.entries,
+            "time_in_state": self.time_in_state,
+            "hook_calls": self.hook_calls,
+            "hook_time": self.hook_time,
+            "max_hook_time": self.max_hook_time,
+            "avg_hook_time": self.hook_time / self.hook_calls if self.hook_calls else 0.0,
+        }
+
+
 class StateMachine:
-    def __init__(self, start="start"):
+    def __init__(
+        self,
+        start: str | None = None,
+        scheduler: scheduling.NewScheduler | None = None,
+        dispatch: str = "sync",
+        topic: str | None = None,
+        trace: int = 0,
+        stats: bool = False,
+        definition: MachineDefinition | None = None,
+    ):
         """
         Represents an State Machine or FSA
         Args:
-            start (str, optional): _description_. The initial state. Defaults to "start".
+            start (str, optional): _description_. The initial state.
+                Defaults to the definition's start state, or "start".
+            scheduler (NewScheduler, optional): Scheduler used for timers and polling.
+                Defaults to the global scheduler. Pass one with a virtual clock for testing.
+            dispatch (str, optional): How to run enter/exit hooks and subscribers.
+                "sync" runs them inside the transition, holding the machine's lock.
+                "workers" runs each one in the worker pool, in no particular order.
+                "ordered" runs them one at a time in the worker pool, in transition order.
+                With anything but sync, the transition is already complete when they run,
+                and errors are logged rather than raised.
+            topic (str, optional): If set, also post the new state to this message bus topic on every transition.
+            trace (int, optional): Keep this many recent transitions for trace(). Defaults to 0, off.
+            stats (bool, optional): Keep per state counters for get_stats(). Defaults to False.
+            definition (MachineDefinition, optional): Shared definition to use instead of
+                adding states one at a time. The machine is frozen from the start.
         """
+        if dispatch not in hook_dispatch_modes:
+            raise ValueError(f"dispatch must be one of {hook_dispatch_modes}")
+
+        self.scheduler = scheduler or scheduling.scheduler
+        self.clock = self.scheduler.clock
+
+        self._dispatch = dispatch
+        self._topic = topic
+        # Hooks waiting to run in ordered mode, and whether a worker is already draining them
+        if dispatch == "ordered":
+            self._hook_queue: collections.deque[tuple[Callable, tuple]] = collections.deque()
+            self._hook_lock = threading.Lock()
+            self._hook_draining = False
+
+        start = start or (definition.start if definition else "start")
 
         self.states = {}
         self.state = start
         self.prev_state = None
-        self.entered_state = time.time()
+        self.entered_state = self.clock.time()
+        # Timers use the monotonic clock so they don't care if the wall clock gets set
+        self._entered_monotonic = self.clock.monotonic()
+        # When we entered each level of the current state's path, for parent state timers
+        self._path_entered = [self._entered_monotonic]
         # Used to ensure that if one leaves and reenters a state just as a timer is firing it does not trigger anything.
         self._transiton_count = 0
         self.lock = threading.RLock()
 
-        # Subscribers, as lists of function weakrefs indexed by what state entrance they are subscribed to to
-        self._subscribers: dict[str, list[weakref.ref[Callable]]] = {}
+        # The timer is armed for _timer_deadline as of transition number _timer_count,
+        # and is stale if we have moved on since. _timer_queued is the soonest entry we have
+        # in the timer service, we only need a new one if the deadline gets earlier than that.
+        self._timer_deadline: float | None = None
+        self._timer_count = 0
+        self._timer_queued: float | None = None
+        self._weakref = weakref.ref(self)
+
+        # Subscribers, indexed by what state entrance they are subscribed to
+        self._subscribers: dict[str, util.WeakCallableSet] = {}
 
         # Used for skipping ahead to quickly test timers and things like that.
         self._time_offset = 0
 
-        self.add_state("__closed__")
-        # Placeholder state
-        self.add_state(start)
+        # Built from self.states on demand, and thrown away whenever they change.
+        self._compiled: _Compiled | None = None
+        self._state_index = 0
+        self._frozen = False
+
+        # Orthogonal regions besides the main one, which is the machine itself
+        self._regions: dict[str, _Region] = {}
+
+        # What caused the transition in progress, for the trace
+        self._trigger = "__goto__"
+        self._trace: _TransitionTrace | None = None
+        self._stats: dict[str, StateStats] | None = None
+        self._total_transitions = 0
+        if trace:
+            self.enable_trace(trace)
+        if stats:
+            self.enable_stats()
+
+        # Topics we watch for conditions, through the scheduler's shared input router,
+        # which only has weak refs to us.
+        self._input_topics: set[str] = set()
+
+        if definition:
+            # Everything is already built, nothing to do but find our place in it
+            self.states = definition.states
+            self._compiled = definition.compiled
+            self._frozen = True
+            self._state_index = self._compiled.index[start]
+            for name, state in definition.regions.items():
+                r = _Region(name, state, self.entered_state, self._entered_monotonic)
+                r._state_index = self._compiled.index[state]
+                self._regions[name] = r
+            for r in self._all_regions():
+                _fit_path(self._compiled, r)
+            router = _get_input_router(self.scheduler)
+            for i in definition.topics:
+                self._input_topics.add(i)
+                router.add(i, self)
+            # Unlike add_state, we know the start state is real, so its timers count from now
+            for r in self._all_regions():
+                self._arm_timer(r)
+            self._update_polling()
+        else:
+            self.add_state("__closed__")
+            # Placeholder state
+            self.add_state(start)
 
     def __call__(self, event):
         "Trigger an event, return the current state"
@@ -99,28 +775,24 @@ class StateMachine:
         return "<State machine at %d in state %s, entered %d ago>" % (
             id(self),
             self.state,
-            time.time() - self.entered_state,
+            self.clock.time() - self.entered_state,
         )
 
     def subscribe(self, f: Callable[[str], Any], state="__all__"):
         """Cause function f to be called when the machine enters the given state.
         If the state is __all__, causes
         f to be called whenever the state changes at all.
-        Uses weak refs, so you must maintain a reference to f
+        Uses weak refs, so you must maintain a reference to f.
+        Subscribing the same function twice to the same state does nothing.
 
         Args:
             f (_type_): The function
             state (str, optional): The specific state to subscribe to. Defaults to "__all__".
         """
         with self.lock:
-            # First clean up old subscribers. This is slow to do thi every time, but it should be infrequent.
-            for i in self._subscribers:
-                self._subscribers[i] = [i for i in self._subscribers[state] if i()]
-            self._subscribers = {i: self._subscribers[i] for i in self._subscribers if self._subscribers[i]}
-
             if state not in self._subscribers:
-                self._subscribers[state] = []
-            self._subscribers[state].append(util.universal_weakref(f))
+                self._subscribers[state] = util.WeakCallableSet()
+            self._subscribers[state].add(f)
 
     def unsubscribe(self, f: Callable[[str], Any], state="__all__"):
         """
@@ -130,20 +802,12 @@ class StateMachine:
             state (str, optional): The specific state to unsub to. Defaults to "__all__".
         """
         with self.lock:
-            for i in self._subscribers:
-                self._subscribers[i] = [i for i in self._subscribers[state] if i()]
-            self._subscribers = {i: self._subscribers[i] for i in self._subscribers if self._subscribers[i]}
-
-            torm = None
-            for i in self._subscribers[state]:
-                if i() == f:
-                    torm = i
-            if torm:
-                self._subscribers[state].remove(torm)
+            if state in self._subscribers:
+                self._subscribers[state].discard(f)
 
     @property
     def age(self):
-        return time.time() - self.entered_state
+        return self.clock.time() - self.entered_state
 
     @property
     def stateage(self) -> tuple[str, float]:
@@ -153,57 +817,192 @@ class StateMachine:
             tuple[str, float]: The state and age of the state in seconds
         """
         with self.lock:
-            return (self.state, time.time() - self.entered_state)
+            return (self.state, self.clock.time() - self.entered_state)
 
-    def _check_timer(self):
-        "Poll function for any timers on the state."
+    def enable_trace(self, size: int = 64):
+        "Start keeping the last size transitions, forgetting any already kept"
         with self.lock:
-            if self.states[self.state].get("timer"):
-                if ((time.time() + self._time_offset) - self.entered_state) > self.states[self.state]["timer"][0]:
-                    # Get the destination
-                    x = self.states[self.state]["timer"][1]
-
-                    # If it's a function, call it to get the actual destination.
-                    if isinstance(x, str):
-                        self._goto(x)
-                    else:
-                        x = x(self)
-                        if x:
-                            self._goto(x)
-                else:
-                    self._configure_timer()
+            self._trace = _TransitionTrace(size) if size else None
 
-    def _configure_timer(self):
-        "Sets up the timer. Needs to be called under lock"
+    def trace(self) -> list[Transition]:
+        "Recent transitions, oldest first. Empty if tracing is off."
+        with self.lock:
+            if not self._trace:
+                return []
+            return self._trace.entries(self._get_compiled())
 
-        if hasattr(self, "schedulerobj"):
-            self.schedulerobj.unregister()
-            del self.schedulerobj
+    def enable_stats(self):
+        "Start keeping per state counters, if not already"
+        with self.lock:
+            if self._stats is None:
+                self._stats = {}
+
+    def _state_stats(self, name: str) -> StateStats:
+        "Needs to be called under lock, with stats enabled"
+        assert self._stats is not None
+        x = self._stats.get(name)
+        if x is None:
+            x = self._stats[name] = StateStats(name)
+        return x
+
+    def get_stats(self) -> dict[str, Any]:
+        """Per state counters, see StateStats. Times are in seconds.
+        Empty if stats are off."""
+        with self.lock:
+            if self._stats is None:
+                return {}
+            states = {k: v.to_dict() for k, v in self._stats.items()}
+            now = self.clock.monotonic()
+            # Count the time so far in the states we are in now
+            for r in self._all_regions():
+                if r.state not in states:
+                    states[r.state] = StateStats(r.state).to_dict()
+                states[r.state]["time_in_state"] += now - r._entered_monotonic
+            return {"transitions": self._total_transitions, "states": states}
+
+    def reset_stats(self):
+        with self.lock:
+            if self._stats is not None:
+                self._stats = {}
+            self._total_transitions = 0
+
+    def _timed_hook(self, stats: StateStats, f: Callable, *args):
+        t = time.perf_counter()
+        try:
+            f(*args)
+        finally:
+            stats.record_hook(time.perf_counter() - t)
+
+    def freeze(self):
+        """Compile the states into a flat transition table and forbid any further changes.
+        Not required, but it makes the intent clear, and
+        stops accidental recompiles if anything modifies the machine later."""
+        with self.lock:
+            self._get_compiled()
+            self._frozen = True
 
-        # If for any reason we get here too early, let's just keep rescheduling
-        if self.states[self.state].get("timer"):
-            # If we haven't already passed the time of the timer
-            if ((time.time() + self._time_offset) - self.entered_state) < self.states[self.state]["timer"][0]:
-                f = makechecker(util.universal_weakref(self))
-                self.schedulerobj = scheduling.scheduler.schedule(f, time.time() + 0.08)
+    @property
+    def frozen(self) -> bool:
+        return self._frozen
+
+    def _modified(self):
+        "Call under lock whenever self.states changes"
+        if self._frozen:
+            raise RuntimeError("State machine is frozen and cannot be modified")
+        self._compiled = None
+
+    def _get_compiled(self) -> _Compiled:
+        "Needs to be called under lock"
+        c = self._compiled
+        if c is None:
+            c = _compile(self.states)
+            self._compiled = c
+            self._state_index = c.index[self.state]
+            for r in self._regions.values():
+                r._state_index = c.index[r.state]
+            for r in self._all_regions():
+                _fit_path(c, r)
+        return c
+
+    def _all_regions(self) -> list[StateMachine | _Region]:
+        return [self, *self._regions.values()]
+
+    def add_region(self, name: str, start: str):
+        """Add an orthogonal region, with its own current state, starting in start.
+        Every event goes to every region, and each region has its own timers and conditions,
+        but they all share the machine's states, rules, and lock.
+        The main region is the machine itself."""
+        for i in illegal_name_chars:
+            if i in name:
+                raise ValueError("Forbidden special character")
+        with self.lock:
+            if name in self._regions:
+                raise ValueError(f"Region {name} already exists")
+            self._modified()
+            self._regions[name] = _Region(name, start, self.clock.time(), self.clock.monotonic())
 
-                # Keep a ref so it doesn't get GCed
-                self.schedulerobj.func_ref = f  # type: ignore
+    @property
+    def regions(self) -> dict[str, str]:
+        "The current state of every extra region"
+        with self.lock:
+            return {k: v.state for k, v in self._regions.items()}
 
-            # If we have already passed that time, just do it now.
-            # This is here for faster response when skipping ahead.
-            else:
-                workers.do(self._check_timer)
+    def in_state(self, state: str, region: str | None = None) -> bool:
+        "True if the region is in the state or any child of it"
+        with self.lock:
+            c = self._get_compiled()
+            r = self._regions[region] if region else self
+            return c.index[state] in c.states[r._state_index].path
+
+    def _follow(self, dest, r: StateMachine | _Region | None = None):
+        """Go to a compiled destination: a state index, a state name, or
+        a function taking the machine and returning a state name or None.
+        Needs to be called under lock"""
+        if dest.__class__ is int:
+            self._goto_index(dest, r)
+        elif isinstance(dest, str):
+            self._goto(dest, r)
+        else:
+            x = dest(self)
+            if x:
+                self._goto(x, r)
+
+    def _check_timer(self, r: StateMachine | _Region | None = None):
+        "Poll function for any timers on the state."
+        r = r or self
+        with self.lock:
+            now = self.clock.monotonic() + r._time_offset
+            for depth, duration, dest in self._get_compiled().states[r._state_index].timers:
+                # Outermost first, a parent's timer takes us out of all its children
+                if now - r._path_entered[depth] >= duration:
+                    self._trigger = "__timer__"
+                    self._follow(dest, r)
+                    return
+            self._arm_timer(r)
+
+    def _arm_timer(self, r: StateMachine | _Region | None = None):
+        "Sets up the timer for the current state. Needs to be called under lock"
+        r = r or self
+        timers = self._get_compiled().states[r._state_index].timers
+        if not timers:
+            r._timer_deadline = None
+            return
+
+        if len(timers) == 1:
+            r._timer_deadline = r._path_entered[timers[0][0]] + timers[0][1] - r._time_offset
+        else:
+            r._timer_deadline = min(r._path_entered[depth] + duration for depth, duration, dest in timers) - r._time_offset
+        r._timer_count = r._transiton_count
+
+        # Anything already queued that comes due before the new deadline will just requeue us when it fires.
+        if r._timer_queued is None or r._timer_deadline < r._timer_queued:
+            r._timer_queued = r._timer_deadline
+            key = None if r is self else r.name
+            _get_timer_service(self.scheduler).push(self._weakref, key, r._timer_deadline)
+
+    def _on_timer(self, key: Any, deadline: float):
+        "Called by the timer service when one of our entries comes due. key is the region name, or None for the main one."
+        with self.lock:
+            r = self._regions.get(key) if key else self
+            if r is None:
+                return
+            if r._timer_queued == deadline:
+                r._timer_queued = None
+            if r._timer_deadline is None or not r._timer_count == r._transiton_count:
+                return
+            # Either it's time, or the deadline moved later and _check_timer will requeue us.
+            self._check_timer(r)
 
-    def seek(self, t, condition=None):
+    def seek(self, t, condition=None, region: str | None = None):
         """
         Seek ahead to a given position in the curren state's timeline, but only if the"""
         with self.lock:
-            if condition and (not condition == self.state):
+            r = self._regions[region] if region else self
+            if condition and (not condition == r.state):
                 return
-            pos = time.time() - self.entered_state
-            self._time_offset = t - pos
-            self._configure_timer()
+            pos = self.clock.monotonic() - r._entered_monotonic
+            r._time_offset = t - pos
+            self._arm_timer(r)
 
     @validate_call
     def add_state(
@@ -212,17 +1011,25 @@ class StateMachine:
         rules: None | dict[str, str | Callable[[], str | None]] = None,
         enter: str | Callable | None = None,
         exit: str | Callable | None = None,
+        parent: str | None = None,
+        initial: str | None = None,
     ):
         """
         Create a new state.  Keys in rules must be event names,
         and values must be either state names or callables that return
         either a state name to go to, or None for no transition.
 
+        A state with a parent is a substate, and uses the parent's rules, conditions and timers
+        for anything it doesn't have itself. The parent is entered first and exited last,
+        and stays entered while moving between its children.
+
         Args:
             name (str): Name of the state. May not contain anything in illegal_name_chars
             rules (dict, optional): Dict of rules for the state
             enter (str | Callable | None, optional): Function to be called when entering
             exit (str | Callable | None, optional): Function to be called when exiting
+            parent (str | None, optional): Parent state, which must exist by the time the machine is used
+            initial (str | None, optional): Child state to go to instead, whenever something goes to this state
 
         Raises:
             ValueError: _description_
@@ -231,11 +1038,15 @@ class StateMachine:
             if i in name:
                 raise ValueError("Forbidden special character")
         with self.lock:
+            self._modified()
             self.states[name] = {
                 "rules": rules or {},
                 "enter": enter,
                 "exit": exit,
                 "conditions": [],
+                "watched": [],
+                "parent": parent,
+                "initial": initial,
             }
 
     def set_timer(self, state: str, time: float | int, dest: str | Callable):
@@ -249,13 +1060,14 @@ class StateMachine:
         """
         with self.lock:
             if dest:
+                self._modified()
                 self.states[state]["timer"] = [time, dest]
 
     def remove_state(self, name):
         raise RuntimeError("Not supported now")
 
     @validate_call
-    def add_rule(self, start: str, event: str | Callable, to: str | Callable):
+    def add_rule(self, start: str, event: str | Callable, to: str | Callable, topics: list[str] | None = None):
         """
         Add a rule to handle what should happen if event occurs while the machine is in state.
         The third parameter representing the destination state may also be a function.
@@ -263,20 +1075,38 @@ class StateMachine:
         The function must take one parameter, the machine itself,
         and return either None for no Transiton or a string representing the new state.
         This lets you implement conditions and branchingself.
+
+        If event is a function taking no arguments, it is a condition, and we go to the destination when
+        it returns True. Conditions are polled at 24Hz, unless you list the message bus topics
+        that they depend on. Then they are only checked on entering the state and when a message arrives.
+        Anything else that can change the inputs can also just call check().
         """
         with self.lock:
+            self._modified()
             if isinstance(event, str):
+                if topics:
+                    raise ValueError("Topics only apply to condition rules")
                 self.states[start]["rules"][event] = to
             elif callable(event):
-                self.states[start]["conditions"].append((event, to))
-                self._setupPolling()
+                if topics:
+                    self.states[start]["watched"].append((event, to, topics))
+                    for i in topics:
+                        if i not in self._input_topics:
+                            self._input_topics.add(i)
+                            _get_input_router(self.scheduler).add(i, self)
+                else:
+                    self.states[start]["conditions"].append((event, to))
+                self._update_polling()
 
     def del_rule(self, start, event):
         with self.lock:
-            if event in self.states[start]["rules"]:
-                del self.states[start]["rules"][event]
-            elif event in self.states[start]["conditions"]:
-                del self.states[start]["conditions"][event]
+            self._modified()
+            s = self.states[start]
+            if event in s["rules"]:
+                del s["rules"][event]
+            elif any(i[0] == event for i in s["conditions"] + s["watched"]):
+                s["conditions"] = [i for i in s["conditions"] if not i[0] == event]
+                s["watched"] = [i for i in s["watched"] if not i[0] == event]
             else:
                 raise KeyError("No such rule")
 
@@ -284,130 +1114,751 @@ class StateMachine:
         """Tell the machine that a specific event just occurred. If there is a matching Transiton rule for that event,
         then we do the current state's exit func, enter the new state, and do it's enter func"""
         with self.lock:
-            if self.state not in self.states:
-                return self.state
-
-            s = self.states[self.state]
-
-            if event in s["rules"]:
-                x = s["rules"][event]
-                # If the rule destination is a string, just use it. If it is not a string, then
-                # It must be a function because those are the only two valid destination types.
-
-                # If it's a function, call it to get the actual destination.
-                if isinstance(x, str):
-                    self._goto(x)
-                else:
-                    x = x(self)
-                    if x:
-                        self._goto(x)
-            return self.event
+            # One dict lookup and one index, no matter how many states or rules there are.
+            col = (self._compiled or self._get_compiled()).table.get(event)
+            if col is not None:
+                self._trigger = event
+                dest = col[self._state_index]
+                if dest is not None:
+                    self._follow(dest)
+                if self._regions:
+                    for r in self._regions.values():
+                        dest = col[r._state_index]
+                        if dest is not None:
+                            self._follow(dest, r)
+            return self.state
 
     def check(self):
         "Check the function based condition rules"
         with self.lock:
-            s = self.states.get(self.state, None)
-            if s:
+            c = self._get_compiled()
+            for r in self._all_regions():
+                s = c.states[r._state_index]
                 # Check all the function rules, poll them all,
                 # and should any happen to be true, we follow that rule
                 # Like any other.
-                for i in s["conditions"]:
+                for i in s.conditions + s.watched:
                     if i[0]():
-                        self._goto(i[1])
+                        self._trigger = "__condition__"
+                        self._follow(i[1], r)
+                        break
+
+    def _on_input(self):
+        "Called when a message arrives on any topic that a watched condition depends on"
+        with self.lock:
+            c = self._get_compiled()
+            for r in self._all_regions():
+                for i in c.states[r._state_index].watched:
+                    if i[0]():
+                        self._trigger = "__condition__"
+                        self._follow(i[1], r)
+                        break
 
     def jump(self, state, condition=None):
         self.goto(state, condition)
 
-    def goto(self, state, condition: str | None = None):
+    def goto(self, state, condition: str | None = None, region: str | None = None):
         """
         Jump to a specified state. If condition is not None,
         only jump if condition it matches the current state."
         """
         with self.lock:
-            if condition and not self.state == condition:
+            r = self._regions[region] if region else self
+            if condition and not r.state == condition:
                 return
-            self._goto(state)
+            self._trigger = "__goto__"
+            self._goto(state, r)
+
+    def _snapshot_region(self, r: StateMachine | _Region) -> dict[str, Any]:
+        "Needs to be called under lock"
+        now = self.clock.monotonic() + r._time_offset
+        timers = self._get_compiled().states[r._state_index].timers
+        return {
+            "state": r.state,
+            "prev_state": r.prev_state,
+            "entered_state": r.entered_state,
+            "position": now - r._entered_monotonic,
+            # How long we have been in each parent, outermost first
+            "path_positions": [now - i for i in r._path_entered],
+            "timer_remaining": max(0.0, min(r._path_entered[d] + t - now for d, t, dest in timers)) if timers else None,
+        }
+
+    def snapshot(self) -> dict[str, Any]:
+        """Get the machine's state as a JSON compatible dict, for restore() to pick up
+        where it left off, even in another process.
+        position is how far into the current state's timeline we are, counting any seek()."""
+        with self.lock:
+            snapshot = self._snapshot_region(self)
+            snapshot["time"] = self.clock.time()
+            if self._regions:
+                snapshot["regions"] = {k: self._snapshot_region(v) for k, v in self._regions.items()}
+            return snapshot
+
+    def _restore_region(self, r: StateMachine | _Region, snapshot: dict[str, Any], extra: float, catch_up: bool):
+        "Needs to be called under lock"
+        c = self._get_compiled()
+        index = c.index[snapshot["state"]]
+        position = snapshot["position"] + extra
+        now = self.clock.monotonic()
+
+        path_positions = snapshot.get("path_positions", [])
+        if not len(path_positions) == len(c.states[index].path):
+            # The hierarchy changed, just pretend we entered everything at once
+            path_positions = [snapshot["position"]] * len(c.states[index].path)
+
+        r.prev_state = snapshot.get("prev_state")
+        r.state = snapshot["state"]
+        r._state_index = index
+        r.entered_state = snapshot["entered_state"] if catch_up else self.clock.time() - position
+        r._entered_monotonic = now - position
+        r._path_entered = [now - i - extra for i in path_positions]
+        r._time_offset = 0
+        r._transiton_count = (r._transiton_count + 1) % 2**64
+        self._arm_timer(r)
+
+        if c.states[index].watched:
+            self.scheduler.do(self._on_input)
+
+    def restore(self, snapshot: dict[str, Any], catch_up: bool = True):
+        """Go back to the state in a snapshot, without running any exit or enter functions.
+        If catch_up is True, time that passed since the snapshot counts towards the timer,
+        so a timer that should have gone off while we were down goes off right away.
+        Regions in the snapshot that the machine doesn't have are ignored."""
+        with self.lock:
+            extra = max(0.0, self.clock.time() - snapshot["time"]) if catch_up else 0.0
+            self._restore_region(self, snapshot, extra, catch_up)
+            for k, v in snapshot.get("regions", {}).items():
+                if k in self._regions:
+                    self._restore_region(self._regions[k], v, extra, catch_up)
+            self._update_polling()
 
     def close(self):
         """Stop any timers and go to the special state __closed__
         Do not use object after this.
         """
         self.goto("__closed__")
-        if hasattr(self, "schedulerobj"):
-            try:
-                self.schedulerobj.unregister()
-                del self.schedulerobj
-            except Exception:
-                pass
+        self._timer_deadline = None
+        for r in list(self._regions):
+            self.goto("__closed__", region=r)
+            self._regions[r]._timer_deadline = None
+
+        try:
+            _get_poller(self.scheduler).discard(self)
+        except Exception:
+            pass
 
-        if hasattr(self, "pollingscheduledfunction"):
+        for i in self._input_topics:
             try:
-                if self.pollingscheduledfunction:
-                    self.pollingscheduledfunction.unregister()
-                del self.pollingscheduledfunction
+                _get_input_router(self.scheduler).discard(i, self)
             except Exception:
                 pass
+        self._input_topics.clear()
 
     def __del__(self):
         self.close()
 
-    def _setupPolling(self):
-        "Start polling the function based events, if there are any to poll for"
-        if hasattr(self, "pollingscheduledfunction"):
-            if self.pollingscheduledfunction:
-                self.pollingscheduledfunction.unregister()
-            del self.pollingscheduledfunction
+    def _update_polling(self):
+        "Join or leave the shared poller depending on whether the current state has polled conditions"
+        c = self._get_compiled()
+        if any(c.states[r._state_index].conditions for r in self._all_regions()):
+            _get_poller(self.scheduler).add(self)
+        else:
+            _get_poller(self.scheduler).discard(self)
 
-        if self.states[self.state].get("conditions"):
-            self.pollingscheduledfunction = scheduling.scheduler.every(self.check, 1 / 24)
-
-    def _goto(self, state):
+    def _goto(self, state, r: StateMachine | _Region | None = None):
         "Must be called under the lock"
+        self._goto_index(self._get_compiled().index[state], r)
+
+    def _dispatch_hooks(self, batch: list[tuple[Callable, tuple]]):
+        """Send off all the hooks and subscribers from one transition as one job.
+        Only used when dispatch is not sync."""
+        if self._dispatch == "workers":
+            self.scheduler.do(lambda: _run_hooks(batch))
+        else:
+            with self._hook_lock:
+                self._hook_queue.extend(batch)
+                if self._hook_draining:
+                    return
+                self._hook_draining = True
+            self.scheduler.do(self._drain_hooks)
+
+    def _drain_hooks(self):
+        "Run queued hooks in order. Only one of these runs at a time per machine, and never under the machine lock."
+        while True:
+            with self._hook_lock:
+                if not self._hook_queue:
+                    self._hook_draining = False
+                    return
+                f, args = self._hook_queue.popleft()
+            try:
+                f(*args)
+            except Exception:
+                logging.exception(f"Error in state machine hook {f}")
 
-        s = self.states[self.state]
-        s2 = self.states[state]
+    def _goto_index(self, index: int, r: StateMachine | _Region | None = None):
+        "Must be called under the lock"
+        r = r or self
+        c = self._compiled or self._get_compiled()
+        if c.states[index].initial is not None:
+            index = c.states[index].initial  # type: ignore[assignment]
+        s = c.states[r._state_index]
+        s2 = c.states[index]
+        state = s2.name
+
+        if s.nested or s2.nested:
+            exits, enters, kept = _transition_path(c, s.index, index)
+        else:
+            # Flat machines don't need to look at the hierarchy at all
+            exits, enters, kept = (s,), (s2,), 0
+
+        # In sync mode hooks run right here, otherwise they are collected and sent off at the end
+        batch: list[tuple[Callable, tuple]] | None = None if self._dispatch == "sync" else []
+        stats = self._stats
+
+        # Do the old state's exit functions, innermost first
+        for x in exits:
+            if x.exit:
+                if batch is not None:
+                    batch.append((x.exit, ()))
+                elif stats is None:
+                    x.exit()
+                else:
+                    self._timed_hook(self._state_stats(x.name), x.exit)
 
-        # Do the old state's exit function
-        if s["exit"]:
-            s["exit"]()
+        now = self.clock.monotonic()
+        if stats is not None:
+            self._total_transitions += 1
+            self._state_stats(state).entries += 1
+            self._state_stats(s.name).time_in_state += now - r._entered_monotonic
 
-        self.prev_state = self.state
-        self.state = state
+        r.prev_state = r.state
+        r.state = state
+        r._state_index = index
         # Record the time that we entered the new state
-        self.entered_state = time.time()
-        self._configure_timer()
+        r.entered_state = self.clock.time()
+        if self._trace:
+            self._trace.record(r.entered_state, s.index, index, self._trigger, None if r is self else r.name)  # type: ignore[union-attr]
+        r._entered_monotonic = now
+        # Parents we stayed in keep their entry times
+        r._path_entered = r._path_entered[:kept] + [now] * len(enters)
+        r._time_offset = 0
 
-        self._time_offset = 0
+        # Increment the trans count. wrap at 2**64
+        # This alone makes any timer from the old state stale.
+        r._transiton_count = (r._transiton_count + 1) % 2**64
+
+        if s2.timers:
+            self._arm_timer(r)
+
+        if s2.conditions or s.conditions:
+            self._update_polling()
+
+        # Do the entrance functions of the new state, outermost first
+        for x in enters:
+            if x.enter:
+                if batch is not None:
+                    batch.append((x.enter, ()))
+                elif stats is None:
+                    x.enter()
+                else:
+                    self._timed_hook(self._state_stats(x.name), x.enter)
 
-        if hasattr(self, "schedulerobj"):
-            self.schedulerobj.unregister()
-            del self.schedulerobj
+        # Handle the subscribers, for every state we entered
+        if self._subscribers:
+            for key in [x.name for x in enters] + ["__all__"]:
+                if key in self._subscribers:
+                    for f in self._subscribers[key]:
+                        if batch is not None:
+                            batch.append((f, (state,)))
+                        elif stats is None:
+                            runSubscriber(f, state)
+                        else:
+                            self._timed_hook(self._state_stats(state), f, state)
 
-        if self.states[self.state].get("timer"):
-            f = makechecker(util.universal_weakref(self))
-            self.schedulerobj = scheduling.scheduler.schedule(f, time.time() + self.states[self.state].get("timer")[0])
+        if batch:
+            self._dispatch_hooks(batch)
 
-            # Keep a strong reference
-            self.schedulerobj.func_ref = f  # type: ignore
+        if self._topic:
+            messagebus.post_message(self._topic, state)
 
-        self._setupPolling()
+        # The inputs may already be true, but don't recurse into another transition from in here
+        if s2.watched:
+            self.scheduler.do(self._on_input)
 
-        # Do the entrance function of the new state
-        if s2["enter"]:
-            s2["enter"]()
 
-        # Handle the subscribers
-        if state in self._subscribers:
-            for i in self._subscribers[state]:
-                x = i()
-                if x:
-                    runSubscriber(x, self.state)
+class GroupMember:
+    "A view of one member of a StateMachineGroup, with the same basic interface as a StateMachine"
+
+    __slots__ = ("group", "index")
+
+    def __init__(self, group: StateMachineGroup, index: int):
+        self.group = group
+        self.index = index
+
+    def __repr__(self):
+        return f"<Member {self.index} of {self.group} in state {self.state}>"
+
+    def __call__(self, event):
+        return self.event(event)
+
+    @property
+    def state(self) -> str:
+        return self.group.state_of(self.index)
+
+    @property
+    def prev_state(self) -> str | None:
+        p = self.group._prev[self.index]
+        return self.group._compiled.states[p].name if p >= 0 else None
+
+    @property
+    def age(self) -> float:
+        return self.group.clock.time() - self.group._entered_wall[self.index]
+
+    @property
+    def stateage(self) -> tuple[str, float]:
+        with self.group.lock:
+            return (self.state, self.age)
+
+    def event(self, event: str) -> str:
+        self.group.event(event, mask=[self.index])
+        return self.state
+
+    def goto(self, state: str, condition: str | None = None):
+        self.group.goto(state, mask=[self.index], condition=condition)
+
+
+class StateMachineGroup:
+    """Many machines sharing one frozen definition, with per member state
+    held in flat arrays, so that events and queries work on the whole group at once
+    instead of taking a lock per machine.
+
+    Members are numbered from 0 and never removed. Enter and exit hooks run once per member
+    that transitions, as they would for separate machines. Destination functions get a GroupMember.
+    Subscribers are per group, and get a list of member indexes along with the new state.
+
+    Substates inherit their parents' rules and conditions, but only a state's own timer applies.
+    Definitions with extra regions are not supported.
+    """
+
+    def __init__(
+        self,
+        definition: StateMachine | MachineDefinition,
+        size: int = 0,
+        start: str | None = None,
+        scheduler: scheduling.NewScheduler | None = None,
+    ):
+        """
+        Args:
+            definition (StateMachine | MachineDefinition): Definition to use, or machine to
+                take the states, rules, timers and conditions from. A machine gets frozen,
+                and its own state doesn't matter.
+            size (int, optional): Number of members to start with. Defaults to 0.
+            start (str, optional): State new members start in. Defaults to the definition's current state.
+            scheduler (NewScheduler, optional): Scheduler used for timers and polling.
+                Defaults to the definition machine's scheduler, or the global one.
+        """
+        if isinstance(definition, MachineDefinition):
+            if definition.regions:
+                raise ValueError("State machine groups don't support regions")
+            self.scheduler = scheduler or scheduling.scheduler
+            self._compiled = definition.compiled
+            start = start or definition.start
+            topics = set(definition.topics)
+        else:
+            if definition._regions:
+                raise ValueError("State machine groups don't support regions")
+            definition.freeze()
+            self.scheduler = scheduler or definition.scheduler
+            self._compiled = definition._get_compiled()
+            start = start or definition.state
+            topics = set(definition._input_topics)
+
+        self.definition = definition
+        self.clock = self.scheduler.clock
+        self.lock = threading.RLock()
+        self._start = self._compiled.index[start]
+
+        # One slot per member
+        self._states = array.array("i")
+        self._prev = array.array("i")
+        self._entered_wall = array.array("d")
+        self._entered_monotonic = array.array("d")
+        # Timer entries from before the member's last transition are stale
+        self._transition_counts = array.array("Q")
+        # Bumped by restore(), which starts the counts over
+        self._epoch = 0
+
+        # Number of members in each state, so we can skip states nobody is in
+        self._occupancy = [0] * len(self._compiled.states)
+
+        self._subscribers: dict[str, util.WeakCallableSet] = {}
+        self._weakref = weakref.ref(self)
+
+        self._input_topics = topics
+        for i in self._input_topics:
+            _get_input_router(self.scheduler).add(i, self)
+
+        if any(i.conditions for i in self._compiled.states):
+            _get_poller(self.scheduler).add(self)  # type: ignore[arg-type]
 
-        if "__all__" in self._subscribers:
-            for i in self._subscribers["__all__"]:
-                x = i()
+        self.add(size)
+
+    def __repr__(self):
+        return f"<State machine group at {id(self)} with {len(self)} members>"
+
+    def __len__(self):
+        return len(self._states)
+
+    def __getitem__(self, index: int) -> GroupMember:
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        return GroupMember(self, index % len(self))
+
+    def add(self, n: int = 1, state: str | None = None) -> range:
+        """Add n members in the given state, or the start state. Returns their indexes.
+        Timers for the state start now, enter functions are not called."""
+        with self.lock:
+            s = self._compiled.index[state] if state else self._start
+            first = len(self._states)
+            now_wall = self.clock.time()
+            now = self.clock.monotonic()
+
+            self._states.extend(array.array("i", [s]) * n)
+            self._prev.extend(array.array("i", [-1]) * n)
+            self._entered_wall.extend(array.array("d", [now_wall]) * n)
+            self._entered_monotonic.extend(array.array("d", [now]) * n)
+            self._transition_counts.extend(array.array("Q", [0]) * n)
+            self._occupancy[s] += n
+
+            members = range(first, first + n)
+            if n:
+                self._arm_timers(s, members, now)
+            return members
+
+    def state_of(self, index: int) -> str:
+        return self._compiled.states[self._states[index]].name
+
+    def subscribe(self, f: Callable[[list[int], str], Any], state="__all__"):
+        """Cause f(members, state) to be called whenever members enter the given state,
+        or any state if __all__. Called once per batch of members, not once per member.
+        Uses weak refs, so you must maintain a reference to f"""
+        with self.lock:
+            if state not in self._subscribers:
+                self._subscribers[state] = util.WeakCallableSet()
+            self._subscribers[state].add(f)
+
+    def unsubscribe(self, f: Callable[[list[int], str], Any], state="__all__"):
+        with self.lock:
+            if state in self._subscribers:
+                self._subscribers[state].discard(f)
+
+    def _select(self, mask) -> Iterable[int]:
+        "Member indexes selected by a mask"
+        if mask is None:
+            return range(len(self._states))
+        mask = list(mask)
+        if mask and mask[0].__class__ is bool:
+            if not len(mask) == len(self._states):
+                raise ValueError("Boolean mask must have one entry per member")
+            return [i for i, m in enumerate(mask) if m]
+        # Moving a member twice would throw off the occupancy counts
+        return dict.fromkeys(mask)
+
+    def event(self, event: str, mask: Iterable[int] | Iterable[bool] | None = None) -> int:
+        """Send an event to every member, or just the ones selected by mask.
+        mask may be a list of bools with one per member, or any iterable of member indexes.
+        Returns the number of members that changed state."""
+        with self.lock:
+            col = self._compiled.table.get(event)
+            if col is None:
+                return 0
+
+            # Sort members by which state they are in, skipping states with no rule for this event
+            by_state: dict[int, list[int]] = {s: [] for s, d in enumerate(col) if d is not None and self._occupancy[s]}
+            if not by_state:
+                return 0
+
+            states = self._states
+            if mask is None and len(by_state) == 1:
+                # One state to look for, let array.index do the scanning
+                (s,) = by_state
+                found = by_state[s]
+                start = 0
+                try:
+                    for _ in range(self._occupancy[s]):
+                        start = states.index(s, start) + 1
+                        found.append(start - 1)
+                except ValueError:
+                    pass
+            else:
+                for i in self._select(mask):
+                    x = by_state.get(states[i])
+                    if x is not None:
+                        x.append(i)
+
+            moved = 0
+            for s, members in by_state.items():
+                if members:
+                    moved += self._follow(s, members, col[s])
+            return moved
+
+    def goto(self, state: str, mask: Iterable[int] | Iterable[bool] | None = None, condition: str | None = None) -> int:
+        """Move members straight to a state. If condition is not None,
+        only move members that are currently in that state. Returns the number moved."""
+        with self.lock:
+            dest = self._compiled.index[state]
+            by_state: dict[int, list[int]] = {}
+            for i in self._select(mask):
+                by_state.setdefault(self._states[i], []).append(i)
+            moved = 0
+            for s, m in by_state.items():
+                if condition is None or self._compiled.states[s].name == condition:
+                    moved += self._move(s, m, dest)
+            return moved
+
+    def _follow(self, src: int, members: list[int], dest) -> int:
+        "Like StateMachine._follow, for all members in state src. Needs to be called under lock"
+        if dest.__class__ is int:
+            return self._move(src, members, dest)
+        elif isinstance(dest, str):
+            return self._move(src, members, self._compiled.index[dest])
+        else:
+            # Functions decide for each member separately
+            by_dest: dict[str, list[int]] = {}
+            for i in members:
+                x = dest(GroupMember(self, i))
                 if x:
-                    runSubscriber(x, self.state)
+                    by_dest.setdefault(x, []).append(i)
+            return sum(self._move(src, m, self._compiled.index[d]) for d, m in by_dest.items())
+
+    def _move(self, src: int, members: list[int], dest: int) -> int:
+        "Move members that are all in state src to dest. Needs to be called under lock"
+        c = self._compiled
+        if c.states[dest].initial is not None:
+            dest = c.states[dest].initial  # type: ignore[assignment]
+        s2 = c.states[dest]
+        exits, enters, kept = _transition_path(c, src, dest)
+
+        for x in exits:
+            if x.exit:
+                for i in members:
+                    x.exit()
+
+        now_wall = self.clock.time()
+        now = self.clock.monotonic()
+        states = self._states
+        prev = self._prev
+        entered_wall = self._entered_wall
+        entered_monotonic = self._entered_monotonic
+        counts = self._transition_counts
+
+        for i in members:
+            states[i] = dest
+            prev[i] = src
+            entered_wall[i] = now_wall
+            entered_monotonic[i] = now
+            counts[i] = (counts[i] + 1) % 2**64
+
+        self._occupancy[src] -= len(members)
+        self._occupancy[dest] += len(members)
+
+        if s2.timer:
+            self._arm_timers(dest, members, now)
+
+        for x in enters:
+            if x.enter:
+                for i in members:
+                    x.enter()
+
+        for key in [x.name for x in enters] + ["__all__"]:
+            for f in self._subscribers.get(key, ()):
+                f(list(members), s2.name)
+
+        if s2.watched:
+            self.scheduler.do(self._on_input)
+
+        return len(members)
+
+    def _arm_timers(self, state: int, members: Iterable[int], entered: float):
+        "One timer service entry covers every member that entered state at the same moment"
+        timer = self._compiled.states[state].timer
+        if timer:
+            counts = self._transition_counts
+            key = (self._epoch, state, [(i, counts[i]) for i in members])
+            _get_timer_service(self.scheduler).push(self._weakref, key, entered + timer[0])
+
+    def _on_timer(self, key: tuple[int, int, list[tuple[int, int]]], deadline: float):
+        "Called by the timer service when a batch of member timers comes due"
+        epoch, state, entries = key
+        with self.lock:
+            if not epoch == self._epoch:
+                return
+            counts = self._transition_counts
+            live = [i for i, n in entries if counts[i] == n]
+            if live:
+                self._follow(state, live, self._compiled.states[state].timer[1])  # type: ignore[index]
+
+    def _check_conditions(self, watched: bool):
+        "Needs to be called under lock"
+        # Decide everything first, so members only take one step per check, like separate machines would
+        fired: dict[int, Any] = {}
+        for s in self._compiled.states:
+            conditions = s.watched if watched else s.conditions + s.watched
+            if conditions and self._occupancy[s.index]:
+                for f, dest in conditions:
+                    if f():
+                        fired[s.index] = dest
+                        break
+        if not fired:
+            return
+
+        members: dict[int, list[int]] = {i: [] for i in fired}
+        for i, x in enumerate(self._states):
+            if x in members:
+                members[x].append(i)
+        for i, dest in fired.items():
+            self._follow(i, members[i], dest)
 
-        # Increment the trans count. wrap at 2**64
-        self._transiton_count = (self._transiton_count + 1) % 2**64
+    def check(self):
+        "Check the function based condition rules for every occupied state"
+        with self.lock:
+            self._check_conditions(False)
+
+    def _on_input(self):
+        with self.lock:
+            self._check_conditions(True)
+
+    def in_state(self, state: str) -> list[int]:
+        "Indexes of all members in a state"
+        with self.lock:
+            s = self._compiled.index[state]
+            return [i for i, x in enumerate(self._states) if x == s]
+
+    def counts(self) -> dict[str, int]:
+        "Number of members in each state, leaving out empty states"
+        with self.lock:
+            return {s.name: self._occupancy[s.index] for s in self._compiled.states if self._occupancy[s.index]}
+
+    def older_than(self, seconds: float, state: str | None = None) -> list[int]:
+        "Indexes of members that have been in their current state, or the given state, at least this long"
+        with self.lock:
+            cutoff = self.clock.monotonic() - seconds
+            if state is None:
+                return [i for i, t in enumerate(self._entered_monotonic) if t <= cutoff]
+            s = self._compiled.index[state]
+            states = self._states
+            return [i for i, t in enumerate(self._entered_monotonic) if t <= cutoff and states[i] == s]
+
+    def snapshot(self) -> dict[str, Any]:
+        "Like StateMachine.snapshot, but with one list entry per member"
+        with self.lock:
+            now = self.clock.monotonic()
+            names = [i.name for i in self._compiled.states]
+            return {
+                "states": [names[i] for i in self._states],
+                "prev_states": [names[i] if i >= 0 else None for i in self._prev],
+                "entered_state": list(self._entered_wall),
+                "position": [now - i for i in self._entered_monotonic],
+                "time": self.clock.time(),
+            }
+
+    def restore(self, snapshot: dict[str, Any], catch_up: bool = True):
+        """Replace every member with the ones in the snapshot, see StateMachine.restore.
+        The group ends up with as many members as the snapshot had."""
+        with self.lock:
+            index = self._compiled.index
+            extra = max(0.0, self.clock.time() - snapshot["time"]) if catch_up else 0.0
+            now = self.clock.monotonic()
+            now_wall = self.clock.time()
+            positions = [i + extra for i in snapshot["position"]]
+
+            self._states = array.array("i", [index[i] for i in snapshot["states"]])
+            self._prev = array.array("i", [index[i] if i else -1 for i in snapshot["prev_states"]])
+            if catch_up:
+                self._entered_wall = array.array("d", snapshot["entered_state"])
+            else:
+                self._entered_wall = array.array("d", [now_wall - i for i in positions])
+            self._entered_monotonic = array.array("d", [now - i for i in positions])
+            # Fresh counts in a new epoch, so that every timer queued before now is stale
+            self._transition_counts = array.array("Q", [0]) * len(self._states)
+            self._epoch += 1
+
+            self._occupancy = [0] * len(self._compiled.states)
+            by_state: dict[int, list[int]] = {}
+            for i, x in enumerate(self._states):
+                self._occupancy[x] += 1
+                by_state.setdefault(x, []).append(i)
+
+            for x, members in by_state.items():
+                if self._compiled.states[x].timer:
+                    # Members that entered at different times need their own entries
+                    by_time: dict[float, list[int]] = {}
+                    for i in members:
+                        by_time.setdefault(self._entered_monotonic[i], []).append(i)
+                    for t, m in by_time.items():
+                        self._arm_timers(x, m, t)
+
+            if any(self._compiled.states[x].watched for x in by_state):
+                self.scheduler.do(self._on_input)
+
+    def close(self):
+        "Stop polling and listening for inputs. Timers that are already queued just go stale."
+        try:
+            _get_poller(self.scheduler).discard(self)  # type: ignore[arg-type]
+        except Exception:
+            pass
+        for i in self._input_topics:
+            try:
+                _get_input_router(self.scheduler).discard(i, self)
+            except Exception:
+                pass
+        self._input_topics.clear()
+        # Moving everyone makes any queued timers stale
+        self.goto("__closed__")
+
+
+def checkpoint(machines: dict[str, StateMachine | StateMachineGroup], fn: str, **kwargs):
+    """Save snapshots of many machines and groups to one file with scullery.persist,
+    so a whole fleet is one write. Extra keyword args go to persist.save."""
+    data = {
+        "time": time.time(),
+        "machines": {k: v.snapshot() for k, v in list(machines.items())},
+    }
+    persist.save(data, fn, **kwargs)
+
+
+def restore_checkpoint(machines: dict[str, StateMachine | StateMachineGroup], fn: str, catch_up: bool = True) -> list[str]:
+    """Restore machines and groups from a file written by checkpoint().
+    Machines not in the file are left alone, and so are any that can't be
+    restored because their definition changed, which is logged.
+    Returns the names of the ones that were restored, which is none if the file doesn't exist yet."""
+    try:
+        data = persist.load(fn)
+    except FileNotFoundError:
+        return []
+    restored = []
+    for k, v in data["machines"].items():
+        if k in machines:
+            try:
+                machines[k].restore(v, catch_up=catch_up)
+                restored.append(k)
+            except Exception:
+                logging.exception(f"Could not restore state machine {k}")
+    return restored
+
+
+def checkpoint_every(
+    machines: dict[str, StateMachine | StateMachineGroup],
+    fn: str,
+    interval: float,
+    scheduler: scheduling.NewScheduler | None = None,
+    **kwargs,
+) -> scheduling.WrappedFunction:
+    """Call checkpoint() on a repeating schedule. Keep a reference to the return value,
+    and call unregister() on it to stop.
+    machines is read fresh every time, so you can add to it as you go."""
+
+    def f():
+        checkpoint(machines, fn, **kwargs)
+
+    return (scheduler or scheduling.scheduler).every(f, interval)
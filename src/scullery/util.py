@@ -51,6 +51,59 @@ def universal_weakref(f: T, cb=None) -> weakref.ref[T]:
         return weakref.ref(f, cb)
 
 
+def _callable_key(f) -> object:
+    "Something hashable that is equal for equal callables, without keeping them alive"
+    if isinstance(f, types.MethodType):
+        return (id(f.__self__), id(f.__func__))
+    return id(f)
+
+
+class WeakCallableSet:
+    """A set of functions or bound methods, held by weak refs.
+    Dead entries remove themselves, so add, discard and cleanup are all O(1).
+    Iterates in the order things were added, and only yields live callables."""
+
+    __slots__ = ("_refs", "__weakref__")
+
+    def __init__(self):
+        self._refs: dict[object, weakref.ref] = {}
+
+    def add(self, f):
+        key = _callable_key(f)
+        if key in self._refs and self._refs[key]() is not None:
+            return
+
+        selfref = weakref.ref(self)
+
+        def remove(r):
+            s = selfref()
+            # Make sure it's still our entry, the id may have been reused already
+            if s is not None and s._refs.get(key) is r:
+                del s._refs[key]
+
+        self._refs[key] = universal_weakref(f, remove)
+
+    def discard(self, f):
+        key = _callable_key(f)
+        r = self._refs.get(key)
+        if r is not None and r() == f:
+            del self._refs[key]
+
+    def __contains__(self, f) -> bool:
+        r = self._refs.get(_callable_key(f))
+        return r is not None and r() == f
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        # Copy first, entries can vanish at any time when things get collected
+        for r in tuple(self._refs.values()):
+            f = r()
+            if f is not None:
+                yield f
+
+
 def search_paths(fn: str, paths: list[str]) -> str | None:
     for i in paths:
         if os.path.exists(os.path.join(i, fn)):
@@ -45,3 +45,16 @@ class TestMsgbus(unittest.TestCase):
             time.sleep(0.01)
             s -= 1
         self.assertEqual(p, ["foo"])
+
+    def test_debounce(self):
+        p = []
+
+        def f(v):
+            p.append(v)
+
+        messagebus.subscribe("/test/debounce", f, debounce=0.1)
+        for i in range(10):
+            messagebus.post_message("/test/debounce", i, synchronous=True)
+
+        time.sleep(0.5)
+        self.assertEqual(p, [9])
@@ -0,0 +1,495 @@
+import array
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from scullery import persist
+
+
+OPTIONAL = {"msgpack": "msgpack", "cbor": "cbor2", "zst": "zstandard", "lz4": "lz4"}
+
+
+def need(ext):
+    for part in ext.split("."):
+        if part in OPTIONAL:
+            pytest.importorskip(OPTIONAL[part])
+
+
+@pytest.mark.parametrize("ext", ["json", "yaml", "json.gz", "json.bz2", "msgpack", "cbor.gz", "json.zst", "yaml.lz4"])
+def test_save_load(tmp_path, ext):
+    need(ext)
+    fn = str(tmp_path / "sub" / f"data.{ext}")
+    data = {"a": [1, 2, 3], "b": "text"}
+
+    persist.save(data, fn)
+    assert persist.load(fn) == data
+
+    mtime = os.stat(fn).st_mtime_ns
+    # Unchanged data doesn't get rewritten
+    persist.save(data, fn)
+    assert os.stat(fn).st_mtime_ns == mtime
+
+    with pytest.raises(ValueError):
+        persist.save(data, str(tmp_path / "data.unknown"))
+
+
+def test_concurrent_saves(tmp_path):
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(20):
+                fn = str(tmp_path / f"{n % 4}.json")
+                persist.save({"n": n, "i": i}, fn, backup=False)
+                assert set(persist.load(fn)) == {"n", "i"}
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+
+
+def test_unchanged_saves_skip_reads(tmp_path, monkeypatch):
+    fn = str(tmp_path / "data.json.gz")
+    data = {"a": list(range(1000))}
+    persist.save(data, fn)
+
+    reads = []
+
+    def counting_open(f, mode="r", *args, **kwargs):
+        if "r" in mode:
+            reads.append(f)
+        return open(f, mode, *args, **kwargs)
+
+    monkeypatch.setattr(persist, "open", counting_open, raising=False)
+
+    # Gzip output is the same every time, and we know what's in the file
+    mtime = os.stat(fn).st_mtime_ns
+    persist.save(data, fn)
+    assert os.stat(fn).st_mtime_ns == mtime
+    assert reads == []
+
+    # Touched by someone else, so we have to look, but it's still the same
+    os.utime(fn, ns=(mtime + 10**9, mtime + 10**9))
+    persist.save(data, fn)
+    assert len(reads) == 1
+    assert os.stat(fn).st_mtime_ns == mtime + 10**9
+
+    with open(fn, "wb") as f:
+        f.write(b"garbage")
+    persist.save(data, fn)
+    assert persist.load(fn) == data
+
+
+@pytest.mark.parametrize("ext", ["json", "yaml", "txt", "json.gz", "json.bz2", "bin.bz2", "cbor", "json.zst", "jsonl.lz4"])
+def test_streaming_save(tmp_path, ext):
+    need(ext)
+    fn = str(tmp_path / f"data.{ext}")
+    if ext.startswith("bin"):
+        data = os.urandom(3_000_000)
+    elif ext == "txt":
+        data = "hello" * 100000
+    elif ext.startswith("jsonl"):
+        data = [{"id": i, "name": f"row {i}"} for i in range(5000)]
+    else:
+        data = {"rows": [{"id": i, "name": f"row {i}"} for i in range(5000)]}
+
+    persist.save(data, fn, stream=True)
+    assert persist.load(fn) == data
+
+    # Byte for byte the same as a normal save, so that saving one way then the other is skipped
+    mtime = os.stat(fn).st_mtime_ns
+    persist.save(data, fn)
+    assert os.stat(fn).st_mtime_ns == mtime
+    persist._digests.clear()
+    # Loading doesn't hash anything, only saving does
+    assert persist.load(fn) == data
+    assert not persist._digests
+    persist.save(data, fn, stream=True)
+    assert os.stat(fn).st_mtime_ns == mtime
+
+    # No temp files left over
+    assert os.listdir(tmp_path) == [f"data.{ext}"]
+
+    if ext.startswith("bin"):
+        persist.save((data[i : i + 1000] for i in range(0, len(data), 1000)), fn, stream=True)
+        assert persist.load(fn) == data
+
+
+@pytest.mark.parametrize("ext", ["gz", "bz2", "zst", "lz4"])
+def test_compression_level(tmp_path, ext):
+    need(ext)
+    fn = str(tmp_path / f"data.json.{ext}")
+    # Bigger than a bz2 block at level 1
+    data = {"rows": [f"row {i}" for i in range(30000)]}
+
+    persist.save(data, fn, level=1)
+    with open(fn, "rb") as f:
+        fast = f.read()
+    persist.save(data, fn, level=9)
+    with open(fn, "rb") as f:
+        assert not f.read() == fast
+    assert persist.load(fn) == data
+
+
+def test_register_codec(tmp_path):
+    persist.register_codec(".upper", lambda data: data.upper().encode(), lambda raw: raw.decode().lower())
+    try:
+        fn = str(tmp_path / "data.upper.gz")
+        persist.save("hello", fn)
+        assert persist.load(fn) == "hello"
+        persist.save("world", fn, stream=True)
+        assert persist.load(fn) == "world"
+    finally:
+        del persist.codecs[".upper"]
+
+
+def test_large_bz2(tmp_path):
+    # Big enough that the compressor returns output before flush()
+    fn = str(tmp_path / "data.bin.bz2")
+    data = os.urandom(2_000_000)
+    persist.save(data, fn)
+    assert persist.load(fn) == data
+
+
+@pytest.mark.parametrize("ext", ["jsonl", "ndjson.gz", "jsonl.bz2", "jsonl.zst", "jsonl.lz4"])
+def test_iter_load(tmp_path, ext):
+    need(ext)
+    fn = str(tmp_path / f"log.{ext}")
+    records = [{"i": i, "msg": f"line {i}\nwith newline"} for i in range(1000)]
+
+    persist.save(iter(records), fn, stream=True)
+    assert list(persist.iter_load(fn)) == records
+    assert persist.load(fn) == records
+
+    with pytest.raises(ValueError):
+        list(persist.iter_load(str(tmp_path / "data.json")))
+
+
+@pytest.mark.parametrize("ext", ["json", "json.gz"])
+def test_load_keys(tmp_path, ext):
+    fn = str(tmp_path / f"data.{ext}")
+    data = {
+        "header": {"version": 2},
+        "rows": [{"name": 'tricky "]} string', "values": [1, [2, {}]]} for i in range(10000)],
+        "footer": "end",
+        "empty": [],
+        "flag": False,
+    }
+    persist.save(data, fn)
+
+    assert persist.load_keys(fn, ["header"]) == {"header": {"version": 2}}
+    assert persist.load_keys(fn, ["footer", "flag", "missing"]) == {"footer": "end", "flag": False}
+    assert persist.load_keys(fn, data.keys()) == data
+
+
+def test_json_scanner_long_strings():
+    # Escapes and quotes land on every possible read boundary.
+    # Scanning restarts where it got to after each read, so this is quick even one byte at a time.
+    data = {"skip": ['a\\"b' * 10, {"s": "x" * 50000}], "long": 'q"\\' * 20000, "n": -12.5}
+    raw = json.dumps(data).encode()
+    for size in [1, 2, 3, 7, 1 << 20]:
+        scanner = persist._JsonScanner(io.BytesIO(raw), chunk_size=size)
+        scanner.expect(b"{")
+        assert scanner.key() == "skip"
+        scanner.expect(b":")
+        scanner.skip_value()
+        scanner.expect(b",")
+        assert scanner.key() == "long"
+        scanner.expect(b":")
+        assert scanner.value() == data["long"]
+        scanner.expect(b",")
+        assert scanner.key() == "n"
+        scanner.expect(b":")
+        assert scanner.value() == -12.5
+        scanner.expect(b"}")
+        assert scanner.peek() == -1
+
+    with pytest.raises(ValueError):
+        persist._JsonScanner(io.BytesIO(b'"unterminated'), chunk_size=4).skip_value()
+
+
+def test_deferred_save(tmp_path, monkeypatch):
+    fn = str(tmp_path / "state.json")
+    writes = []
+    write = persist._write
+    monkeypatch.setattr(persist, "_write", lambda data, fn, *a: writes.append(fn) or write(data, fn, *a))
+    monkeypatch.setattr(persist, "flush_interval", 60)
+
+    for i in range(100):
+        persist.save({"i": i}, fn, deferred=True)
+
+    # Not written yet, but reads see it
+    assert not os.path.exists(fn)
+    assert persist.load(fn) == {"i": 99}
+
+    persist.flush(fn)
+    assert writes == [fn]
+    assert persist.load(fn) == {"i": 99}
+
+    # A normal save wins over an older deferred one
+    persist.save({"i": 100}, fn, deferred=True)
+    persist.save({"i": 101}, fn)
+    persist.flush_all()
+    assert persist.load(fn) == {"i": 101}
+
+    with pytest.raises(ValueError):
+        persist.save({}, fn, deferred=True, stream=True)
+
+
+def test_deferred_background_flush(tmp_path, monkeypatch):
+    monkeypatch.setattr(persist, "flush_interval", 0.05)
+    fn = str(tmp_path / "log.jsonl")
+    persist.save([{"a": 1}], fn, deferred=True)
+    assert list(persist.iter_load(fn)) == [{"a": 1}]
+
+    for i in range(100):
+        if os.path.exists(fn):
+            break
+        time.sleep(0.02)
+    assert persist._pending == {}
+    with open(fn) as f:
+        assert f.read() == '{"a": 1}\n'
+
+
+def test_read_cache(tmp_path, monkeypatch):
+    fn = str(tmp_path / "config.yaml")
+    persist.save({"a": [1, 2], "b": {"c": 3}}, fn)
+
+    reads = []
+    real_open = open
+
+    def counting_open(f, mode="r", *args, **kwargs):
+        reads.append(f)
+        return real_open(f, mode, *args, **kwargs)
+
+    monkeypatch.setattr(persist, "open", counting_open, raising=False)
+
+    first = persist.load(fn, cache=True)
+    assert len(reads) == 1
+
+    # Callers get their own copies
+    first["a"].append(99)
+    second = persist.load(fn, cache=True)
+    assert second == {"a": [1, 2], "b": {"c": 3}}
+    assert len(reads) == 1
+
+    # Saving invalidates, even when the stat signature might not change
+    persist.save({"a": [5]}, fn, backup=False)
+    assert persist.load(fn, cache=True) == {"a": [5]}
+
+    # So does someone else changing the file
+    with real_open(fn, "w") as f:
+        f.write("a: [6, 7]\n")
+    assert persist.load(fn, cache=True) == {"a": [6, 7]}
+
+
+def test_read_cache_bounded(tmp_path, monkeypatch):
+    persist.clear_read_cache()
+    monkeypatch.setattr(persist, "read_cache_size", 10000)
+
+    for i in range(20):
+        fn = str(tmp_path / f"{i}.json")
+        persist.save({"data": "x" * 1000}, fn)
+        persist.load(fn, cache=True)
+
+    assert persist._read_cache_bytes <= 10000
+    assert persist._read_cache_bytes == sum(len(i[1]) for i in persist._read_cache.values())
+    # The most recent are the ones kept
+    assert os.path.abspath(str(tmp_path / "19.json")) in persist._read_cache
+    assert os.path.abspath(str(tmp_path / "0.json")) not in persist._read_cache
+    persist.clear_read_cache()
+    assert persist._read_cache_bytes == 0
+
+
+@pytest.mark.parametrize("ext", ["json", "json.gz", "json.zst"])
+def test_journal(tmp_path, ext):
+    need(ext)
+    fn = str(tmp_path / f"state.{ext}")
+
+    with persist.Journal(fn) as j:
+        j["a"] = {"x": [1, 2]}
+        j.update(b=2, c=3)
+        del j["c"]
+        # Values are copies
+        j["a"]["x"].append(3)
+        assert j["a"] == {"x": [1, 2]}
+        assert dict(j) == {"a": {"x": [1, 2]}, "b": 2}
+
+    with persist.Journal(fn) as j:
+        assert dict(j) == {"a": {"x": [1, 2]}, "b": 2}
+        j.compact(wait=True)
+        j["d"] = None
+
+    # The snapshot and one log after it
+    assert len(os.listdir(tmp_path)) == 2
+    with persist.Journal(fn) as j:
+        assert dict(j) == {"a": {"x": [1, 2]}, "b": 2, "d": None}
+
+
+def test_journal_compacts(tmp_path):
+    fn = str(tmp_path / "state.json")
+    with persist.Journal(fn, compact_size=10000) as j:
+        for r in range(50):
+            j.update({f"k{i}": r * 100 + i for i in range(100)})
+        j.close()
+        # Compacted along the way, so there isn't much log left
+        assert persist.load(fn)["generation"] > 1
+        assert sum(os.path.getsize(tmp_path / i) for i in os.listdir(tmp_path)) < 30000
+
+    with persist.Journal(fn) as j:
+        assert dict(j) == {f"k{i}": 4900 + i for i in range(100)}
+
+
+def test_journal_torn_write(tmp_path):
+    fn = str(tmp_path / "state.json")
+    with persist.Journal(fn) as j:
+        j["a"] = 1
+        j["b"] = 2
+
+    # Crashed partway through writing the next record
+    (log,) = [i for i in os.listdir(tmp_path) if i.endswith(".jsonl")]
+    with open(tmp_path / log, "a") as f:
+        f.write('{"k": "c", "v": [1, 2')
+
+    with persist.Journal(fn) as j:
+        assert dict(j) == {"a": 1, "b": 2}
+        j["c"] = 3
+    with persist.Journal(fn) as j:
+        assert dict(j) == {"a": 1, "b": 2, "c": 3}
+
+
+def test_journal_group_commit(tmp_path, monkeypatch):
+    fsyncs = []
+    real_fsync = os.fsync
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        time.sleep(0.005)
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    j = persist.Journal(str(tmp_path / "state.json"))
+
+    def worker(n):
+        for i in range(20):
+            j[f"{n}"] = i
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Writers waiting on the same fsync share it
+    assert len(fsyncs) < 200
+    j.close()
+    assert dict(persist.Journal(str(tmp_path / "state.json"))) == {f"{n}": 19 for n in range(10)}
+
+
+def test_journal_no_sync(tmp_path):
+    fn = str(tmp_path / "state.json")
+    j = persist.Journal(fn, sync=False, commit_interval=60)
+    j["a"] = 1
+    assert j._synced == 0
+    j.commit()
+    assert dict(persist.Journal(fn)) == {"a": 1}
+    j.close()
+
+
+def test_buffer_saves(tmp_path):
+    fn = str(tmp_path / "data.bin")
+    numbers = array.array("d", range(1000))
+
+    for data, expected in [
+        (bytearray(b"abc" * 1000), b"abc" * 1000),
+        (numbers, numbers.tobytes()),
+        # Not in one piece, so it has to be copied
+        (memoryview(b"abcdef")[::2], b"ace"),
+    ]:
+        persist.save(data, fn)
+        assert persist.load(fn) == expected
+        persist.save(data, fn + ".gz", stream=True)
+        assert persist.load(fn + ".gz") == expected
+
+    persist.save((numbers[i : i + 10] for i in range(0, 1000, 10)), fn, stream=True)
+    assert persist.load(fn) == numbers.tobytes()
+
+
+def test_open_buffer(tmp_path):
+    fn = str(tmp_path / "data.bin")
+    persist.save(b"0123456789" * 1000, fn)
+
+    view = persist.load(fn, mmap=True)
+    assert view.readonly
+    assert view[10:13] == b"012"
+    assert len(view) == 10000
+
+    # Not written in place while mapped, so the view keeps its contents
+    persist.save(b"x", fn, backup=False)
+    assert bytes(view[:3]) == b"012"
+    assert persist.load(fn) == b"x"
+
+    part = view[5:8]
+    del view
+    assert part == b"567"
+
+    persist.save(b"", fn)
+    assert persist.open_buffer(fn) == b""
+
+    with pytest.raises(ValueError):
+        persist.open_buffer(str(tmp_path / "data.bin.gz"))
+
+
+def test_async_save_load(tmp_path, monkeypatch):
+    real_fsync = os.fsync
+
+    def slow_fsync(fd):
+        time.sleep(0.05)
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+
+    async def main():
+        fn = str(tmp_path / "data.json")
+        # Big first, so it would finish last if they ran at the same time
+        saves = [persist.asave({"i": i, "pad": "x" * (100000 if i == 0 else 0)}, fn) for i in range(5)]
+        loaded = persist.aload(fn)
+
+        # The loop keeps running while they are written
+        ticks = 0
+        while not loaded.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+        await asyncio.gather(*saves)
+        assert (await loaded)["i"] == 4
+
+        # Other files don't wait for this one
+        other = [persist.asave({"n": n}, str(tmp_path / f"{n}.json")) for n in range(4)]
+        await asyncio.gather(*other)
+        assert [await persist.aload(str(tmp_path / f"{n}.json")) for n in range(4)] == [{"n": n} for n in range(4)]
+
+        with pytest.raises(ValueError):
+            await persist.asave({}, str(tmp_path / "data.unknown"))
+
+        # Cancelled saves still happen
+        task = asyncio.ensure_future(persist.asave({"i": 5}, fn))
+        task.cancel()
+        assert (await persist.aload(fn))["i"] == 5
+        return ticks
+
+    assert asyncio.run(main()) > 5
+
+    with pytest.raises(RuntimeError):
+        persist.asave({}, str(tmp_path / "data.json"))
@@ -1,5 +1,6 @@
 import time
 import scullery.ratelimits
+import scullery.clocks
 
 
 def test_rate_limits():
@@ -27,3 +28,22 @@ def test_rate_limits():
         rl.limit()
 
     assert abs(rl.limit() - 3) < 2
+
+
+def test_rate_limits_virtual_clock():
+    clock = scullery.clocks.VirtualClock()
+    rl = scullery.ratelimits.RateLimiter(hz=10, burst=3, clock=clock)
+
+    assert rl.limit() == 2
+    assert rl.limit() == 1
+    rl.limit()
+    assert rl.current_limit == 0
+
+    # Exactly one credit comes back
+    clock.advance(0.1)
+    rl.limit()
+    assert rl.current_limit == 0
+
+    # But never more than the burst limit
+    clock.advance(100)
+    assert rl.limit() == 2
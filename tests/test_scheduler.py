@@ -1,7 +1,9 @@
 import unittest
 import time
+import asyncio
+import threading
 
-from scullery import scheduling
+from scullery import scheduling, clocks
 
 
 class TestScheduler(unittest.TestCase):
@@ -26,3 +28,240 @@ class TestScheduler(unittest.TestCase):
         time.sleep(2)
 
         assert x == c[0]
+
+
+def test_virtual_clock():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    c = []
+
+    @sched.every(60)
+    def f():
+        c.append(clock.time())
+
+    # A whole day, instantly
+    clock.advance(24 * 3600)
+    assert len(c) == 24 * 60
+
+    # Every run happened exactly on schedule
+    assert c[1] - c[0] == 60
+
+    f.unregister()
+    clock.advance(3600)
+    assert len(c) == 24 * 60
+
+    done = []
+
+    def g():
+        done.append(clock.time())
+
+    sched.schedule(g, clock.time() + 5)
+    clock.advance(4.9)
+    assert not done
+    clock.advance(0.2)
+    assert len(done) == 1
+
+
+def test_scheduler_stats():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    def slow():
+        time.sleep(0.02)
+
+    def fast():
+        pass
+
+    e1 = sched.every(slow, 0.01)
+    e2 = sched.every(fast, 0.1)
+
+    clock.advance(0.5)
+
+    stats = sched.get_stats()
+    assert stats["queue_size"] == 2
+    assert stats["repeating_events"] == 2
+    assert stats["runs"] == e1.e.stats.runs + e2.e.stats.runs
+    # Virtual time never runs late
+    assert stats["lateness_histogram"][0] == stats["runs"]
+
+    # The slow one takes longer than its own interval every time
+    assert e1.e.stats.overruns == e1.e.stats.runs
+    assert e2.e.stats.overruns == 0
+
+    top = sched.slowest_events(1)
+    assert top[0]["name"] == str(slow)
+
+    e1.unregister()
+    e2.unregister()
+
+
+def test_wall_clock_jump():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    c = []
+    wall = []
+
+    def f():
+        c.append(1)
+
+    def g():
+        wall.append(1)
+
+    e = sched.every(f, 1)
+    sched.schedule(g, clock.time() + 3600)
+    clock.advance(10)
+    n = len(c)
+
+    # Step the wall clock forward an hour, like NTP after boot.
+    # Interval events don't all fire at once, but the wall clock event is now due.
+    clock.step(3600)
+    assert len(c) == n
+    assert wall == [1]
+
+    # Going backwards doesn't stall interval events either
+    clock.step(-7200)
+    clock.advance(10)
+    assert len(c) == n + 10
+
+    e.unregister()
+
+
+def test_async_every():
+    c = []
+    once = []
+
+    async def f():
+        await asyncio.sleep(0)
+        c.append(threading.current_thread())
+
+    async def g():
+        once.append(1)
+
+    async def main():
+        async with scheduling.every(f, 0.05):
+            scheduling.scheduler.schedule_after(g, 0.1)
+            await asyncio.sleep(0.5)
+
+        n = len(c)
+        await asyncio.sleep(0.3)
+        return n
+
+    n = asyncio.run(main())
+
+    # Ran in the loop's own thread, and stopped when the block exited
+    assert n > 3
+    assert len(c) == n
+    assert c[0] == threading.current_thread()
+    assert once == [1]
+
+
+def test_debounce_throttle():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    d = []
+    t = []
+
+    @scheduling.debounce(0.1, scheduler=sched)
+    def save(x):
+        d.append(x)
+
+    @scheduling.throttle(0.25, scheduler=sched)
+    def push(x):
+        t.append(x)
+
+    for i in range(100):
+        save(i)
+        push(i)
+        clock.advance(0.01)
+
+    clock.advance(0.25)
+    # Calls never stopped long enough until the very end
+    assert d == [99]
+
+    # First call right away, then one per interval with the latest value
+    assert t == [0, 24, 49, 74, 99]
+
+    # One Event, only pushed back once per wait period rather than once per call
+    assert save._event.stats.runs < 15
+
+
+def test_debounce_throttle_methods():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    class Device:
+        def __init__(self):
+            self.saved = []
+            self.pushed = []
+
+        @scheduling.debounce(0.1, scheduler=sched)
+        def save(self, x):
+            self.saved.append(x)
+
+        @scheduling.throttle(0.25, scheduler=sched)
+        def push(self, x):
+            self.pushed.append(x)
+
+    a = Device()
+    b = Device()
+    assert a.save is a.save
+    assert a.save is not b.save
+
+    # Each instance has its own limiter, so b's calls don't swallow a's
+    a.save(1)
+    b.save(2)
+    a.push(1)
+    b.push(2)
+    a.push(3)
+    clock.advance(0.3)
+    assert a.saved == [1]
+    assert b.saved == [2]
+    assert a.pushed == [1, 3]
+    assert b.pushed == [2]
+
+
+def test_async_every_no_overlap():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    running = []
+    most = []
+    release = None
+
+    async def f():
+        running.append(1)
+        most.append(len(running))
+        await release.wait()
+        running.pop()
+
+    async def turns():
+        # One for the scheduler's call into the loop, one for the task to start
+        for i in range(3):
+            await asyncio.sleep(0)
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        e = sched.every(f, 1)
+        clock.advance(1)
+        await turns()
+        assert running == [1]
+
+        # Long enough that error recovery thinks it's stuck and reschedules it
+        clock.advance(11)
+        sched._do_error_recovery()
+        clock.advance(2)
+        await turns()
+
+        assert most == [1]
+        assert e.e.stats.skipped > 0
+
+        release.set()
+        await turns()
+        clock.advance(2)
+        await turns()
+        e.unregister()
+
+    asyncio.run(main())
+    # Kept running after the slow one, one at a time
+    assert len(most) > 1
+    assert max(most) == 1
@@ -1,5 +1,6 @@
 import time
-from scullery import statemachines
+import pytest
+from scullery import statemachines, scheduling, clocks, messagebus
 
 
 class Obj:
@@ -133,3 +134,572 @@ def test_state_machines():
     if not transitions == ["on"]:
         print(transitions)
         raise RuntimeError("State machines not working as they should")
+
+
+def test_state_machine_virtual_clock():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    sm = statemachines.StateMachine(start="off", scheduler=sched)
+    sm.add_state("on")
+    sm.add_state("off")
+    sm.add_rule("off", "motion", "on")
+    sm.set_timer("on", 3600, "off")
+
+    sm.event("motion")
+    clock.advance(3599)
+    assert sm.state == "on"
+    clock.advance(2)
+    assert sm.state == "off"
+
+
+def test_frozen_state_machine():
+    sm = statemachines.StateMachine(start="off")
+    sm.add_state("on")
+    sm.add_state("off")
+    sm.add_rule("off", "toggle", "on")
+    sm.add_rule("on", "toggle", "off")
+    sm.add_rule("on", "maybe", lambda m: "off" if m.prev_state == "off" else None)
+    sm.freeze()
+
+    with pytest.raises(RuntimeError):
+        sm.add_rule("off", "other", "on")
+
+    for i in range(1001):
+        sm.event("toggle")
+    assert sm.state == "on"
+
+    # No rule for this event in this state
+    assert sm("nonsense") == "on"
+
+    assert sm("maybe") == "off"
+    assert sm.prev_state == "on"
+
+
+def test_state_machine_conditions():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    level = [0]
+    polls = [0]
+
+    def high():
+        polls[0] += 1
+        return level[0] > 10
+
+    def low():
+        return level[0] < 5
+
+    sm = statemachines.StateMachine(start="low", scheduler=sched)
+    sm.add_state("low")
+    sm.add_state("high")
+    sm.add_rule("low", high, "high")
+    sm.add_rule("high", low, "low", topics=["/test/sm_level"])
+
+    # Polled through the shared poller
+    clock.advance(1)
+    assert polls[0] > 20
+    level[0] = 20
+    clock.advance(0.1)
+    assert sm.state == "high"
+
+    # Nothing polls in the high state
+    polls[0] = 0
+    clock.advance(1)
+    assert polls[0] == 0
+
+    # Only a message on the topic causes a recheck
+    level[0] = 0
+    clock.advance(1)
+    assert sm.state == "high"
+    messagebus.post_message("/test/sm_level", 0, synchronous=True)
+    assert sm.state == "low"
+
+    # Many machines watching a topic share one bus subscription
+    machines = [statemachines.StateMachine(start="high", scheduler=sched) for i in range(50)]
+    for m in machines:
+        m.add_state("low")
+        m.add_state("high")
+        m.add_rule("high", low, "low", topics=["/test/sm_level2"])
+    assert len(messagebus._bus._subscribers["/test/sm_level2"]) == 1
+    messagebus.post_message("/test/sm_level2", 0, synchronous=True)
+    assert all(m.state == "low" for m in machines)
+
+
+def test_state_machine_timer_service():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    sm = statemachines.StateMachine(start="a", scheduler=sched)
+    sm.add_state("a")
+    sm.add_state("b")
+    sm.add_state("timeout")
+    sm.add_rule("a", "go", "b")
+    sm.add_rule("b", "go", "a")
+    sm.set_timer("a", 10, "timeout")
+    sm.set_timer("b", 10, "timeout")
+
+    timers = statemachines._get_timer_service(sched)
+
+    # Rapid transitions between timed states don't pile up timer entries
+    for i in range(1000):
+        sm.event("go")
+        clock.advance(0.001)
+    assert len(timers) == 1
+
+    # The timer counts from the last transition
+    clock.advance(9.9)
+    assert sm.state == "a"
+    clock.advance(0.2)
+    assert sm.state == "timeout"
+    assert len(timers) == 0
+
+    # Skipping ahead still works
+    sm.goto("a")
+    sm.seek(9.5)
+    clock.advance(0.6)
+    assert sm.state == "timeout"
+
+
+def test_state_machine_ordered_dispatch():
+    seen = []
+    posted = []
+
+    def slow_subscriber(state):
+        time.sleep(0.05)
+        seen.append(state)
+
+    def bus_subscriber(state):
+        posted.append(state)
+
+    messagebus.subscribe("/test/sm_transitions", bus_subscriber)
+
+    sm = statemachines.StateMachine(start="a", dispatch="ordered", topic="/test/sm_transitions")
+    sm.add_state("a")
+    sm.add_state("b")
+    sm.add_rule("a", "go", "b")
+    sm.add_rule("b", "go", "a")
+    sm.subscribe(slow_subscriber)
+
+    t = time.monotonic()
+    for i in range(10):
+        sm.event("go")
+    # The slow subscriber didn't hold anything up
+    assert time.monotonic() - t < 0.25
+
+    for i in range(100):
+        if len(seen) == 10 and len(posted) == 10:
+            break
+        time.sleep(0.02)
+
+    # But still saw every transition, in order
+    assert seen == ["b", "a"] * 5
+    assert sorted(posted) == sorted(seen)
+
+
+def test_state_machine_group():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    d = statemachines.StateMachine(start="idle", scheduler=sched)
+    d.add_state("idle")
+    d.add_state("running")
+    d.add_state("fault")
+    d.add_rule("idle", "start", "running")
+    d.add_rule("running", "power_fail", "fault")
+    d.add_rule("idle", "power_fail", "fault")
+    d.set_timer("running", 10, "idle")
+
+    entered = []
+
+    group = statemachines.StateMachineGroup(d, 100)
+    assert d.frozen
+    assert group.counts() == {"idle": 100}
+
+    def subscriber(members, state):
+        entered.append((len(members), state))
+
+    group.subscribe(subscriber, "fault")
+
+    # Only the masked members start
+    assert group.event("start", mask=[i % 2 == 0 for i in range(100)]) == 50
+    assert group.counts() == {"idle": 50, "running": 50}
+    assert group[2].state == "running"
+    assert group[3].state == "idle"
+
+    clock.advance(5)
+    assert group.older_than(5, "running") == list(range(0, 100, 2))
+
+    # Restarting one member restarts its timer only
+    group[2].goto("idle")
+    group[2].event("start")
+    clock.advance(5.1)
+    assert group.counts() == {"idle": 99, "running": 1}
+    assert group.in_state("running") == [2]
+
+    assert group.event("power_fail") == 100
+    assert group.counts() == {"fault": 100}
+    assert sum(i[0] for i in entered) == 100
+    assert group[2].prev_state == "running"
+
+    # The old timer is stale
+    clock.advance(10)
+    assert group.counts() == {"fault": 100}
+
+    # Nothing has a rule for this
+    assert group.event("start") == 0
+
+    # Listing a member twice only moves it once
+    assert group.goto("idle", mask=[1, 1, 2]) == 2
+    assert group.event("start", mask=[3, 3]) == 0
+    assert group.event("start", mask=[1, 1]) == 1
+    assert group.counts() == {"fault": 98, "idle": 1, "running": 1}
+    assert group.in_state("running") == [1]
+
+
+def test_state_machine_checkpoint(tmp_path):
+    fn = str(tmp_path / "machines.json")
+
+    def make(clock):
+        sched = scheduling.NewScheduler(clock=clock)
+        sm = statemachines.StateMachine(start="off", scheduler=sched)
+        sm.add_state("off")
+        sm.add_state("on")
+        sm.add_rule("off", "motion", "on")
+        sm.set_timer("on", 3600, "off")
+        sm.freeze()
+        return sm
+
+    clock = clocks.VirtualClock(start=1000)
+    sm = make(clock)
+    group = statemachines.StateMachineGroup(make(clock), 10)
+
+    # First run, nothing saved yet
+    assert statemachines.restore_checkpoint({"sm": sm}, fn) == []
+    assert sm.state == "off"
+    sm.event("motion")
+    group.event("motion", mask=range(5))
+    clock.advance(3000)
+
+    snap = sm.snapshot()
+    assert snap["state"] == "on"
+    assert snap["timer_remaining"] == pytest.approx(600)
+
+    statemachines.checkpoint({"sm": sm, "group": group}, fn)
+
+    # A new process, 500 seconds later
+    clock2 = clocks.VirtualClock(start=clock.time() + 500)
+    sm2 = make(clock2)
+    group2 = statemachines.StateMachineGroup(make(clock2))
+    assert statemachines.restore_checkpoint({"sm": sm2, "group": group2, "other": sm2}, fn) == ["sm", "group"]
+
+    assert sm2.state == "on"
+    assert sm2.entered_state == sm.entered_state
+    assert group2.counts() == {"on": 5, "off": 5}
+
+    # The timers carry on where they left off
+    clock2.advance(99)
+    assert sm2.state == "on"
+    assert group2.counts() == {"on": 5, "off": 5}
+    clock2.advance(2)
+    assert sm2.state == "off"
+    assert group2.counts() == {"off": 10}
+
+    # Without catch up, downtime doesn't count
+    sm3 = make(clock2)
+    sm3.restore(snap, catch_up=False)
+    clock2.advance(599)
+    assert sm3.state == "on"
+    clock2.advance(2)
+    assert sm3.state == "off"
+
+
+def test_state_machine_subscribers():
+    sm = statemachines.StateMachine(start="a")
+    sm.add_state("a")
+    sm.add_state("b")
+    sm.add_rule("a", "go", "b")
+    sm.add_rule("b", "go", "a")
+
+    seen_a = []
+    seen_b = []
+
+    def on_a(state):
+        seen_a.append(state)
+
+    def on_b(state):
+        seen_b.append(state)
+
+    class Listener:
+        def __init__(self):
+            self.seen = []
+
+        def on_any(self, state):
+            self.seen.append(state)
+
+    listener = Listener()
+
+    sm.subscribe(on_a, "a")
+    sm.subscribe(on_b, "b")
+    # Subscribing to one state doesn't touch the others
+    sm.subscribe(on_b, "b")
+    sm.subscribe(listener.on_any)
+
+    sm.event("go")
+    sm.event("go")
+    assert seen_a == ["a"]
+    assert seen_b == ["b"]
+    assert listener.seen == ["b", "a"]
+
+    sm.unsubscribe(on_b, "b")
+    sm.unsubscribe(listener.on_any)
+    sm.event("go")
+    assert seen_b == ["b"]
+    assert listener.seen == ["b", "a"]
+
+    # Dead subscribers clean themselves up
+    sm.subscribe(listener.on_any)
+    assert len(sm._subscribers["__all__"]) == 1
+    del listener
+    assert len(sm._subscribers["__all__"]) == 0
+    assert len(sm._subscribers["a"]) == 1
+
+
+def test_state_machine_hierarchy():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    log = []
+
+    sm = statemachines.StateMachine(start="off", scheduler=sched)
+    sm.add_state("off")
+    sm.add_state("on", initial="warming", enter=lambda: log.append("enter on"), exit=lambda: log.append("exit on"))
+    sm.add_state("warming", parent="on", exit=lambda: log.append("exit warming"))
+    sm.add_state("ready", parent="on", enter=lambda: log.append("enter ready"))
+    sm.add_rule("off", "power", "on")
+    # Inherited by both children
+    sm.add_rule("on", "power", "off")
+    sm.set_timer("warming", 5, "ready")
+    # Counts from entering on, not the children
+    sm.set_timer("on", 60, "off")
+
+    sm.event("power")
+    assert sm.state == "warming"
+    assert sm.in_state("on")
+    assert log == ["enter on"]
+
+    clock.advance(5)
+    assert sm.state == "ready"
+    assert log == ["enter on", "exit warming", "enter ready"]
+
+    clock.advance(54)
+    assert sm.state == "ready"
+    clock.advance(1)
+    assert sm.state == "off"
+    assert log[-1] == "exit on"
+
+    sm.event("power")
+    sm.event("power")
+    assert sm.state == "off"
+    assert not sm.in_state("on")
+
+
+def test_state_machine_nested_start():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    # Starts inside p without ever entering it
+    sm = statemachines.StateMachine(start="a", scheduler=sched)
+    sm.add_state("p")
+    sm.add_state("a", parent="p")
+    sm.add_state("b")
+    sm.set_timer("a", 2, "b")
+    sm.set_timer("p", 5, "b")
+    sm.add_region("r", "a")
+
+    sm.seek(0)
+    snap = sm.snapshot()
+    assert snap["path_positions"] == [0, 0]
+    assert snap["timer_remaining"] == 2
+    assert snap["regions"]["r"]["path_positions"] == [0, 0]
+
+    clock.advance(2)
+    assert sm.state == "b"
+
+    sm.restore(snap, catch_up=False)
+    assert sm.state == "a"
+    clock.advance(1)
+    assert sm.state == "a"
+    clock.advance(1)
+    assert sm.state == "b"
+
+
+def test_state_machine_regions():
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+
+    sm = statemachines.StateMachine(start="idle", scheduler=sched)
+    sm.add_state("idle")
+    sm.add_state("running")
+    sm.add_state("light_off")
+    sm.add_state("light_on")
+    sm.add_rule("idle", "start", "running")
+    sm.add_rule("light_off", "start", "light_on")
+    sm.add_rule("light_on", "toggle", "light_off")
+    sm.set_timer("light_on", 10, "light_off")
+    sm.add_region("light", "light_off")
+
+    seen = []
+
+    def subscriber(state):
+        seen.append(state)
+
+    sm.subscribe(subscriber)
+
+    assert sm.event("start") == "running"
+    assert sm.regions == {"light": "light_on"}
+    assert sorted(seen) == ["light_on", "running"]
+
+    # Each region has its own timer
+    clock.advance(10)
+    assert sm.state == "running"
+    assert sm.regions == {"light": "light_off"}
+
+    sm.goto("light_on", region="light")
+    snap = sm.snapshot()
+    sm.event("toggle")
+    assert sm.regions == {"light": "light_off"}
+    sm.restore(snap)
+    assert sm.regions == {"light": "light_on"}
+
+
+def test_state_machine_trace_and_stats():
+    clock = clocks.VirtualClock(start=1000)
+    sched = scheduling.NewScheduler(clock=clock)
+
+    def slow_enter():
+        time.sleep(0.01)
+
+    sm = statemachines.StateMachine(start="a", scheduler=sched, trace=3, stats=True)
+    sm.add_state("a")
+    sm.add_state("b", enter=slow_enter)
+    sm.add_rule("a", "go", "b")
+    sm.add_rule("b", "go", "a")
+    sm.set_timer("b", 5, "a")
+
+    sm.event("go")
+    clock.advance(5)
+    sm.event("go")
+    sm.goto("a")
+
+    t = sm.trace()
+    assert len(t) == 3
+    assert t[0] == (1005, "b", "a", "__timer__", None)
+    assert t[1][1:4] == ("a", "b", "go")
+    assert t[2].trigger == "__goto__"
+    assert t[2].from_state == "b"
+
+    clock.advance(1)
+    stats = sm.get_stats()
+    assert stats["transitions"] == 4
+    assert stats["states"]["b"]["entries"] == 2
+    assert stats["states"]["b"]["time_in_state"] == pytest.approx(5)
+    assert stats["states"]["a"]["time_in_state"] == pytest.approx(1)
+    assert stats["states"]["b"]["hook_calls"] == 2
+    assert stats["states"]["b"]["max_hook_time"] >= 0.01
+
+    sm.reset_stats()
+    assert sm.get_stats()["transitions"] == 0
+
+
+def test_machine_definition(tmp_path):
+    fn = str(tmp_path / "machine.yaml")
+    with open(fn, "w") as f:
+        f.write(
+            """
+start: idle
+states:
+  idle:
+    rules: {start: running}
+  running:
+    rules: {stop: idle}
+    timer: [10, idle]
+    enter: on_running
+regions:
+  fan: fan_off
+"""
+        )
+    entered = []
+
+    def on_running():
+        entered.append(1)
+
+    # The region's start state doesn't exist
+    with pytest.raises(ValueError):
+        statemachines.MachineDefinition.load(fn, {"on_running": on_running})
+
+    with open(fn, "w") as f:
+        f.write(
+            """
+start: idle
+states:
+  idle:
+    rules: {start: running}
+  running:
+    rules: {stop: idle}
+    timer: [10, idle]
+    enter: on_running
+  fan_off:
+    rules: {start: fan_on}
+  fan_on: {}
+regions:
+  fan: fan_off
+"""
+        )
+
+    d = statemachines.MachineDefinition.load(fn, {"on_running": on_running})
+
+    clock = clocks.VirtualClock()
+    sched = scheduling.NewScheduler(clock=clock)
+    a = d.machine(scheduler=sched)
+    b = d.machine("running", scheduler=sched)
+
+    assert a.frozen
+    assert a.states is b.states
+    with pytest.raises(RuntimeError):
+        a.add_state("other")
+
+    assert a.state == "idle"
+    assert a.event("start") == "running"
+    assert a.regions == {"fan": "fan_on"}
+    assert b.state == "running"
+    assert entered == [1]
+
+    clock.advance(10)
+    assert a.state == "idle"
+    assert b.state == "idle"
+
+    with pytest.raises(ValueError):
+        statemachines.MachineDefinition({"states": {"a": {"rules": {"x": "a"}, "bogus": 1}}})
+
+    # Destinations that aren't states are caught up front, not when the transition happens
+    for state in [{"rules": {"go": "runing"}}, {"timer": [1, "runing"]}, {"conditions": [{"when": bool, "to": "runing"}]}]:
+        with pytest.raises(ValueError, match="runing"):
+            statemachines.MachineDefinition({"start": "idle", "states": {"idle": state, "running": {}}})
+
+    # Shared by every machine made from it, so it can't be changed
+    with pytest.raises(TypeError):
+        d.states["idle"]["rules"]["stop"] = "running"
+
+    # Starting in a substate, with timers on it and its parent
+    nested = statemachines.MachineDefinition(
+        {"start": "a", "states": {"p": {"timer": [5, "b"]}, "a": {"parent": "p", "timer": [2, "b"]}, "b": {}}}
+    )
+    m = nested.machine(scheduler=sched)
+    assert m.snapshot()["path_positions"] == [0, 0]
+    clock.advance(2)
+    assert m.state == "b"
+
+    group = statemachines.StateMachineGroup(
+        statemachines.MachineDefinition({"start": "a", "states": {"a": {"rules": {"go": "b"}}, "b": {}}}), 10
+    )
+    group.event("go")
+    assert group.counts() == {"b": 10}